@@ -14,6 +14,7 @@ from utils.fmt.plm.base import fix_parameter_name
 from utils.h5serial import h5File
 from utils.io import load_model_cpu
 from utils.torch.comp import torch_autocast, torch_compile, torch_inference_mode
+from utils.torch.quant import quantize_model
 from utils.tqdm import tqdm
 
 import cnfg.plm.bart.base_16kmeng2zhtest as cnfg
@@ -77,14 +78,21 @@ mymodel.eval()
 
 use_cuda, cuda_device, cuda_devices, multi_gpu = parse_cuda_decode(cnfg.use_cuda, cnfg.gpuid, cnfg.multi_gpu_decoding)
 use_amp = cnfg.use_amp and use_cuda
+if quantize_cpu_inference and (not use_cuda):
+	mymodel = quantize_model(mymodel)
 
 # Important to make cudnn methods deterministic
 set_random_seed(cnfg.seed, use_cuda)
 
 if cuda_device:
-	mymodel.to(cuda_device, non_blocking=True)
-	if multi_gpu:
-		mymodel = DataParallelMT(mymodel, device_ids=cuda_devices, output_device=cuda_device.index, host_replicate=True, gather_output=False)
+	# distribute ensemble members over GPUs instead of splitting batches
+	if multi_gpu and (ensemble_parallel == "device") and isinstance(mymodel, Ensemble):
+		mymodel.distribute(cuda_devices)
+		multi_gpu = False
+	else:
+		mymodel.to(cuda_device, non_blocking=True)
+		if multi_gpu:
+			mymodel = DataParallelMT(mymodel, device_ids=cuda_devices, output_device=cuda_device.index, host_replicate=True, gather_output=False)
 
 mymodel = torch_compile(mymodel, *torch_compile_args, **torch_compile_kwargs)
 
@@ -9,6 +9,7 @@ data_id = "w14ed32"
 exp_dir = "expm/"
 cache_dir = "cache/"
 
+# train_data and dev_data can also be directories of the flat data format (tools/h5/flat.py)
 train_data = cache_dir + data_id + "/train.h5"
 dev_data = cache_dir + data_id + "/dev.h5"
 test_data = cache_dir + data_id + "/test.h5"
@@ -71,6 +72,8 @@ weight_decay = 0
 
 beam_size = 4
 length_penalty = 0.0
+# lexical shortlist built by `tools/shortlist.py` to restrict the target vocabulary to candidates of source tokens in decoding, which saves the computation of the classifier. None to decode with the full vocabulary.
+shortlist = None
 # use multi-gpu for translating or not. `predict.py` will take the last gpu rather than the first in case multi_gpu_decoding is set to False to avoid potential break due to out of memory, since the first gpu is the main device by default which takes more jobs.
 multi_gpu_decoding = False
 
@@ -22,12 +22,23 @@ disable_std_pemb = False
 
 # using fast implementation of label smoothing loss, but it cannot exclude the negative impact of special tokens, like <pad>, on training. `forbidden_indexes` in `cnfg/base.py` shall be set to None to enable.
 use_fast_loss = True
+# fuse the classifier with the label smoothing loss in training (`loss.base.FusedLabelSmoothingLoss`), the log-sum-exp over the vocabulary is computed in chunks of fused_loss_chunk_size classes and recomputed in the backward pass, so that the (batch size, seq len, vocab size) log-probabilities are never stored. Losses are the same as those of the label smoothing loss selected by use_fast_loss.
+fused_loss = False
+fused_loss_chunk_size = 4096
 
 # configure maximum batch size w.r.t GPU memory
 max_tokens_gpu = 6144
 max_sentences_gpu = max_tokens_gpu // 6
 max_pad_tokens_sentence = 32
 normal_tokens_vs_pad_tokens = 4
+# attention-cost-aware batch sizes: the cost of a batch is estimated as bsize * len * (1 + attn_cost_ratio * len) (FFN/classifier and attention), and batch sizes keep it equal to the cost of max_tokens_gpu tokens in sentences of attn_cost_ref_len tokens, so that batches of long sentences are smaller and those of short ones are larger. attn_cost_ratio can be fitted on the local machine with `tools/check/batch_cost.py`, None to count tokens linearly.
+attn_cost_ratio = None
+attn_cost_ref_len = 64
+# rebuild batches from the sentences of the training data at each epoch with the settings above (`utils/fmt/rebatch.py`) instead of shuffling the fixed batches built by `tools/mkiodata.py`, sentences of the same length are shuffled before batching. It requires the flat data format (`tools/h5/flat.py`).
+dynamic_rebatch = False
+# pack (source, target) pairs of each batch into rows of pack_seq_len tokens (at least) in training (`utils/fmt/pack.py`), pairs in a row are separated by block-diagonal attention masks, positions restart for each pair, and the loss ignores predictions across pair boundaries. It saves the computation on padding for batches of short sentences at the cost of longer (masked) attention, the padding ratio before and after packing is logged for each epoch.
+packed_training = False
+pack_seq_len = 64
 
 # For BPE (using full vocabulary), the special <unk> token will never appear and thus can be removed from the vocabulary. Otherwise, it should be set to True.
 use_unk = True
@@ -56,6 +67,42 @@ hdf5_load_parameter_name = hdf5_save_parameter_name = True
 # prune with length penalty in each beam decoding step
 clip_beam_with_lp = True
 
+# remove finished sentences from the batch during decoding (with `decode_clip` of decoders), which saves computation when lengths of translations in a batch vary a lot.
+decode_clip_finished = False
+
+# use preallocated key/value caches for incremental self-attention in decoding instead of growing them with torch.cat at each step.
+use_kv_cache = True
+
+# number of decoder layers used as the draft model in speculative greedy decoding, the draft proposes tokens which are verified by the full decoder in one forward pass, without changing translations. None to disable speculative decoding (unless a draft model is passed to `decode`).
+speculative_draft_layers = None
+# number of tokens proposed by the draft model for each verification in speculative decoding
+speculative_draft_steps = 4
+
+# quantize Linear layers (including the classifier) to int8 with dynamic quantization for inference on CPU (prediction scripts and the translation server), quantized models can be saved with `utils.io.save_model` and loaded with `utils.io.load_model_cpu`.
+quantize_cpu_inference = False
+# quantize weights per output channel (more accurate) rather than per tensor
+quant_per_channel = True
+
+# run the members of ensembles (`transformer/EnsembleNMT.py`) in decoding: None (one by one), "thread" (concurrently on a thread pool) or "device" (concurrently, distributed over the GPUs of multi-GPU decoding instead of splitting batches with `DataParallelMT`).
+ensemble_parallel = None
+# number of intra-op threads of each thread running an ensemble member on CPU ("thread" mode), None to keep the default
+ensemble_member_threads = None
+# compute the classifiers of ensemble members (with identical shapes on the same device) with one batched matrix multiplication, their weights are stacked into a single tensor.
+ensemble_stack_classifier = False
+
+# number of training batches read ahead in the background by `train.py` and the BART training scripts at the root of the repository (`utils/prefetch.py`), the time spent waiting for data and the average number of ready batches are logged after each epoch. Training scripts under `adv/train/` still read batches synchronously.
+prefetch_batches = 4
+# number of threads reading batches ahead
+prefetch_workers = 1
+
+# synchronize the device at each timing point of the training telemetry (`utils/train/telemetry.py`, logged and written to `telemetry.jsonl` in the working directory at each report and the end of epochs) of `train.py` and the BART training scripts at the root of the repository, training scripts under `adv/train/` do not collect telemetry. CUDA kernels run asynchronously, without synchronization, the time of the device is counted to the section which waits for it (e.g., the optimizer step or the data loading of the next batch), synchronizing gives an accurate breakdown at the cost of the overlap between host and device.
+telemetry_sync = False
+
+# multi-process training with torch.distributed (`parallel/dist.py`), enabled when training scripts are launched by torchrun with more than one process, each process trains on its shard of batches with a GPU (or CPU). dist_backend: None ("nccl" for GPUs and "gloo" for CPU), "nccl" or "gloo". Gradients are all-reduced in buckets of dist_bucket_cap_mb MB during the backward pass, set dist_find_unused_parameters if some parameters are not used in forward passes.
+dist_backend = None
+dist_bucket_cap_mb = 25
+dist_find_unused_parameters = False
+
 # optimize speed even if it sacrifices reproduction
 performance_over_reproduction = True
 
@@ -71,5 +71,8 @@ list_key_func = str
 # tqdm
 tqdm_mininterval = 1.0
 
+# initial capacity (number of decoding steps) of key/value caches, doubled when exceeded
+kv_cache_init_len = 64
+
 # optimizer step zero_grad
 optm_step_zero_grad_set_none = not contiguous_parameters
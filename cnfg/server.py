@@ -0,0 +1,25 @@
+#encoding: utf-8
+
+# sleep interval (seconds) of thread keepers
+thread_keeper_interval = 1.0
+
+# decode with the continuous (iteration-level) batching engine (`modules/server/engine.py`) in `TranslatorCore`, which admits new sentences into the decoding batch between decoding steps and evicts finished ones, instead of decoding batches one by one to completion.
+use_continuous_batching = False
+# maximum waiting time (seconds) of the idle decoding engine before checking for new sentences again
+engine_wait_interval = 0.05
+# minimum number of finished sentences to evict, or of free slots to admit waiting sentences (if there are more of them) at a time for the decoding engine, larger values reduce the copying of decoding states at the cost of computation on finished sentences
+engine_min_update = 8
+
+# maximum number of sequences in a batch of the request batcher (`utils/server/batcher.py`)
+batcher_max_sentences = 128
+# maximum number of (padded) tokens in a batch of the request batcher
+batcher_max_tokens = 6144
+# maximum waiting time (seconds) of the earliest request in the request batcher before its batch is handled, larger values lead to larger batches at the cost of latency
+batcher_max_wait = 0.01
+
+# maximum (estimated) memory consumption (bytes) of the translation memory cache (`utils/server/cache.py`) of `Translator`, which returns cached translations of source sentences directly, only cache misses are translated by `TranslatorCore`. Set it to 0 to disable the cache.
+tm_cache_size = 64 * 1024 * 1024
+# time-to-live (seconds) of cached translations, None for no expiration
+tm_cache_ttl = None
+# file for the persistence of the translation memory cache for warm restarts, None to disable it
+tm_cache_file = None
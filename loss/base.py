@@ -1,10 +1,13 @@
 #encoding: utf-8
 
 import torch
-from torch.nn.functional import cross_entropy, kl_div, nll_loss
+from math import log
+from torch.autograd import Function
+from torch.nn.functional import cross_entropy, kl_div, linear, nll_loss
 from torch.nn.modules.loss import CrossEntropyLoss as CrossEntropyLossBase, NLLLoss as NLLLossBase, _Loss
 
 from utils.base import clear_pad_mask, eq_indexes
+from utils.torch.comp import torch_is_autocast_enabled
 
 from cnfg.ihyp import *
 from cnfg.vocab.base import pad_id
@@ -119,6 +122,122 @@ class StdLabelSmoothingLoss(_Loss):
 
 LabelSmoothingLoss = FastLabelSmoothingLoss if use_fast_loss else StdLabelSmoothingLoss
 
+# the log-sum-exp of linear(input, weight, bias) over classes, computed in chunks of chunk_size classes in dtype (the autocast dtype), logits are never stored but recomputed chunk by chunk in the backward pass.
+class ChunkedLogSumExp(Function):
+
+	@staticmethod
+	def forward(ctx, input, weight, bias=None, chunk_size=fused_loss_chunk_size, dtype=None):
+
+		_dtype = input.dtype if dtype is None else dtype
+		_input, nclass, _rtype = input.to(_dtype), weight.size(0), torch.promote_types(_dtype, torch.float32)
+		rs = None
+		for _i in range(0, nclass, chunk_size):
+			_n = min(chunk_size, nclass - _i)
+			_s = linear(_input, weight.narrow(0, _i, _n).to(_dtype), None if bias is None else bias.narrow(0, _i, _n).to(_dtype)).to(_rtype).logsumexp(-1)
+			rs = _s if rs is None else torch.logaddexp(rs, _s)
+		ctx.save_for_backward(input, weight, bias, rs)
+		ctx.chunk_size, ctx.dtype = chunk_size, _dtype
+
+		return rs
+
+	@staticmethod
+	def backward(ctx, grad_output):
+
+		input, weight, bias, rs = ctx.saved_tensors
+		_dtype, chunk_size, nclass = ctx.dtype, ctx.chunk_size, weight.size(0)
+		_ig, _wg, _bg = ctx.needs_input_grad[:3]
+		_input = input.to(_dtype)
+		grad_input = input.new_zeros(input.size(), dtype=rs.dtype) if _ig else None
+		grad_weight = weight.new_empty(weight.size()) if _wg else None
+		grad_bias = bias.new_empty(bias.size()) if _bg else None
+		_rs, _g = rs.unsqueeze(-1), grad_output.unsqueeze(-1)
+		for _i in range(0, nclass, chunk_size):
+			_n = min(chunk_size, nclass - _i)
+			_w = weight.narrow(0, _i, _n).to(_dtype)
+			# gradients of logits: softmax probabilities scaled by grad_output
+			_p = linear(_input, _w, None if bias is None else bias.narrow(0, _i, _n).to(_dtype)).to(rs.dtype).sub_(_rs).exp_().mul_(_g)
+			if _ig:
+				grad_input.add_(_p.to(_dtype).mm(_w))
+			if _wg:
+				grad_weight.narrow(0, _i, _n).copy_(_p.t().to(_dtype).mm(_input))
+			if _bg:
+				grad_bias.narrow(0, _i, _n).copy_(_p.sum(0))
+
+		return None if grad_input is None else grad_input.to(input.dtype), grad_weight, grad_bias, None, None
+
+# the classifier fused with the label smoothing loss (LabelSmoothingLoss, Fast or Std according to use_fast_loss), which takes (hidden states, classifier weight, classifier bias) returned by decoders with word_prediction="fused" instead of log-probabilities. With q the smoothed target distribution of a token and x its logits, the loss is sum(q * log(q)) - sum(q * x) + sum(q) * logsumexp(x), where sum(q * x) is linear in hidden states and computed without logits, only the log-sum-exp is computed over the vocabulary by ChunkedLogSumExp. Log-probabilities (e.g., in evaluation) are handled by the label smoothing loss.
+class FusedLabelSmoothingLoss(_Loss):
+
+	def __init__(self, nclass, label_smoothing=0.1, ignore_index=-1, reduction="mean", forbidden_index=-1, chunk_size=fused_loss_chunk_size, **kwargs):
+
+		super(FusedLabelSmoothingLoss, self).__init__()
+		self.loss = LabelSmoothingLoss(nclass, label_smoothing=label_smoothing, ignore_index=ignore_index, reduction=reduction, forbidden_index=forbidden_index, **kwargs)
+		self.ignore_index, self.reduction, self.chunk_size, self.conf = self.loss.ignore_index, reduction, chunk_size, self.loss.conf
+		# self.replace: probabilities of targets are replaced by conf (StdLabelSmoothingLoss) instead of being added with conf (FastLabelSmoothingLoss), and the constant term sum(q * log(q)) of kl_div is kept.
+		self.replace = isinstance(self.loss, StdLabelSmoothingLoss)
+		if self.replace:
+			weight = self.loss.weight.view(-1)
+			_sv = weight.max().item()
+			self.log_conf, self.log_sv = (self.conf * log(self.conf)) if self.conf > 0.0 else 0.0, log(_sv) if _sv > 0.0 else 0.0
+		else:
+			weight = torch.full((nclass,), self.loss.smoothing_value)
+		self.register_buffer("weight", weight, persistent=False)
+		self.wsum = weight.sum().item()
+
+	# input: (hidden states, classifier weight, classifier bias) and target, or they are passed as separate arguments (by DataParallelCriterion).
+	# losses of tokens (in the shape of target) are returned if reduction is "none".
+	def forward(self, input, *inputs, mask=None, **kwargs):
+
+		if isinstance(input, (list, tuple,)):
+			inputs = (*input, *inputs)
+		elif len(inputs) == 1:
+			return self.loss(input, *inputs, mask=mask, **kwargs)
+		else:
+			inputs = (input, *inputs)
+		input, weight, bias, target = inputs
+
+		isize = input.size(-1)
+		_input, _target = input.view(-1, isize), target.view(-1)
+		_pad_mask = mask
+		if _pad_mask is None:
+			if isinstance(self.ignore_index, (list, tuple,)):
+				_pad_mask = eq_indexes(_target, self.ignore_index)
+			elif self.ignore_index >= 0:
+				_pad_mask = _target.eq(self.ignore_index)
+		else:
+			_pad_mask = _pad_mask.view(-1)
+		_reduce = self.reduction != "none"
+		# only non-padding tokens are computed for reduced losses
+		if _reduce and (_pad_mask is not None):
+			_keep = ~_pad_mask
+			_input, _target, _pad_mask = _input[_keep], _target[_keep], None
+
+		_w = self.weight
+		_tw = _w.index_select(0, _target)
+		_tconf = (self.conf - _tw) if self.replace else _tw.new_full(_tw.size(), self.conf)
+		_ftype = _w.dtype
+		_finput = _input.to(_ftype)
+		# sum(w * x) = input * (w * W) + w * b, forbidden indexes (with 0 weight) are excluded from the bias which may be -inf.
+		_wx = _finput.mv(_w.matmul(weight.to(_ftype)))
+		_gx = _finput.mul(weight.index_select(0, _target).to(_ftype)).sum(-1)
+		if bias is not None:
+			_fbias = bias.to(_ftype)
+			_wx = _wx + _fbias.masked_fill(_w.eq(0.0), 0.0).dot(_w)
+			_gx = _gx + _fbias.index_select(0, _target)
+		_lse = ChunkedLogSumExp.apply(_input, weight, bias, self.chunk_size, torch.float16 if torch_is_autocast_enabled() and _input.is_cuda else None)
+		rs = (_tconf + self.wsum) * _lse - _tconf * _gx - _wx
+		if self.replace:
+			rs = rs + (self.log_conf + (self.wsum - _tw) * self.log_sv)
+		if _pad_mask is not None:
+			rs = rs.masked_fill(_pad_mask, 0.0)
+		if _reduce:
+			rs = rs.sum()
+			if self.reduction == "mean":
+				# kl_div of StdLabelSmoothingLoss averages over all classes
+				rs = rs / float(target.numel() * (self.weight.numel() if self.replace else 1))
+
+		return rs.view(target.size()) if not _reduce else rs
+
 class NLLLoss(NLLLossBase):
 
 	def forward(self, input, target, **kwargs):
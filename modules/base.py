@@ -10,6 +10,7 @@ from modules.act import Custom_Act, LGLU, get_act, reduce_model as reduce_model_
 from modules.dropout import Dropout, reduce_model as reduce_model_drop
 from utils.base import reduce_model_list
 from utils.decode.beam import repeat_bsize_for_beam_tensor
+from utils.decode.cache import KVCache
 from utils.fmt.parser import parse_none
 from utils.relpos.bucket import build_rel_pos_bucket, build_rel_pos_bucket_map
 from utils.torch.comp import torch_no_grad
@@ -142,11 +143,15 @@ class PositionalEmb(nn.Module):
 		self.reset_parameters()
 
 	# x: input (bsize, seql)
+	# pos: positions of x (bsize, seql) instead of 0, 1, ..., seql - 1 (e.g., positions restart for each sentence packed in x), which shall be smaller than seql
 
-	def forward(self, x, expand=True, **kwargs):
+	def forward(self, x, expand=True, pos=None, **kwargs):
 
 		bsize, seql = x.size()
 
+		if pos is not None:
+			return (self.w if seql <= self.num_pos else torch.cat((self.w, self.get_ext(seql, False)), 0))[pos]
+
 		rs = self.w[:seql].unsqueeze(0) if seql <= self.num_pos else torch.cat((self.w, self.get_ext(seql, False)), 0).unsqueeze(0)
 
 		return rs.expand(bsize, seql, self.num_dim) if expand else rs
@@ -186,6 +191,22 @@ class PositionalEmb(nn.Module):
 
 		return self.w[step] if step < self.num_pos else self.get_ext(step, True).squeeze(0)
 
+	# length steps of weight to retrieve from step start
+
+	def get_range(self, start, length):
+
+		_end = start + length
+
+		return self.w.narrow(0, start, length) if _end <= self.num_pos else torch.cat((self.w, self.get_ext(_end, False)), 0).narrow(0, start, length)
+
+	# weight of steps pos (a tensor), max_pos: an upper bound (exclusive) of pos, which saves the synchronization of computing it
+
+	def get_steps(self, pos, max_pos=None):
+
+		_end = (pos.max().item() + 1) if max_pos is None else max_pos
+
+		return (self.w if _end <= self.num_pos else torch.cat((self.w, self.get_ext(_end, False)), 0))[pos]
+
 class MultiHeadAttn(nn.Module):
 
 	# isize: input dimension
@@ -299,10 +320,16 @@ class MultiHeadAttn(nn.Module):
 				self.iV, self.real_iV = iV, real_iV
 
 		if states is not None:
-			_h_real_iK, _h_real_iV = states
-			if _h_real_iK is not None:
-				seql += _h_real_iK.size(-1)
-				real_iK, real_iV = torch.cat((_h_real_iK, real_iK,), dim=-1), torch.cat((_h_real_iV, real_iV,), dim=2)
+			if use_kv_cache and isinstance(states, tuple) and (states[0] is None):
+				states = KVCache()
+			if isinstance(states, KVCache):
+				real_iK, real_iV = states.update(real_iK, real_iV)
+				seql = real_iK.size(-1)
+			else:
+				_h_real_iK, _h_real_iV = states
+				if _h_real_iK is not None:
+					seql += _h_real_iK.size(-1)
+					real_iK, real_iV = torch.cat((_h_real_iK, real_iK,), dim=-1), torch.cat((_h_real_iV, real_iV,), dim=2)
 
 		# scores (bsize, nheads, nquery, adim) * (bsize, nheads, adim, seql) => (bsize, nheads, nquery, seql)
 
@@ -329,7 +356,7 @@ class MultiHeadAttn(nn.Module):
 		if states is None:
 			return out
 		else:
-			return out, (real_iK, real_iV,)
+			return out, states if isinstance(states, KVCache) else (real_iK, real_iV,)
 
 	def train(self, mode=True):
 
@@ -500,12 +527,18 @@ class SelfAttn(nn.Module):
 		real_iQ, real_iK, real_iV = real_iQ.transpose(1, 2), real_iK.permute(0, 2, 3, 1), real_iV.transpose(1, 2)
 
 		if states is not None:
-			_h_real_iK, _h_real_iV = states
-			if _h_real_iK is None:
-				seql = nquery
+			if use_kv_cache and isinstance(states, tuple) and (states[0] is None):
+				states = KVCache()
+			if isinstance(states, KVCache):
+				real_iK, real_iV = states.update(real_iK, real_iV)
+				seql = real_iK.size(-1)
 			else:
-				seql = nquery + _h_real_iK.size(-1)
-				real_iK, real_iV = torch.cat((_h_real_iK, real_iK,), dim=-1), torch.cat((_h_real_iV, real_iV,), dim=2)
+				_h_real_iK, _h_real_iV = states
+				if _h_real_iK is None:
+					seql = nquery
+				else:
+					seql = nquery + _h_real_iK.size(-1)
+					real_iK, real_iV = torch.cat((_h_real_iK, real_iK,), dim=-1), torch.cat((_h_real_iV, real_iV,), dim=2)
 
 		scores = real_iQ.matmul(real_iK)
 
@@ -532,7 +565,7 @@ class SelfAttn(nn.Module):
 		if states is None:
 			return out
 		else:
-			return out, (real_iK, real_iV,)
+			return out, states if isinstance(states, KVCache) else (real_iK, real_iV,)
 
 	def get_rel_pos(self, length):
 
@@ -8,6 +8,7 @@ from modules.act import Custom_Act, GEGLU, LGLU, get_act
 from modules.base import CrossAttn as CrossAttnBase, Linear, PositionwiseFF as PositionwiseFFBase, ResCrossAttn as ResCrossAttnBase, ResSelfAttn as ResSelfAttnBase, SelfAttn as SelfAttnBase
 from modules.dropout import Dropout
 from modules.norm import RMSNorm as Norm
+from utils.decode.cache import KVCache
 from utils.fmt.parser import parse_none
 from utils.relpos.bucket import build_rel_pos_bucket, build_rel_pos_bucket_map
 
@@ -32,12 +33,18 @@ class SelfAttn(SelfAttnBase):
 		real_iQ, real_iK, real_iV = real_iQ.transpose(1, 2), real_iK.permute(0, 2, 3, 1), real_iV.transpose(1, 2)
 
 		if states is not None:
-			_h_real_iK, _h_real_iV = states
-			if _h_real_iK is None:
-				seql = nquery
+			if use_kv_cache and isinstance(states, tuple) and (states[0] is None):
+				states = KVCache()
+			if isinstance(states, KVCache):
+				real_iK, real_iV = states.update(real_iK, real_iV)
+				seql = real_iK.size(-1)
 			else:
-				seql = nquery + _h_real_iK.size(-1)
-				real_iK, real_iV = torch.cat((_h_real_iK, real_iK,), dim=-1), torch.cat((_h_real_iV, real_iV,), dim=2)
+				_h_real_iK, _h_real_iV = states
+				if _h_real_iK is None:
+					seql = nquery
+				else:
+					seql = nquery + _h_real_iK.size(-1)
+					real_iK, real_iV = torch.cat((_h_real_iK, real_iK,), dim=-1), torch.cat((_h_real_iV, real_iV,), dim=2)
 
 		scores = real_iQ.matmul(real_iK)
 
@@ -68,7 +75,7 @@ class SelfAttn(SelfAttnBase):
 		if states is None:
 			return out
 		else:
-			return out, (real_iK, real_iV,)
+			return out, states if isinstance(states, KVCache) else (real_iK, real_iV,)
 
 class CrossAttn(CrossAttnBase):
 
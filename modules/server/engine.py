@@ -0,0 +1,432 @@
+#encoding: utf-8
+
+import torch
+from collections import deque
+from threading import Condition
+
+from modules.base import CrossAttn
+from utils.base import index_tensors
+from utils.decode.beam import beam_step, expand_bsize_for_beam
+from utils.decode.cache import KVCache
+from utils.thread import start_thread_with_keeper
+from utils.torch.comp import torch_autocast, torch_inference_mode
+
+from cnfg.ihyp import *
+from cnfg.server import engine_min_update as min_update, engine_wait_interval as wait_interval, thread_keeper_interval
+from cnfg.vocab.base import eos_id, pad_id
+
+def pad_dim(x, dim, length, value=0):
+
+	_size = list(x.size())
+	_dlen = _size[dim]
+	if _dlen >= length:
+		return x
+	_size[dim] = length
+	rs = x.new_full(_size, value)
+	rs.narrow(dim, 0, _dlen).copy_(x)
+
+	return rs
+
+class Task:
+
+	# callback: called (by the decoding thread, under the condition of the engine) with the index of a sentence, its translation so far and whether it is finished, each time the translation of a sentence of the task is extended (see Engine.report) and when it is finished
+
+	def __init__(self, nsent, callback=None):
+
+		self.rs = [None for _ in range(nsent)]
+		self.nleft = nsent
+		self.callback = callback
+		# nout: lengths of translations reported to callback
+		self.nout = None if callback is None else [0 for _ in range(nsent)]
+		# sentences of cancelled tasks are dropped from the pending queue, and stopped in the decoding batch
+		self.cancelled = False
+
+# continuous (iteration-level) batching decoding engine for encoder-decoder models (e.g., `transformer.NMT.NMT` and BART) whose decoders support incremental decoding (`transformer.Decoder.Decoder.inc_forward`) with `utils.decode.cache.KVCache` states: new sentences are encoded and admitted into free slots of the decoding batch between decoding steps, and results of finished sentences are returned immediately. The incremental self-attention states (`utils.decode.cache.KVCache`) of sentences admitted at different steps are aligned to the right, and cached steps before the start of each sentence are masked out in self attention.
+class Engine:
+
+	# model: the model to decode with (in evaluation mode)
+	# beam_size, length_penalty, clip_beam: settings of beam search, see `transformer.Decoder.Decoder.beam_decode`
+	# bsize: maximum number of sentences in the decoding batch
+	# maxtoken: maximum number of (padded) source tokens in the decoding batch
+	# device: the device to decode on, inputs are moved to it
+	# min_update: minimum number of finished sentences to evict, or of free slots to admit waiting sentences (if there are more of them) at a time, which reduces the copying of decoding states at the cost of computation on finished sentences
+	# start: start the background decoding thread, otherwise decoding steps are run by callers of __call__
+
+	def __init__(self, model, beam_size=1, length_penalty=0.0, bsize=max_sentences_gpu, maxtoken=max_tokens_gpu, device=None, use_amp=False, clip_beam=clip_beam_with_lp, min_update=min_update, wait_interval=wait_interval, start=True, **kwargs):
+
+		self.enc, self.dec = model.enc, model.dec
+		self.cross_attns = tuple(_m for _m in self.dec.modules() if isinstance(_m, CrossAttn))
+		self.beam_size, self.length_penalty, self.clip_beam = beam_size, length_penalty, clip_beam
+		self.bsize, self.maxtoken, self.min_update = bsize, maxtoken, max(1, min(min_update, bsize))
+		self.device, self.use_amp, self.wait_interval = device, use_amp, wait_interval
+		# max_pos: an upper bound of decoding steps (the maximum decoding length of admitted sentences), see `transformer.Decoder.Decoder.get_inc_emb`
+		self.max_pos = 1
+		if length_penalty > 0.0:
+			self.lpv_base = 6.0 ** length_penalty
+
+		self.pending = deque()
+		self.cond = Condition()
+		self.reset()
+		self.running = start
+		if start:
+			self.t_process = start_thread_with_keeper([self.is_running], None, thread_keeper_interval, target=self.processor)
+
+	# sentences: list of mapped source sentences (lists of indexes with <sos> and <eos>)
+	# return: list of translations (lists of indexes), which can be processed in the same way as rows of the output of `NMT.decode`
+
+	def __call__(self, sentences, **kwargs):
+
+		_task = Task(len(sentences))
+		if _task.nleft > 0:
+			with self.cond:
+				self.pending.extend((_task, _i, _s,) for _i, _s in enumerate(sentences))
+				self.cond.notify_all()
+				if self.running:
+					while _task.nleft > 0:
+						self.cond.wait()
+			if not self.running:
+				with torch_inference_mode(), torch_autocast(enabled=self.use_amp):
+					while _task.nleft > 0:
+						self.step()
+
+		return _task.rs
+
+	# streaming decoding, yields lists of (index of sentence, translation so far, whether it is finished) for sentences whose translations are extended, which are reported through the callback of the task. Stopping the iteration cancels the remaining sentences.
+
+	def stream(self, sentences, **kwargs):
+
+		_upd = []
+		_task = Task(len(sentences), callback=lambda *args: _upd.append(args))
+		if _task.nleft > 0:
+			with self.cond:
+				self.pending.extend((_task, _i, _s,) for _i, _s in enumerate(sentences))
+				self.cond.notify_all()
+			try:
+				while (_task.nleft > 0) or _upd:
+					if self.running:
+						with self.cond:
+							while (not _upd) and (_task.nleft > 0):
+								self.cond.wait()
+					elif not _upd:
+						with torch_inference_mode(), torch_autocast(enabled=self.use_amp):
+							self.step()
+					with self.cond:
+						rs = _upd[:]
+						_upd.clear()
+					if rs:
+						yield rs
+			finally:
+				_task.cancelled = True
+
+	def processor(self):
+
+		with torch_inference_mode(), torch_autocast(enabled=self.use_amp):
+			while self.running:
+				if (self.nsent == 0) and (not self.pending):
+					with self.cond:
+						if not self.pending:
+							self.cond.wait(self.wait_interval)
+				else:
+					self.step()
+
+	# one iteration: a decoding step of the ongoing sentences, collection of finished sentences, admission (encoding and the first decoding step) of new sentences, and the update of the decoding batch which evicts finished sentences and merges new ones in a single pass.
+
+	def step(self):
+
+		_nfin = 0
+		if self.nsent > 0:
+			self.decode_step()
+			_nfin = self.collect()
+			self.report()
+		_nsent = self.nsent - _nfin
+		_new = self.admit(_nsent) if self.pending and ((self.bsize - _nsent) >= min(len(self.pending), self.min_update)) else None
+		if (_new is not None) or (_nfin >= self.min_update) or ((_nfin > 0) and (_nfin == self.nsent)):
+			self.update((~self.sent_done).nonzero().squeeze(1) if _nfin > 0 else None, _new)
+
+	def reset(self):
+
+		self.nsent = self.nfin = 0
+		self.slots = []
+		self.inpute = self.src_pad_mask = self.states = self.sind = self.mlen = self.slen = self.wds = self.trans = self.done = self.sent_done = self.reported = self.scores = self.sum_scores = self.lpv = None
+		for _m in self.cross_attns:
+			_m.reset_buffer()
+
+	def set_cross_attn_buffer(self, bufs=None):
+
+		if bufs is None:
+			for _m in self.cross_attns:
+				_m.iK = self.inpute
+		else:
+			for _m, (_real_iK, _real_iV,) in zip(self.cross_attns, bufs):
+				_m.iK, _m.real_iK, _m.real_iV = self.inpute, _real_iK, _real_iV
+
+	def decode_step(self):
+
+		_dec = self.dec
+		nsent, beam_size = self.nsent, self.beam_size
+		_len = self.trans.size(1)
+		# pos: decoding step of each sentence (real_bsize), finished sentences which are not evicted yet are clamped to max_pos
+		pos = self.sind.neg().add_(_len)
+
+		# _mask: hide cached steps before the start of each sentence (real_bsize, 1, _len + 1)
+		_mask = torch.arange(_len + 1, dtype=pos.dtype, device=pos.device).unsqueeze(0).lt(self.sind.unsqueeze(1)).unsqueeze(1)
+
+		out = _dec.inc_forward(self.inpute, _dec.get_inc_emb(pos.clamp(max=self.max_pos - 1), self.wds, max_pos=self.max_pos), self.states, self.src_pad_mask, _mask)
+
+		_ntok = pos + 1
+		if beam_size > 1:
+			length_penalty = self.length_penalty
+			self.scores, self.sum_scores, wds, _inds, done, self.lpv = beam_step(_dec.lsm(out).view(nsent, beam_size, -1), self.sum_scores, self.done.view(nsent, beam_size), self.lpv, ((pos.unsqueeze(1).to(torch.double) + 6.0) ** length_penalty / self.lpv_base).to(self.lpv.dtype) if length_penalty > 0.0 else None, self.clip_beam)
+			self.done = done.view(-1)
+			self.trans = torch.cat((self.trans.index_select(0, _inds), wds,), 1)
+			self.states = index_tensors(self.states, indices=_inds, dim=0)
+
+			self.sent_done = self.sent_done | self.is_done(self.done, _ntok.view(nsent, beam_size).select(1, 0), self.mlen)
+		else:
+			wds = out.argmax(dim=-1)
+			self.trans = torch.cat((self.trans, wds,), 1)
+			self.done = self.sent_done = self.sent_done | self.is_done(wds.squeeze(1).eq(eos_id), _ntok, self.mlen)
+		self.wds = wds
+
+	# done: whether each beam (or sentence in greedy decoding) is finished (bsize * beam_size)
+	# ntok: number of decoded tokens (bsize)
+	# mlen: maximum decoding length (bsize)
+
+	def is_done(self, done, ntok, mlen):
+
+		if self.beam_size > 1:
+			done = done.view(-1, self.beam_size)
+			done = done.all(1) if self.length_penalty > 0.0 else done.select(1, 0)
+
+		return done | ntok.ge(mlen)
+
+	# return the best translation (from the start of each sentence) of sentences (indexes _sind in the decoding batch) with trans, sind, scores and lpv
+
+	def get_rs(self, _sind, trans, sind, scores=None, lpv=None):
+
+		beam_size = self.beam_size
+		if beam_size > 1:
+			if (not self.clip_beam) and (self.length_penalty > 0.0):
+				_nsel = _sind.size(0)
+				_rind = (_sind.unsqueeze(1) * beam_size + torch.arange(0, beam_size, dtype=_sind.dtype, device=_sind.device)).view(-1)
+				_rind = _sind * beam_size + (scores.index_select(0, _sind) / lpv.index_select(0, _rind).view(_nsel, beam_size)).argmax(-1)
+			else:
+				_rind = _sind * beam_size
+		else:
+			_rind = _sind
+
+		return [_tran[_sid:] for _tran, _sid in zip(trans.index_select(0, _rind).tolist(), sind.index_select(0, _rind).tolist())]
+
+	def put_rs(self, slots, rs):
+
+		with self.cond:
+			for (_task, _ind,), _tran in zip(slots, rs):
+				_task.rs[_ind] = _tran
+				_task.nleft -= 1
+				if _task.callback is not None:
+					_task.callback(_ind, _tran, True)
+			self.cond.notify_all()
+
+	def put_upd(self, slots, rs):
+
+		with self.cond:
+			for (_task, _ind,), _tran in zip(slots, rs):
+				if len(_tran) > _task.nout[_ind]:
+					_task.nout[_ind] = len(_tran)
+					_task.callback(_ind, _tran, False)
+			self.cond.notify_all()
+
+	# report extended translations of unfinished sentences of streaming tasks (with callbacks): all decoded tokens in greedy decoding, and the common prefix of all beams in beam search which can no longer change, like `transformer.Decoder.Decoder.decode_stream`. Translations of finished sentences are reported by self.put_rs.
+
+	def report(self):
+
+		_sind = [_iu for _iu, (_task, _,) in enumerate(self.slots) if _task.callback is not None]
+		if _sind:
+			_sind = torch.as_tensor(_sind, dtype=torch.long, device=self.sent_done.device)
+			_sind = _sind.index_select(0, (~self.sent_done.index_select(0, _sind)).nonzero().squeeze(1))
+			if _sind.size(0) > 0:
+				beam_size = self.beam_size
+				if beam_size > 1:
+					_trans = self.trans.view(self.nsent, beam_size, -1).index_select(0, _sind)
+					_best = _trans.select(1, 0)
+					# _plen: lengths of common prefixes of all beams (before <eos>)
+					_plen = (_trans.eq(_best.unsqueeze(1)).all(1) & _best.ne(eos_id)).long().cumprod(1).sum(1).tolist()
+					_rind = _sind * beam_size
+				else:
+					_best = self.trans.index_select(0, _sind)
+					_plen = [None for _ in range(_sind.size(0))]
+					_rind = _sind
+				self.put_upd([self.slots[_iu] for _iu in _sind.tolist()], [_tran[_sid:_l] for _tran, _sid, _l in zip(_best.tolist(), self.sind.index_select(0, _rind).tolist(), _plen)])
+
+	# return results of newly finished sentences, which stay in the decoding batch until evicted by self.update, return the number of finished sentences in the decoding batch.
+
+	def collect(self):
+
+		# sentences of cancelled tasks are taken as finished
+		if any(_task.cancelled for _task, _ in self.slots):
+			self.sent_done = self.sent_done | torch.as_tensor([_task.cancelled for _task, _ in self.slots], dtype=torch.bool, device=self.sent_done.device)
+			if self.beam_size == 1:
+				self.done = self.sent_done
+		_sent_done = self.sent_done
+		_ndone = _sent_done.int().sum().item()
+		if _ndone > self.nfin:
+			_dind = (_sent_done if self.reported is None else (_sent_done & ~self.reported)).nonzero().squeeze(1)
+			self.put_rs([self.slots[_iu] for _iu in _dind.tolist()], self.get_rs(_dind, self.trans, self.sind, self.scores, self.lpv))
+			self.reported, self.nfin = _sent_done, _ndone
+
+		return _ndone
+
+	# take new sentences under the limits of the number of sentences and source tokens, encode them and run their first decoding step, return the batch of new sentences (None if no sentence is admitted or all of them are finished at the first step). Buffers of cross attention for the current decoding batch are kept in the returned batch.
+	# nsent: number of sentences remaining in the decoding batch
+
+	def admit(self, nsent):
+
+		_seql = 0 if nsent == 0 else self.slen.max().item()
+		_new = []
+		with self.cond:
+			while self.pending and (nsent < self.bsize):
+				if self.pending[0][0].cancelled:
+					self.pending.popleft()
+					continue
+				_l = max(_seql, len(self.pending[0][-1]))
+				if (_new or (nsent > 0)) and ((nsent + 1) * _l > self.maxtoken):
+					break
+				_new.append(self.pending.popleft())
+				nsent += 1
+				_seql = _l
+		if not _new:
+			return None
+
+		_dec = self.dec
+		beam_size = self.beam_size
+		bsize = len(_new)
+		real_bsize = bsize * beam_size
+		_nlen = max(len(_[-1]) for _ in _new)
+		seq_batch = torch.as_tensor([_[-1] + [pad_id for _ in range(_nlen - len(_[-1]))] for _ in _new], dtype=torch.long, device=self.device)
+		src_pad_mask = seq_batch.eq(pad_id).unsqueeze(1)
+		slen = _nlen - src_pad_mask.squeeze(1).int().sum(-1)
+		mlen = slen + (slen // 4).clamp(min=64)
+		self.max_pos = max(self.max_pos, mlen.max().item())
+
+		inpute = self.enc(seq_batch, src_pad_mask)
+
+		_bufs = [(_m.real_iK, _m.real_iV,) for _m in self.cross_attns] if self.nsent > 0 else None
+
+		states = {_tmp: KVCache() for _tmp in range(len(_dec.nets))}
+		out = _dec.inc_forward(inpute, _dec.get_inc_emb(0, emb=_dec.get_sos_emb(inpute)), states, src_pad_mask)
+
+		_ntok = slen.new_ones(bsize)
+		if beam_size > 1:
+			scores, wds = _dec.lsm(out).topk(beam_size, dim=-1)
+			scores = scores.squeeze(1)
+			wds = wds.view(real_bsize, 1)
+			done = wds.squeeze(1).eq(eos_id)
+			sent_done = self.is_done(done, _ntok, mlen)
+			_dec.repeat_cross_attn_buffer(beam_size)
+			src_pad_mask = src_pad_mask.repeat(1, beam_size, 1).view(real_bsize, 1, _nlen)
+			states = expand_bsize_for_beam(states, beam_size=beam_size)
+			lpv = scores.new_ones(real_bsize, 1) if self.length_penalty > 0.0 else None
+		else:
+			wds = out.argmax(dim=-1)
+			done = sent_done = self.is_done(wds.squeeze(1).eq(eos_id), _ntok, mlen)
+			scores = lpv = None
+		sind = wds.new_zeros(real_bsize)
+
+		rs = {"slots": [(_task, _ind,) for _task, _ind, _ in _new], "inpute": inpute, "src_pad_mask": src_pad_mask, "states": states, "bufs": [(_m.real_iK, _m.real_iV,) for _m in self.cross_attns], "cbufs": _bufs, "slen": slen, "mlen": mlen, "wds": wds, "trans": wds, "done": done, "sent_done": sent_done, "sind": sind, "scores": scores, "sum_scores": scores, "lpv": lpv}
+
+		# sentences finished at the first step are not merged into the decoding batch
+		_ndone = sent_done.int().sum().item()
+		if _ndone > 0:
+			_dind = sent_done.nonzero().squeeze(1)
+			self.put_rs([rs["slots"][_iu] for _iu in _dind.tolist()], self.get_rs(_dind, wds, sind, scores, lpv))
+			if _ndone == bsize:
+				if _bufs is not None:
+					self.set_cross_attn_buffer(_bufs)
+				return None
+			_ndid = (~sent_done).nonzero().squeeze(1)
+			_rind = (_ndid.unsqueeze(1) * beam_size + torch.arange(0, beam_size, dtype=_ndid.dtype, device=_ndid.device)).view(-1) if beam_size > 1 else _ndid
+			rs["slots"] = [rs["slots"][_iu] for _iu in _ndid.tolist()]
+			rs["states"] = index_tensors(states, indices=_rind, dim=0)
+			rs["bufs"] = [(_real_iK.index_select(0, _rind), _real_iV.index_select(0, _rind),) for _real_iK, _real_iV in rs["bufs"]]
+			for _k in ("inpute", "slen", "mlen", "sent_done", "scores", "sum_scores",):
+				if rs[_k] is not None:
+					rs[_k] = rs[_k].index_select(0, _ndid)
+			for _k in ("src_pad_mask", "wds", "trans", "done", "sind", "lpv",):
+				if rs[_k] is not None:
+					rs[_k] = rs[_k].index_select(0, _rind)
+
+		return rs
+
+	# evict finished sentences (keep sentences with indexes ndid, or all sentences if None), and merge new sentences (the batch returned by self.admit, optional) into the decoding batch. Cached steps masked for all sentences are dropped, and new sentences start from the last cached step.
+
+	def update(self, ndid=None, new=None):
+
+		beam_size = self.beam_size
+		if (ndid is not None) and (ndid.size(0) == 0):
+			self.reset()
+			ndid = None
+		if self.nsent == 0:
+			if new is not None:
+				for _k in ("slots", "inpute", "src_pad_mask", "states", "slen", "mlen", "wds", "trans", "done", "sent_done", "sind", "scores", "sum_scores", "lpv",):
+					setattr(self, _k, new[_k])
+				self.nsent = len(self.slots)
+				self.set_cross_attn_buffer(new["bufs"])
+			return
+
+		_bufs = [(_m.real_iK, _m.real_iV,) for _m in self.cross_attns] if new is None else new["cbufs"]
+		if ndid is None:
+			_rind = None
+		else:
+			_rind = (ndid.unsqueeze(1) * beam_size + torch.arange(0, beam_size, dtype=ndid.dtype, device=ndid.device)).view(-1) if beam_size > 1 else ndid
+			self.slots = [self.slots[_iu] for _iu in ndid.tolist()]
+			self.inpute, self.slen, self.mlen, self.sent_done = self.inpute.index_select(0, ndid), self.slen.index_select(0, ndid), self.mlen.index_select(0, ndid), self.sent_done.index_select(0, ndid)
+			self.src_pad_mask, self.sind, self.wds, self.trans, self.done = self.src_pad_mask.index_select(0, _rind), self.sind.index_select(0, _rind), self.wds.index_select(0, _rind), self.trans.index_select(0, _rind), self.done.index_select(0, _rind)
+			if beam_size > 1:
+				self.scores, self.sum_scores = self.scores.index_select(0, ndid), self.sum_scores.index_select(0, ndid)
+				if self.length_penalty > 0.0:
+					self.lpv = self.lpv.index_select(0, _rind)
+			_bufs = [(_real_iK.index_select(0, _rind), _real_iV.index_select(0, _rind),) for _real_iK, _real_iV in _bufs]
+
+		# drop cached steps which are masked for all remaining sentences
+		_nstep = self.sind.min().item()
+		if _nstep > 0:
+			self.trans = self.trans.narrow(1, _nstep, self.trans.size(1) - _nstep)
+			self.sind = self.sind - _nstep
+		if (_rind is not None) or (_nstep > 0) or (new is not None):
+			_new_states = None if new is None else new["states"]
+			for _tmp, _state in self.states.items():
+				_state.merge(indices=_rind, start=_nstep, other=None if _new_states is None else _new_states[_tmp])
+
+		# fit the padded source length to the longest sentence in the batch
+		_seql = self.slen.max().item() if new is None else max(self.slen.max().item(), new["inpute"].size(1))
+		if _seql < self.inpute.size(1):
+			self.inpute, self.src_pad_mask = self.inpute.narrow(1, 0, _seql), self.src_pad_mask.narrow(-1, 0, _seql)
+			_bufs = [(_real_iK.narrow(-1, 0, _seql), _real_iV.narrow(2, 0, _seql),) for _real_iK, _real_iV in _bufs]
+
+		if new is not None:
+			_len = self.trans.size(1)
+			_real_bsize = new["wds"].size(0)
+			self.slots.extend(new["slots"])
+			self.inpute = torch.cat((pad_dim(self.inpute, 1, _seql), pad_dim(new["inpute"], 1, _seql),), 0)
+			self.src_pad_mask = torch.cat((pad_dim(self.src_pad_mask, -1, _seql, True), pad_dim(new["src_pad_mask"], -1, _seql, True),), 0)
+			_bufs = [(torch.cat((pad_dim(_real_iK, -1, _seql), pad_dim(_new_real_iK, -1, _seql),), 0), torch.cat((pad_dim(_real_iV, 2, _seql), pad_dim(_new_real_iV, 2, _seql),), 0),) for (_real_iK, _real_iV,), (_new_real_iK, _new_real_iV,) in zip(_bufs, new["bufs"])]
+			self.slen, self.mlen, self.sent_done = torch.cat((self.slen, new["slen"],), 0), torch.cat((self.mlen, new["mlen"],), 0), torch.cat((self.sent_done, new["sent_done"],), 0)
+			self.wds, self.done = torch.cat((self.wds, new["wds"],), 0), torch.cat((self.done, new["done"],), 0)
+			self.trans = torch.cat((self.trans, torch.cat((new["wds"].new_full((_real_bsize, _len - 1), pad_id), new["wds"],), 1),), 0)
+			self.sind = torch.cat((self.sind, self.sind.new_full((_real_bsize,), _len - 1),), 0)
+			if beam_size > 1:
+				self.scores, self.sum_scores = torch.cat((self.scores, new["scores"],), 0), torch.cat((self.sum_scores, new["sum_scores"],), 0)
+				if self.length_penalty > 0.0:
+					self.lpv = torch.cat((self.lpv, new["lpv"],), 0)
+		self.nsent = len(self.slots)
+		self.nfin = 0
+		self.reported = None
+		self.set_cross_attn_buffer(_bufs)
+
+	def status(self, mode):
+
+		self.running = mode
+
+	def is_running(self):
+
+		return self.running
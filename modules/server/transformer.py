@@ -2,22 +2,30 @@
 
 import torch
 
+from modules.server.engine import Engine
 from parallel.parallelMT import DataParallelMT
 from transformer.EnsembleNMT import NMT as Ensemble
 from transformer.NMT import NMT
-from utils.fmt.base import clean_str, dict_insert_set, iter_dict_sort
+from utils.fmt.base import clean_list, clean_str, dict_insert_set, iter_dict_sort
 from utils.fmt.base4torch import parse_cuda_decode
 from utils.fmt.single import batch_padder
-from utils.fmt.vocab.base import reverse_dict
+from utils.fmt.vocab.base import map_instance, reverse_dict
 from utils.fmt.vocab.token import ldvocab
 from utils.io import load_model_cpu
 from utils.torch.comp import torch_autocast, torch_compile, torch_inference_mode
+from utils.torch.quant import quantize_model
 
 from cnfg.ihyp import *
+from cnfg.server import use_continuous_batching
 from cnfg.vocab.base import eos_id
 
+# read tokenized sentences from memory instead of files for batch_padder
+def sentence_reader(sentences_iter, keep_empty_line=True, **kwargs):
+	for _ in sentences_iter:
+		yield _.split()
+
 def data_loader(sentences_iter, vcbi, minbsize=1, bsize=max_sentences_gpu, maxpad=max_pad_tokens_sentence, maxpart=normal_tokens_vs_pad_tokens, maxtoken=max_tokens_gpu):
-	for i_d in batch_padder(sentences_iter, vcbi, bsize, maxpad, maxpart, maxtoken, minbsize):
+	for i_d in batch_padder(sentences_iter, vcbi, bsize, maxpad, maxpart, maxtoken, minbsize, file_reader=sentence_reader):
 		yield torch.as_tensor(i_d, dtype=torch.long)
 
 def load_fixing(module):
@@ -49,7 +57,7 @@ def restore(src, tsrc, trs):
 
 class TranslatorCore:
 
-	def __init__(self, modelfs, fvocab_i, fvocab_t, cnfg, minbsize=1, expand_for_mulgpu=True, bsize=max_sentences_gpu, maxpad=max_pad_tokens_sentence, maxpart=normal_tokens_vs_pad_tokens, maxtoken=max_tokens_gpu, minfreq=False, vsize=False, **kwargs):
+	def __init__(self, modelfs, fvocab_i, fvocab_t, cnfg, minbsize=1, expand_for_mulgpu=True, bsize=max_sentences_gpu, maxpad=max_pad_tokens_sentence, maxpart=normal_tokens_vs_pad_tokens, maxtoken=max_tokens_gpu, minfreq=False, vsize=False, continuous_batching=use_continuous_batching, **kwargs):
 
 		vcbi, nwordi = ldvocab(fvocab_i, minf=minfreq, omit_vsize=vsize, vanilla=False)
 		vcbt, nwordt = ldvocab(fvocab_t, minf=minfreq, omit_vsize=vsize, vanilla=False)
@@ -87,16 +95,27 @@ class TranslatorCore:
 		self.use_cuda, self.cuda_device, cuda_devices, self.multi_gpu = parse_cuda_decode(cnfg.use_cuda, cnfg.gpuid, cnfg.multi_gpu_decoding)
 
 		if self.use_cuda:
-			model.to(self.cuda_device, non_blocking=True)
-			if self.multi_gpu:
-				model = DataParallelMT(model, device_ids=cuda_devices, output_device=self.cuda_device.index, host_replicate=True, gather_output=False)
-		model = torch_compile(model, *torch_compile_args, **torch_compile_kwargs)
+			# distribute ensemble members over GPUs instead of splitting batches
+			if self.multi_gpu and (ensemble_parallel == "device") and isinstance(model, Ensemble):
+				model.distribute(cuda_devices)
+				self.multi_gpu = False
+			else:
+				model.to(self.cuda_device, non_blocking=True)
+				if self.multi_gpu:
+					model = DataParallelMT(model, device_ids=cuda_devices, output_device=self.cuda_device.index, host_replicate=True, gather_output=False)
 		self.use_amp = cnfg.use_amp and self.use_cuda
+		if quantize_cpu_inference and (not self.use_cuda):
+			model = quantize_model(model)
 		self.beam_size = cnfg.beam_size
 		self.length_penalty = cnfg.length_penalty
+		# the continuous batching engine only supports a single model on a single device
+		self.engine = Engine(model, beam_size=self.beam_size, length_penalty=self.length_penalty, bsize=self.bsize, maxtoken=self.maxtoken, device=self.cuda_device if self.use_cuda else None, use_amp=self.use_amp) if continuous_batching and (not isinstance(model, (Ensemble, DataParallelMT,))) else None
+		model = torch_compile(model, *torch_compile_args, **torch_compile_kwargs)
 		self.net = model
 
 	def __call__(self, sentences_iter, **kwargs):
+		if self.engine is not None:
+			return self.engine_call(sentences_iter, **kwargs)
 		rs = []
 		with torch_inference_mode():
 			for seq_batch in data_loader(sentences_iter, self.vcbi, self.minbsize, self.bsize, self.maxpad, self.maxpart, self.maxtoken):
@@ -111,83 +130,206 @@ class TranslatorCore:
 					output = tmp
 				else:
 					output = output.tolist()
-				for tran in output:
-					tmp = []
-					for tmpu in tran:
-						if tmpu == eos_id:
-							break
-						else:
-							tmp.append(self.vcbt[tmpu])
-					rs.append(" ".join(tmp))
+				rs.extend(self.restore_tran(tran) for tran in output)
 				seq_batch = None
 		return rs
 
+	# streaming translation, yields dicts of {index of sentence: (translation, whether it is finished)} for the sentences updated at each decoding step. Decoding stops when the iteration stops. With the continuous batching engine, sentences are decoded by the engine thread which reports updates through task callbacks (`Engine.stream`), as running the model in the calling thread would race with the engine on the cross-attention buffers of the shared decoder. Otherwise, only single models without multi-GPU decoding support streaming, and complete translations of batches are yielded for the others.
+
+	def stream(self, sentences_iter, **kwargs):
+
+		if self.engine is not None:
+			for _upd in self.engine.stream([map_instance(_.split(), self.vcbi) for _ in sentences_iter]):
+				yield {_i: (self.restore_tran(_tran), _f,) for _i, _tran, _f in _upd}
+			return
+
+		_stream = (not self.multi_gpu) and hasattr(self.net, "decode_stream")
+		_ind = 0
+		with torch_inference_mode():
+			for seq_batch in data_loader(sentences_iter, self.vcbi, self.minbsize, self.bsize, self.maxpad, self.maxpart, self.maxtoken):
+				bsize = seq_batch.size(0)
+				if self.use_cuda:
+					seq_batch = seq_batch.to(self.cuda_device, non_blocking=True)
+				with torch_autocast(enabled=self.use_amp):
+					if _stream:
+						_trans = [[] for _ in range(bsize)]
+						for _upd in self.net.decode_stream(seq_batch, self.beam_size, None, self.length_penalty):
+							rs = {}
+							for _i, (_tran, _u,) in enumerate(zip(_trans, _upd)):
+								if _u:
+									_tran.extend(_u)
+									rs[_ind + _i] = (self.restore_tran(_tran), _tran[-1] == eos_id,)
+							if rs:
+								yield rs
+						# translations cut by the maximum length
+						rs = {_ind + _i: (self.restore_tran(_tran), True,) for _i, _tran in enumerate(_trans) if (not _tran) or (_tran[-1] != eos_id)}
+					else:
+						output = self.net.decode(seq_batch, self.beam_size, None, self.length_penalty)
+						if self.multi_gpu:
+							tmp = []
+							for ou in output:
+								tmp.extend(ou.tolist())
+							output = tmp
+						else:
+							output = output.tolist()
+						rs = {_ind + _i: (self.restore_tran(tran), True,) for _i, tran in enumerate(output)}
+				if rs:
+					yield rs
+				_ind += bsize
+				seq_batch = None
+
+	def engine_call(self, sentences_iter, **kwargs):
+
+		return [self.restore_tran(tran) for tran in self.engine([map_instance(_.split(), self.vcbi) for _ in sentences_iter])]
+
+	def restore_tran(self, tran):
+
+		tmp = []
+		for tmpu in tran:
+			if tmpu == eos_id:
+				break
+			else:
+				tmp.append(self.vcbt[tmpu])
+
+		return " ".join(tmp)
+
+# cache: translation memory (utils.server.cache.TranslationCache) of trans outputs, keyed on the source sentences pre-processed by punc_norm, tok, truecaser and bpe, only cache misses are translated by trans.
+
 class Translator:
 
-	def __init__(self, trans=None, sent_split=None, tok=None, detok=None, bpe=None, debpe=None, punc_norm=None, truecaser=None, detruecaser=None, **kwargs):
+	def __init__(self, trans=None, sent_split=None, tok=None, detok=None, bpe=None, debpe=None, punc_norm=None, truecaser=None, detruecaser=None, cache=None, **kwargs):
 
-		self.sent_split = sent_split
+		self.sent_split, self.trans, self.cache = sent_split, trans, cache
 
-		self.flow = []
+		self.pre_flow = []
 		if punc_norm is not None:
-			self.flow.append(punc_norm)
+			self.pre_flow.append(punc_norm)
 		if tok is not None:
-			self.flow.append(tok)
+			self.pre_flow.append(tok)
 		if truecaser is not None:
-			self.flow.append(truecaser)
+			self.pre_flow.append(truecaser)
 		if bpe is not None:
-			self.flow.append(bpe)
-		if trans is not None:
-			self.flow.append(trans)
+			self.pre_flow.append(bpe)
+		self.post_flow = []
 		if debpe is not None:
-			self.flow.append(debpe)
+			self.post_flow.append(debpe)
 		if detruecaser is not None:
-			self.flow.append(detruecaser)
+			self.post_flow.append(detruecaser)
 		if detok is not None:
-			self.flow.append(detok)
+			self.post_flow.append(detok)
 
-	def __call__(self, paragraphs, **kwargs):
+	def translate(self, sentences):
+
+		if self.cache is None:
+			return self.trans(sentences)
+		rs = self.cache.get(sentences)
+		_miss = list(dict.fromkeys(_s for _s, _t in zip(sentences, rs) if _t is None))
+		if _miss:
+			_trans = self.trans(_miss)
+			self.cache.put(_miss, _trans)
+			_trans = dict(zip(_miss, _trans))
+			rs = [_trans[_s] if _t is None else _t for _s, _t in zip(sentences, rs)]
+
+		return rs
+
+	def split(self, paragraphs):
 
 		_paras = [clean_str(tmpu.strip()) for tmpu in paragraphs.strip().split("\n") if tmpu]
 
-		_tmp = []
+		rs = []
 		if self.sent_split is None:
-			for _tmpu in paras:
-				_tmp.append(_tmpu)
-				_tmp.append("\n")
+			for _tmpu in _paras:
+				rs.append(_tmpu)
+				rs.append("\n")
 		else:
 			for _tmpu in _paras:
-				_tmp.extend(clean_list([clean_str(_tmps) for _tmps in self.sent_split(_tmpu)]))
-				_tmp.append("\n")
+				rs.extend(clean_list([clean_str(_tmps) for _tmps in self.sent_split(_tmpu)]))
+				rs.append("\n")
+
+		return rs
+
+	def pre_process(self, sentences):
+
+		rs = sentences
+		for pu in self.pre_flow:
+			rs = pu(rs)
+
+		return rs
+
+	def post_process(self, sentences):
+
+		rs = sentences
+		for pu in self.post_flow:
+			rs = pu(rs)
+
+		return rs
+
+	def __call__(self, paragraphs, **kwargs):
+
+		_tmp = self.split(paragraphs)
 		_tmp_o = _tmpi = list(sorti(_tmp))
 
-		for pu in self.flow:
-			_tmp_o = pu(_tmp_o)
+		_tmp_o = self.pre_process(_tmp_o)
+		if self.trans is not None:
+			_tmp_o = self.translate(_tmp_o)
+		_tmp_o = self.post_process(_tmp_o)
 
 		_tmp = restore(_tmp, _tmpi, _tmp_o)
 
 		return " ".join(_tmp).replace(" \n", "\n").replace("\n ", "\n")
 
-#from datautils.bpe import BPEApplier, BPERemover
-#from datautils.moses import SentenceSplitter
-#from datautils.pymoses import Detokenizer, Detruecaser, Normalizepunctuation, Tokenizer, Truecaser
-
-#import cnfg
-
-#if __name__ == "__main__":
-	#tl = ["28 @-@ jähriger Koch in San Francisco M@@ all tot a@@ u@@ f@@ gefunden", "ein 28 @-@ jähriger Koch , der vor kurzem nach San Francisco gezogen ist , wurde im T@@ r@@ e@@ p@@ p@@ e@@ n@@ haus eines örtlichen E@@ i@@ n@@ k@@ a@@ u@@ f@@ z@@ e@@ n@@ t@@ r@@ u@@ ms tot a@@ u@@ f@@ gefunden .", "der Bruder des O@@ p@@ f@@ e@@ r@@ s sagte aus , dass er sich niemanden vorstellen kann , der ihm schaden wollen würde , &quot; E@@ n@@ d@@ lich ging es bei ihm wieder b@@ e@@ r@@ g@@ auf &quot; .", "der am Mittwoch morgen in der W@@ e@@ s@@ t@@ field M@@ all g@@ e@@ f@@ u@@ n@@ d@@ e@@ n@@ e L@@ e@@ i@@ c@@ h@@ n@@ a@@ m wurde als der 28 Jahre alte Frank G@@ a@@ l@@ i@@ c@@ i@@ a aus San Francisco identifiziert , teilte die g@@ e@@ r@@ i@@ c@@ h@@ t@@ s@@ medizinische Abteilung in San Francisco mit .", "das San Francisco P@@ o@@ l@@ i@@ ce D@@ e@@ p@@ a@@ r@@ t@@ ment sagte , dass der Tod als Mord eingestuft wurde und die Ermittlungen am L@@ a@@ u@@ f@@ en sind .", "der Bruder des O@@ p@@ f@@ e@@ r@@ s , Louis G@@ a@@ l@@ i@@ c@@ i@@ a , teilte dem A@@ B@@ S Sender K@@ GO in San Francisco mit , dass Frank , der früher als Koch in B@@ o@@ s@@ t@@ on gearbeitet hat , vor sechs Monaten seinen T@@ r@@ a@@ u@@ m@@ j@@ ob als Koch im S@@ o@@ n@@ s &amp; D@@ a@@ u@@ g@@ h@@ t@@ e@@ r@@ s Restaurant in San Francisco e@@ r@@ g@@ a@@ t@@ t@@ e@@ r@@ t hatte .", "ein Sprecher des S@@ o@@ n@@ s &amp; D@@ a@@ u@@ g@@ h@@ t@@ e@@ r@@ s sagte , dass sie über seinen Tod &quot; s@@ c@@ h@@ o@@ c@@ k@@ i@@ e@@ r@@ t und am Boden zerstört seien &quot; .", "&quot; wir sind ein kleines Team , das wie eine enge Familie arbeitet und wir werden ihn s@@ c@@ h@@ m@@ e@@ r@@ z@@ lich vermissen &quot; , sagte der Sprecher weiter .", "unsere Gedanken und unser B@@ e@@ i@@ leid sind in dieser schweren Zeit bei F@@ r@@ a@@ n@@ k@@ s Familie und Freunden .", "Louis G@@ a@@ l@@ i@@ c@@ i@@ a gab an , dass Frank zunächst in Hostels lebte , aber dass , &quot; die Dinge für ihn endlich b@@ e@@ r@@ g@@ auf gingen &quot; ."]
-	#spl = SentenceSplitter("de")
-	#tok = Tokenizer("de")
-	#detok = Detokenizer("en")
-	#punc_norm = Normalizepunctuation("de")
-	#truecaser = Truecaser("c1207\\truecase-model.de")
-	#detruecaser = Detruecaser()
-	#tran_core = TranslatorCore("c1207\\eva_20_1.384_1.088_26.74.h5", "c1207\\src.vcb", "c1207\\tgt.vcb", cnfg)
-	#bpe = BPEApplier("c1207\\src.cds", "c1207\\src.vcb.bpe", 50)
-	#debpe = BPERemover()
-	#trans = Translator(tran_core, spl, tok, detok, bpe, debpe, punc_norm, truecaser, detruecaser)
-	#rs = tran_core(tl)
-	#for rsu in rs:
-		#print(rsu.replace("@@ ", ""))
-	#rs = trans(". ".join(detok(detruecaser(debpe(tl)))))
-	#print(rs)
+	# streaming translation, yields the translation of paragraphs so far whenever it is updated (cached translations come first). Trailing BPE pieces (ending with "@@") of unfinished translations are held back until their words are complete. Falls back to a single complete translation if trans does not support streaming (TranslatorCore.stream).
+
+	def stream(self, paragraphs, **kwargs):
+
+		if not hasattr(self.trans, "stream"):
+			yield self(paragraphs, **kwargs)
+			return
+
+		_tmp = self.split(paragraphs)
+		_tmpi = list(sorti(_tmp))
+		_tmp_o = self.pre_process(_tmpi)
+		_nsent = len(_tmp_o)
+
+		rs = [None for _ in range(_nsent)]
+		_miss = list(range(_nsent))
+		if self.cache is not None:
+			_cached = self.cache.get(_tmp_o)
+			_miss = [_i for _i, _t in enumerate(_cached) if _t is None]
+			if len(_miss) < _nsent:
+				_ind = [_i for _i, _t in enumerate(_cached) if _t is not None]
+				for _i, _t in zip(_ind, self.post_process([_cached[_i] for _i in _ind])):
+					rs[_i] = _t
+				yield self.restore_stream(_tmp, _tmpi, rs)
+
+		if _miss:
+			_done = {}
+			for _upd in self.trans.stream([_tmp_o[_i] for _i in _miss]):
+				_ind, _trans = [], []
+				for _i, (_t, _f,) in _upd.items():
+					if _f:
+						_done[_i] = _t
+					else:
+						_t = _t.split()
+						while _t and _t[-1].endswith("@@"):
+							_t.pop()
+						_t = " ".join(_t)
+					_ind.append(_miss[_i])
+					_trans.append(_t)
+				for _i, _t in zip(_ind, self.post_process(_trans)):
+					rs[_i] = _t
+				yield self.restore_stream(_tmp, _tmpi, rs)
+			if self.cache is not None:
+				self.cache.put([_tmp_o[_miss[_i]] for _i in _done.keys()], list(_done.values()))
+
+	def restore_stream(self, src, tsrc, trs):
+
+		data = {}
+		for sl, tl in zip(tsrc, trs):
+			_sl = sl.strip()
+			if _sl and tl:
+				data[_sl] = clean_str(tl.strip())
+		# sentences not translated yet are omitted
+		_tmp = [_ for _ in (data.get(clean_str(line.strip()), line if line == "\n" else "") for line in src) if _]
+
+		return " ".join(_tmp).replace(" \n", "\n").replace("\n ", "\n")
@@ -0,0 +1,155 @@
+#encoding: utf-8
+
+import torch
+from contextlib import nullcontext
+from inspect import signature
+from os import environ
+from os.path import splitext
+from torch import distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from cnfg.ihyp import *
+
+"""	multi-process data parallel training with torch.distributed, one process per device. Launch training scripts with torchrun (or any launcher setting RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and MASTER_PORT), e.g.:
+
+		torchrun --nproc_per_node=4 train.py
+		torchrun --nnodes=2 --node_rank=0 --nproc_per_node=8 --master_addr=... --master_port=... train.py
+"""
+
+# rank and number of processes, host_group handles collectives of host (CPU) values, it is the default group for gloo and an additional gloo group for nccl.
+rank, world_size, host_group = 0, 1, None
+
+def is_dist_launched():
+
+	return int(environ.get("WORLD_SIZE", "1")) > 1
+
+# initialize the process group and return (use_cuda, cuda_device, cuda_devices, multi_gpu) like `utils.fmt.base4torch.parse_cuda`, the LOCAL_RANK-th GPU of gpuid (all GPUs if None) is used by each process. DataParallel (multi_gpu) is disabled in processes.
+
+def init_dist(use_cuda_arg, gpuid=None, backend=dist_backend):
+
+	global rank, world_size, host_group
+	use_cuda = use_cuda_arg and torch.cuda.is_available()
+	if use_cuda:
+		_gpuid = tuple(range(torch.cuda.device_count())) if gpuid is None else tuple(int(_.strip()) for _ in gpuid[gpuid.find(":") + 1:].split(","))
+		cuda_device = torch.device("cuda", _gpuid[int(environ.get("LOCAL_RANK", "0")) % len(_gpuid)])
+		torch.cuda.set_device(cuda_device.index)
+	else:
+		cuda_device = None
+	_backend = ("nccl" if use_cuda else "gloo") if backend is None else backend
+	dist.init_process_group(backend=_backend)
+	rank, world_size = dist.get_rank(), dist.get_world_size()
+	host_group = None if _backend == "gloo" else dist.new_group(backend="gloo")
+
+	return use_cuda, cuda_device, None, False
+
+def close_dist():
+
+	global host_group
+	if dist.is_initialized():
+		dist.destroy_process_group()
+	host_group = None
+
+# functions writing shared files (e.g., `utils.io.save_model`) only run in the first process
+
+def master_only(func):
+
+	def _func(*args, **kwargs):
+
+		if rank == 0:
+			return func(*args, **kwargs)
+
+	return _func
+
+# processes other than the first one write to fname.rank{rank}.ext (e.g., logs)
+
+def rank_fname(fname):
+
+	if rank == 0:
+		return fname
+	_name, _ext = splitext(fname)
+
+	return "%s.rank%d%s" % (_name, rank, _ext,)
+
+# shard of the batch list of this process (interleaved), even keeps the same number of batches for all processes (required in training to match collectives of processes) by dropping at most world_size - 1 batches at the tail.
+
+def shard_list(tl, even=True):
+
+	if world_size == 1:
+		return tl
+	_ntl = len(tl)
+
+	return tl[rank:(_ntl - _ntl % world_size) if even else _ntl:world_size]
+
+# the index in the full batch list of the i-th batch of all shards
+
+def shard_start(i):
+
+	return i * world_size
+
+# sum host values (int/float) over processes, asynchronously with the wait method
+
+class HostAllReduce:
+
+	def __init__(self, *values):
+
+		self.types = tuple(type(_) for _ in values)
+		self.data = torch.as_tensor(values, dtype=torch.float64)
+		self.work = dist.all_reduce(self.data, group=host_group, async_op=True)
+
+	def wait(self):
+
+		self.work.wait()
+
+		return tuple(_t(_v) for _t, _v in zip(self.types, self.data.tolist()))
+
+def all_reduce_host(*values):
+
+	return HostAllReduce(*values).wait()
+
+# merge dicts (with distinct keys, e.g., losses of batches of shards) of all processes
+
+def all_gather_dict(x):
+
+	_rsl = [None for _ in range(world_size)]
+	dist.all_gather_object(_rsl, x, group=host_group)
+	rs = {}
+	for _ in _rsl:
+		rs.update(_)
+
+	return rs
+
+# gradients are summed rather than averaged over processes, consistent with losses summed over tokens and DataParallel
+
+def allreduce_sum_hook(process_group, bucket):
+
+	return dist.all_reduce(bucket.buffer(), group=process_group, async_op=True).get_future().then(lambda fut: fut.value()[0])
+
+# forward_sync_buffers replaces broadcast_buffers in recent versions of pytorch
+no_buffer_sync_kwargs = {"forward_sync_buffers": False} if "forward_sync_buffers" in signature(DistributedDataParallel.__init__).parameters else {"broadcast_buffers": False}
+
+# DistributedDataParallel all-reduces gradients in buckets of bucket_cap_mb MB overlapped with the backward pass. Buffers are not broadcast in forward passes so that processes can evaluate different numbers of batches.
+
+class DistributedModel(DistributedDataParallel):
+
+	def __init__(self, module, device=None, bucket_cap_mb=dist_bucket_cap_mb, find_unused_parameters=dist_find_unused_parameters, **kwargs):
+
+		super(DistributedModel, self).__init__(module, device_ids=None if (device is None) or (device.type != "cuda") else [device.index], output_device=None if (device is None) or (device.type != "cuda") else device.index, bucket_cap_mb=bucket_cap_mb, find_unused_parameters=find_unused_parameters, **no_buffer_sync_kwargs, **kwargs)
+		self.register_comm_hook(None, allreduce_sum_hook)
+
+	# gradients of batches before the optimizer step are accumulated locally with sync False (the forward and the backward pass shall be in the context), they are all-reduced with those of the batch with sync True
+
+	def grad_sync(self, sync=True):
+
+		return nullcontext() if sync else self.no_sync()
+
+	# all-reduce gradients accumulated without sync, for optimizer steps outside training loops (e.g., with remaining tokens at the end of training)
+
+	def sync_gradients(self):
+
+		for para in self.module.parameters():
+			if para.grad is not None:
+				dist.all_reduce(para.grad)
+
+def grad_sync(model, sync=True):
+
+	return model.grad_sync(sync) if hasattr(model, "grad_sync") else nullcontext()
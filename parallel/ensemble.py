@@ -0,0 +1,67 @@
+#encoding: utf-8
+
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from utils.torch.comp import torch_autocast, torch_inference_mode, torch_is_autocast_enabled, torch_is_grad_enabled, torch_is_inference_mode_enabled, torch_set_grad_enabled
+
+from cnfg.ihyp import ensemble_member_threads
+
+def set_num_threads(nthreads):
+
+	if (nthreads is not None) and (nthreads > 0):
+		torch.set_num_threads(nthreads)
+
+# runs a function for each member of ensembles and collects their outputs. Members are run one by one, or concurrently on a thread pool (one thread for each member, with nthreads intra-op threads) if parallel is True. After distribute, members are placed on devices (each member is run within the context of its device), their inputs are moved to their devices with to_member, and their outputs are gathered to the first device.
+
+class MemberExecutor:
+
+	def __init__(self, nmembers, parallel=False, nthreads=ensemble_member_threads, **kwargs):
+
+		self.nmembers, self.devices = nmembers, None
+		self.pool = ThreadPoolExecutor(max_workers=nmembers, thread_name_prefix="ensemble", initializer=set_num_threads, initargs=(nthreads,)) if parallel and (nmembers > 1) else None
+
+	# members: list of modules (one for each member) to be distributed
+	# devices: list of devices, members are assigned to them in turn
+
+	def distribute(self, members, devices):
+
+		self.devices = [devices[_i % len(devices)] for _i in range(self.nmembers)]
+		for _m, _d in zip(members, self.devices):
+			_m.to(_d, non_blocking=True)
+		if self.pool is None:
+			self.pool = ThreadPoolExecutor(max_workers=self.nmembers, thread_name_prefix="ensemble")
+
+	def to_member(self, i, x):
+
+		return x if (x is None) or (self.devices is None) else x.to(self.devices[i], non_blocking=True)
+
+	def gather(self, x):
+
+		return x if self.devices is None else x.to(self.devices[0], non_blocking=True)
+
+	# func: called as func(i, *args) for the i-th member
+	# inputs: lists of arguments (one for each member) of func
+	# gather: gather outputs (tensors) to the first device
+
+	def __call__(self, func, *inputs, gather=True):
+
+		if self.pool is None:
+			return [func(_i, *_args) for _i, _args in enumerate(zip(*inputs))]
+
+		grad_enabled, autocast_enabled, inference_mode_enabled = torch_is_grad_enabled(), torch_is_autocast_enabled(), torch_is_inference_mode_enabled()
+
+		# grad mode is set inside inference mode, as entering inference_mode(False) enables gradients (e.g., with torch.no_grad() callers)
+
+		def _worker(i, *args):
+
+			with (torch_inference_mode() if inference_mode_enabled else nullcontext()), torch_set_grad_enabled(grad_enabled), torch_autocast(enabled=autocast_enabled):
+				if (self.devices is not None) and (self.devices[i].type == "cuda"):
+					with torch.cuda.device(self.devices[i]):
+						return func(i, *args)
+				return func(i, *args)
+
+		rs = [_.result() for _ in [self.pool.submit(_worker, _i, *_args) for _i, _args in enumerate(zip(*inputs))]]
+
+		return [self.gather(_) for _ in rs] if gather else rs
@@ -7,6 +7,7 @@ from parallel.parallelMT import DataParallelMT
 from transformer.EnsembleNMT import NMT as Ensemble
 from transformer.NMT import NMT
 from utils.base import set_random_seed
+from utils.decode.shortlist import Shortlist
 from utils.fmt.base import sys_open
 from utils.fmt.base4torch import parse_cuda_decode
 from utils.fmt.vocab.base import reverse_dict
@@ -14,6 +15,7 @@ from utils.fmt.vocab.token import ldvocab
 from utils.h5serial import h5File
 from utils.io import load_model_cpu
 from utils.torch.comp import torch_autocast, torch_compile, torch_inference_mode
+from utils.torch.quant import quantize_model
 from utils.tqdm import tqdm
 
 import cnfg.base as cnfg
@@ -53,19 +55,27 @@ mymodel.eval()
 
 use_cuda, cuda_device, cuda_devices, multi_gpu = parse_cuda_decode(cnfg.use_cuda, cnfg.gpuid, cnfg.multi_gpu_decoding)
 use_amp = cnfg.use_amp and use_cuda
+if quantize_cpu_inference and (not use_cuda):
+	mymodel = quantize_model(mymodel)
 
 # Important to make cudnn methods deterministic
 set_random_seed(cnfg.seed, use_cuda)
 
 if cuda_device:
-	mymodel.to(cuda_device, non_blocking=True)
-	if multi_gpu:
-		mymodel = DataParallelMT(mymodel, device_ids=cuda_devices, output_device=cuda_device.index, host_replicate=True, gather_output=False)
+	# distribute ensemble members over GPUs instead of splitting batches
+	if multi_gpu and (ensemble_parallel == "device") and isinstance(mymodel, Ensemble):
+		mymodel.distribute(cuda_devices)
+		multi_gpu = False
+	else:
+		mymodel.to(cuda_device, non_blocking=True)
+		if multi_gpu:
+			mymodel = DataParallelMT(mymodel, device_ids=cuda_devices, output_device=cuda_device.index, host_replicate=True, gather_output=False)
 
 mymodel = torch_compile(mymodel, *torch_compile_args, **torch_compile_kwargs)
 
 beam_size = cnfg.beam_size
 length_penalty = cnfg.length_penalty
+shortlist = None if cnfg.shortlist is None else Shortlist(cnfg.shortlist)
 
 ens = "\n".encode("utf-8")
 
@@ -77,7 +87,7 @@ with sys_open(sys.argv[1], "wb") as f, torch_inference_mode():
 			seq_batch = seq_batch.to(cuda_device, non_blocking=True)
 		seq_batch = seq_batch.long()
 		with torch_autocast(enabled=use_amp):
-			output = mymodel.decode(seq_batch, beam_size, None, length_penalty)
+			output = mymodel.decode(seq_batch, beam_size, None, length_penalty, shortlist=shortlist)
 			#output = mymodel.train_decode(seq_batch, beam_size, None, length_penalty)
 		if multi_gpu:
 			tmp = []
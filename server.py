@@ -1,15 +1,18 @@
 #encoding: utf-8
 
 import json
-from flask import Flask, render_template, request, send_from_directory
+from atexit import register as register_exit
+from flask import Flask, Response, render_template, request, send_from_directory, stream_with_context
 
 from datautils.bpe import BPEApplier, BPERemover
 from datautils.moses import SentenceSplitter
 # import Tokenizer/Detokenizer/SentenceSplitter from datautils.zh for Chinese
 from datautils.pymoses import Detokenizer, Detruecaser, Normalizepunctuation, Tokenizer, Truecaser
 from modules.server.transformer import Translator, TranslatorCore
+from utils.server.cache import TranslationCache
 
 import cnfg.base as cnfg
+from cnfg.server import tm_cache_file, tm_cache_size
 
 """
 slang = "de"# source language
@@ -32,7 +35,11 @@ detruecaser = Detruecaser()
 tran_core = TranslatorCore(tmodel, srcvcb, tgtvcb, cnfg)
 bpe = BPEApplier(bpecds, bpevcb, bpethr)
 debpe = BPERemover()
-trans = Translator(tran_core, spl, tok, detok, bpe, debpe, punc_norm, truecaser, detruecaser)
+# translation memory cache keyed on the model file, persisted at exit if tm_cache_file is set
+tm_cache = TranslationCache(tmodel if isinstance(tmodel, str) else "|".join(tmodel)) if tm_cache_size > 0 else None
+if (tm_cache is not None) and (tm_cache_file is not None):
+	register_exit(tm_cache.save)
+trans = Translator(tran_core, spl, tok, detok, bpe, debpe, punc_norm, truecaser, detruecaser, cache=tm_cache)
 
 app = Flask(__name__)
 
@@ -59,6 +66,28 @@ def translate_core_api():
 
 	return json.dumps({"tgt": trans(srclang)})
 
+# streams the translation so far as a JSON line whenever it is updated, decoding stops when the client disconnects
+@app.route("/api/stream", methods=["POST"])
+def translate_stream_api():
+
+	try:
+		srclang = json.loads(request.get_data())["src"]
+
+	except Exception as e:
+		return json.dumps({"exception": str(e)})
+
+	def stream_core():
+
+		for _ in trans.stream(srclang):
+			yield json.dumps({"tgt": _}) + "\n"
+
+	return Response(stream_with_context(stream_core()), mimetype="application/x-ndjson")
+
+@app.route("/cache", methods=["GET"])
+def cache_status():
+
+	return json.dumps({} if tm_cache is None else tm_cache.status())
+
 # send everything from client as static content
 @app.route("/favicon.ico")
 def favicon():
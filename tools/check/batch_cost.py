@@ -0,0 +1,104 @@
+#encoding: utf-8
+
+# usage: python tools/check/batch_cost.py [$model.h5]
+# times training steps (forward and backward) of the model configured in `cnfg/base.py` on random batches of various lengths on the local machine (the GPU in `cnfg/base.py` if enabled), fits the time of a batch as c + a * bsize * len + b * bsize * len * len (len is the total number of source and target tokens, the number of heads is constant for a model and absorbed in b), and reports attn_cost_ratio (b / a) for `cnfg/hyp.py`.
+
+import sys
+import numpy
+import torch
+from time import time
+
+from loss.base import LabelSmoothingLoss
+from transformer.NMT import NMT
+from utils.fmt.base import get_bsize_cost, get_bsize_linear
+from utils.fmt.base4torch import parse_cuda
+from utils.fmt.flat import open_data
+from utils.io import load_model_cpu
+from utils.torch.comp import torch_autocast
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+from cnfg.vocab.base import init_normal_token_id, pad_id
+
+lens = (8, 16, 24, 32, 48, 64, 96, 128, 192, 256,)
+token_ratios = (0.5, 1.0,)
+nrun = 4
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+def synchronize(use_cuda):
+
+	if use_cuda:
+		torch.cuda.synchronize()
+
+def time_step(model, lossf, bsize, lgth, nwordi, nwordt, device, use_cuda, use_amp):
+
+	_ls = lgth // 2
+	_lt = lgth - _ls
+	seq_batch = torch.randint(init_normal_token_id, nwordi, (bsize, _ls,), device=device)
+	seq_o = torch.randint(init_normal_token_id, nwordt, (bsize, _lt + 1,), device=device)
+	rs = []
+	for _ in range(nrun + 1):
+		synchronize(use_cuda)
+		_st = time()
+		with torch_autocast(enabled=use_amp):
+			loss = lossf(model(seq_batch, seq_o.narrow(1, 0, _lt)), seq_o.narrow(1, 1, _lt).contiguous())
+		loss.backward()
+		synchronize(use_cuda)
+		rs.append(time() - _st)
+		model.zero_grad(set_to_none=True)
+		loss = None
+
+	# the first run is for warm up
+	return min(rs[1:])
+
+def handle(modelf=None):
+
+	with open_data(cnfg.dev_data) as td:
+		nword = td["nword"][()].tolist()
+	nwordi, nwordt = nword[0], nword[-1]
+
+	mymodel = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.act_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+	if modelf is not None:
+		mymodel = load_model_cpu(modelf, mymodel)
+		mymodel.apply(load_fixing)
+	mymodel.train()
+	lossf = LabelSmoothingLoss(nwordt, cnfg.label_smoothing, ignore_index=pad_id, reduction="sum", forbidden_index=cnfg.forbidden_indexes)
+
+	use_cuda, cuda_device, cuda_devices, multi_gpu = parse_cuda(cnfg.use_cuda, cnfg.gpuid)
+	if use_cuda:
+		mymodel.to(cuda_device, non_blocking=True)
+		lossf.to(cuda_device, non_blocking=True)
+	use_amp = cnfg.use_amp and use_cuda
+
+	_x, _y = [], []
+	for _r in token_ratios:
+		_maxtoken = int(max_tokens_gpu * _r)
+		for _l in lens:
+			_bsize = get_bsize_linear(_l, _maxtoken, max_sentences_gpu)
+			try:
+				_t = time_step(mymodel, lossf, _bsize, _l, nwordi, nwordt, cuda_device, use_cuda, use_amp)
+			except RuntimeError as e:
+				print("Skip %d x %d: %s" % (_bsize, _l, e,))
+				mymodel.zero_grad(set_to_none=True)
+				if use_cuda:
+					torch.cuda.empty_cache()
+				continue
+			_ntok = _bsize * _l
+			_x.append((1.0, _ntok, _ntok * _l,))
+			_y.append(_t)
+			print("bsize: %d, len: %d, time: %.4fs" % (_bsize, _l, _t,))
+
+	(_c, _a, _b,), _, _, _ = numpy.linalg.lstsq(numpy.array(_x), numpy.array(_y), rcond=None)
+	_ratio = max(_b / _a, 0.0)
+	print("time = %.4e + %.4e * bsize * len + %.4e * bsize * len * len" % (_c, _a, _b,))
+	print("attn_cost_ratio = %.4e" % _ratio)
+	print("Batch sizes with max_tokens_gpu = %d and attn_cost_ref_len = %d:" % (max_tokens_gpu, attn_cost_ref_len,))
+	for _l in lens:
+		print("len %d: %d (linear: %d)" % (_l, get_bsize_cost(_l, max_tokens_gpu, max_sentences_gpu, ratio=_ratio, ref_len=attn_cost_ref_len), get_bsize_linear(_l, max_tokens_gpu, max_sentences_gpu),))
+
+if __name__ == "__main__":
+	handle(sys.argv[1] if len(sys.argv) > 1 else None)
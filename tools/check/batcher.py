@@ -0,0 +1,66 @@
+#encoding: utf-8
+
+# usage: python tools/check/batcher.py $requests_per_second,... [$num_requests]
+# load test of the request batcher (`utils/server/batcher.py`) with a simulated handler whose cost grows with the batch size, single-sentence requests arrive following a Poisson process, and the p50/p99 latency and the average batch size are reported for each request rate.
+
+import sys
+from asyncio import gather, run, sleep as asleep
+from random import expovariate, seed as rpyseed
+from time import sleep, time
+
+from utils.server.batcher import BatchWrapper
+
+# simulated cost (seconds) of handling a batch: batch_cost + seq_cost * number of sequences
+batch_cost = 0.02
+seq_cost = 0.0005
+
+class Handler:
+
+	def __init__(self):
+
+		self.nbatch = self.nseq = 0
+
+	def __call__(self, x):
+
+		sleep(batch_cost + seq_cost * len(x))
+		self.nbatch += 1
+		self.nseq += len(x)
+
+		return x
+
+async def request(batcher, x, tstart, lat):
+
+	_wait = tstart - time()
+	if _wait > 0.0:
+		await asleep(_wait)
+	_st = time()
+	await batcher([x])
+	lat.append(time() - _st)
+
+async def benchmark(batcher, rate, nreq):
+
+	lat = []
+	_tstart = time()
+	_reqs = []
+	for _i in range(nreq):
+		_tstart += expovariate(rate)
+		_reqs.append(request(batcher, "request %d" % _i, _tstart, lat))
+	await gather(*_reqs)
+	lat.sort()
+
+	return lat[len(lat) // 2], lat[min(len(lat) - 1, int(len(lat) * 0.99))]
+
+def handle(rates, nreq=2000):
+
+	for _rate in rates:
+		_handler = Handler()
+		_batcher = BatchWrapper(_handler)
+		try:
+			_p50, _p99 = run(benchmark(_batcher, _rate, nreq))
+		finally:
+			_batcher.status(False)
+		print("%.1f requests/s: p50 %.1f ms, p99 %.1f ms, %.2f sequences/batch" % (_rate, _p50 * 1000.0, _p99 * 1000.0, _handler.nseq / max(_handler.nbatch, 1),))
+
+if __name__ == "__main__":
+	rpyseed(666666)
+	handle([float(_) for _ in sys.argv[1].split(",")], *[int(_) for _ in sys.argv[2:3]])
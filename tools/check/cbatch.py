@@ -0,0 +1,146 @@
+#encoding: utf-8
+
+# usage: python tools/check/cbatch.py $test.h5 $requests_per_second $model.h5 [$num_requests]
+# simulates concurrent single-sentence translation requests with Poisson arrivals, and compares the p50/p99 latency and throughput (sentences/sec) of the per-batch decoding loop (decoding a padded batch of waiting requests to completion before looking at new ones) against the continuous batching engine (`modules/server/engine.py`).
+
+import sys
+import torch
+from collections import deque
+from random import expovariate, seed as rpyseed, shuffle
+from threading import Condition
+from time import sleep, time
+
+from modules.server.engine import Engine, Task
+from transformer.NMT import NMT
+from utils.fmt.base4torch import parse_cuda_decode
+from utils.h5serial import h5File
+from utils.io import load_model_cpu
+from utils.thread import start_thread
+from utils.torch.comp import torch_autocast, torch_inference_mode
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+from cnfg.server import engine_wait_interval
+from cnfg.vocab.base import pad_id
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+class BatchLoop:
+
+	def __init__(self, model, beam_size=1, length_penalty=0.0, bsize=max_sentences_gpu, maxtoken=max_tokens_gpu, device=None, use_amp=False, wait_interval=engine_wait_interval, **kwargs):
+
+		self.net, self.beam_size, self.length_penalty, self.bsize, self.maxtoken, self.device, self.use_amp, self.wait_interval = model, beam_size, length_penalty, bsize, maxtoken, device, use_amp, wait_interval
+		self.pending = deque()
+		self.cond = Condition()
+		self.running = True
+		self.t_process = start_thread(target=self.processor)
+
+	def __call__(self, sentences, **kwargs):
+
+		_task = Task(len(sentences))
+		with self.cond:
+			self.pending.extend((_task, _i, _s,) for _i, _s in enumerate(sentences))
+			self.cond.notify_all()
+			while _task.nleft > 0:
+				self.cond.wait()
+
+		return _task.rs
+
+	def processor(self):
+
+		with torch_inference_mode(), torch_autocast(enabled=self.use_amp):
+			while self.running:
+				_batch, _seql = [], 0
+				with self.cond:
+					if not self.pending:
+						self.cond.wait(self.wait_interval)
+					while self.pending and (len(_batch) < self.bsize):
+						_l = max(_seql, len(self.pending[0][-1]))
+						if _batch and ((len(_batch) + 1) * _l > self.maxtoken):
+							break
+						_batch.append(self.pending.popleft())
+						_seql = _l
+				if _batch:
+					seq_batch = torch.as_tensor([_[-1] + [pad_id for _ in range(_seql - len(_[-1]))] for _ in _batch], dtype=torch.long, device=self.device)
+					output = self.net.decode(seq_batch, self.beam_size, None, self.length_penalty).tolist()
+					with self.cond:
+						for (_task, _ind, _,), _tran in zip(_batch, output):
+							_task.rs[_ind] = _tran
+							_task.nleft -= 1
+						self.cond.notify_all()
+
+	def status(self, mode):
+
+		self.running = mode
+
+def load_sentences(h5f, nreq=None):
+
+	rs = []
+	with h5File(h5f, "r") as td:
+		ntest = td["ndata"][()].item()
+		src_grp = td["src"]
+		for i in range(ntest):
+			for _s in src_grp[str(i)][()].tolist():
+				rs.append([_ for _ in _s if _ != pad_id])
+	shuffle(rs)
+
+	return rs if nreq is None else rs[:nreq]
+
+def benchmark(server, sentences, rate):
+
+	lat = [None for _ in sentences]
+
+	def request(ind, sent, tstart):
+
+		_wait = tstart - time()
+		if _wait > 0.0:
+			sleep(_wait)
+		_st = time()
+		server([sent])
+		lat[ind] = time() - _st
+
+	threads = []
+	_st = _tstart = time()
+	for _i, _sent in enumerate(sentences):
+		_tstart += expovariate(rate)
+		threads.append(start_thread(target=request, args=(_i, _sent, _tstart,)))
+	for _t in threads:
+		_t.join()
+	_cost = time() - _st
+	lat.sort()
+	_n = len(lat)
+
+	return lat[_n // 2], lat[min(_n - 1, int(_n * 0.99))], _n / _cost
+
+def handle(h5f, rate, modelf, nreq=None):
+
+	with h5File(h5f, "r") as td:
+		nword = td["nword"][()].tolist()
+	nwordi, nwordt = nword[0], nword[-1]
+	mymodel = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.act_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+	mymodel = load_model_cpu(modelf, mymodel)
+	mymodel.apply(load_fixing)
+	mymodel.eval()
+
+	use_cuda, cuda_device, cuda_devices, multi_gpu = parse_cuda_decode(cnfg.use_cuda, cnfg.gpuid, False)
+	if use_cuda:
+		mymodel.to(cuda_device, non_blocking=True)
+	else:
+		cuda_device = None
+	use_amp = cnfg.use_amp and use_cuda
+
+	sentences = load_sentences(h5f, nreq)
+	for _name, _server_cls in (("per-batch", BatchLoop,), ("continuous", Engine,),):
+		_server = _server_cls(mymodel, beam_size=cnfg.beam_size, length_penalty=cnfg.length_penalty, device=cuda_device, use_amp=use_amp)
+		# warm up
+		_server(sentences[:8])
+		_p50, _p99, _tput = benchmark(_server, sentences, rate)
+		_server.status(False)
+		print("%s: p50 %.1f ms, p99 %.1f ms, %.2f sentences/s" % (_name, _p50 * 1000.0, _p99 * 1000.0, _tput,))
+
+if __name__ == "__main__":
+	rpyseed(666666)
+	handle(sys.argv[1], float(sys.argv[2]), sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else None)
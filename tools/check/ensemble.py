@@ -0,0 +1,73 @@
+#encoding: utf-8
+
+# usage: python tools/check/ensemble.py $model1.h5 $model2.h5 ...
+# decodes the source side of the dev set with the ensemble of models run one by one and with members run concurrently (on a thread pool, or distributed over the GPUs of gpuid), under both torch.inference_mode() and torch.no_grad() callers, and reports whether translations are identical and the decoding time of each.
+
+import sys
+import torch
+from copy import deepcopy
+from time import time
+
+from transformer.EnsembleNMT import NMT as Ensemble
+from transformer.NMT import NMT
+from utils.h5serial import h5File
+from utils.io import load_model_cpu
+from utils.torch.comp import torch_inference_mode, torch_no_grad
+
+import cnfg.base as cnfg
+from cnfg.ihyp import *
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+def translate(model, src_grp, ntest, device=None):
+
+	rs = []
+	_st = time()
+	for i in range(ntest):
+		seq_batch = torch.from_numpy(src_grp[str(i)][()])
+		if device is not None:
+			seq_batch = seq_batch.to(device, non_blocking=True)
+		rs.extend(model.decode(seq_batch.long(), cnfg.beam_size, None, cnfg.length_penalty).tolist())
+
+	return rs, time() - _st
+
+def handle(modelfs):
+
+	with h5File(cnfg.dev_data, "r") as td:
+		ntest = td["ndata"][()].item()
+		nword = td["nword"][()].tolist()
+		nwordi, nwordt = nword[0], nword[-1]
+		src_grp = td["src"]
+
+		models = []
+		for modelf in modelfs:
+			tmp = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.act_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
+			tmp = load_model_cpu(modelf, tmp)
+			tmp.apply(load_fixing)
+			models.append(tmp)
+
+		seq_model, par_model = Ensemble(models, parallel=None), Ensemble([deepcopy(_) for _ in models], parallel="thread")
+		device = None
+		if cnfg.use_cuda and torch.cuda.is_available():
+			devices = [int(_.strip()) for _ in cnfg.gpuid[cnfg.gpuid.find(":") + 1:].split(",")]
+			device = torch.device("cuda", devices[0])
+			torch.cuda.set_device(device.index)
+			seq_model.to(device, non_blocking=True)
+			if len(devices) > 1:
+				par_model.distribute([torch.device("cuda", _) for _ in devices])
+			else:
+				par_model.to(device, non_blocking=True)
+		seq_model.eval()
+		par_model.eval()
+
+		for _name, _ctx in (("inference_mode", torch_inference_mode,), ("no_grad", torch_no_grad,),):
+			with _ctx():
+				seq_rs, seq_t = translate(seq_model, src_grp, ntest, device)
+				par_rs, par_t = translate(par_model, src_grp, ntest, device)
+			print("%s: identical %s, sequential %.2fs, parallel %.2fs" % (_name, seq_rs == par_rs, seq_t, par_t,))
+
+if __name__ == "__main__":
+	handle(sys.argv[1:])
@@ -0,0 +1,119 @@
+#encoding: utf-8
+
+# usage: python tools/check/quant.py [nmt|bart] $dev.h5 $model.h5 [$rs_quantized_model.h5]
+# the model is built as in predict.py (nmt, default) or in the BART prediction scripts (bart, with cnfg/plm/bart/base.py). It decodes the source side of the HDF5 data with the fp32 model and its int8 dynamic quantized version on CPU, and reports BLEU (on token indices against the target side of the data) and the decoding speed (generated tokens/sec) of both, and BLEU of int8 translations against fp32 ones. The quantized model is saved if a file name is given.
+
+import sys
+import torch
+from collections import Counter
+from math import exp, log
+from time import time
+
+from utils.h5serial import h5File
+from utils.io import load_model_cpu, save_model
+from utils.torch.comp import torch_inference_mode
+from utils.torch.quant import quantize_model
+
+from cnfg.ihyp import *
+from cnfg.vocab.base import eos_id, pad_id, sos_id
+
+# build the model to check and return it with its configuration module
+
+def build_nmt(nwordi, nwordt):
+
+	from transformer.NMT import NMT
+	import cnfg.base as cnfg
+
+	return NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.act_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes), cnfg
+
+def build_bart(nwordi, nwordt):
+
+	from transformer.PLM.BART.NMT import NMT
+	import cnfg.plm.bart.base as cnfg
+
+	return NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, fhsize=cnfg.ff_hsize, dropout=cnfg.drop, attn_drop=cnfg.attn_drop, global_emb=cnfg.share_emb, num_head=cnfg.nhead, xseql=cache_len_default, ahsize=cnfg.attn_hsize, norm_output=cnfg.norm_output, bindDecoderEmb=cnfg.bindDecoderEmb, forbidden_index=cnfg.forbidden_indexes, model_name=cnfg.model_name), cnfg
+
+model_builders = {"nmt": build_nmt, "bart": build_bart}
+
+def load_fixing(module):
+
+	if hasattr(module, "fix_load"):
+		module.fix_load()
+
+def clean_tokens(seq):
+
+	rs = []
+	for _ in seq:
+		if _ == eos_id:
+			break
+		elif (_ != pad_id) and (_ != sos_id):
+			rs.append(_)
+
+	return rs
+
+def ngrams(seq, n):
+
+	return Counter(tuple(seq[i:i + n]) for i in range(len(seq) - n + 1))
+
+# corpus BLEU of tokenized hypotheses and references (one reference per hypothesis)
+
+def bleu(hyps, refs, max_n=4):
+
+	_match, _total = [0 for _ in range(max_n)], [0 for _ in range(max_n)]
+	_hlen = _rlen = 0
+	for _h, _r in zip(hyps, refs):
+		_hlen += len(_h)
+		_rlen += len(_r)
+		for _n in range(max_n):
+			_hc, _rc = ngrams(_h, _n + 1), ngrams(_r, _n + 1)
+			_match[_n] += sum(min(_c, _rc[_g]) for _g, _c in _hc.items())
+			_total[_n] += max(0, len(_h) - _n)
+	if min(_match) == 0:
+		return 0.0
+	_bp = 1.0 if _hlen > _rlen else exp(1.0 - _rlen / max(_hlen, 1))
+
+	return _bp * exp(sum(log(_m / _t) for _m, _t in zip(_match, _total)) / max_n) * 100.0
+
+def translate(model, src_grp, ntest, cnfg):
+
+	rs = []
+	_ntok = 0
+	_st = time()
+	with torch_inference_mode():
+		for i in range(ntest):
+			for _tran in model.decode(torch.from_numpy(src_grp[str(i)][()]).long(), cnfg.beam_size, None, cnfg.length_penalty).tolist():
+				_tran = clean_tokens(_tran)
+				_ntok += len(_tran) + 1
+				rs.append(_tran)
+
+	return rs, _ntok / (time() - _st)
+
+def handle(h5f, modelf, rsf=None, model_type="nmt"):
+
+	with h5File(h5f, "r") as td:
+		ntest = td["ndata"][()].item()
+		nword = td["nword"][()].tolist()
+		nwordi, nwordt = nword[0], nword[-1]
+		src_grp, tgt_grp = td["src"], td["tgt"]
+		refs = [clean_tokens(_r) for i in range(ntest) for _r in tgt_grp[str(i)][()].tolist()]
+
+		mymodel, cnfg = model_builders[model_type](nwordi, nwordt)
+		mymodel = load_model_cpu(modelf, mymodel)
+		mymodel.apply(load_fixing)
+		mymodel.eval()
+
+		fp_hyps, fp_speed = translate(mymodel, src_grp, ntest, cnfg)
+		fp_bleu = bleu(fp_hyps, refs)
+		mymodel = quantize_model(mymodel)
+		hyps, q_speed = translate(mymodel, src_grp, ntest, cnfg)
+		q_bleu = bleu(hyps, refs)
+
+	print("fp32: BLEU %.2f, %.1f tokens/s\nint8: BLEU %.2f (%+.2f), %.1f tokens/s (%.2fx), BLEU against fp32 translations %.2f" % (fp_bleu, fp_speed, q_bleu, q_bleu - fp_bleu, q_speed, q_speed / fp_speed, bleu(hyps, fp_hyps),))
+	if rsf is not None:
+		save_model(mymodel, rsf, sub_module=False, h5args=h5zipargs)
+
+if __name__ == "__main__":
+	if sys.argv[1] in model_builders:
+		handle(*sys.argv[2:5], model_type=sys.argv[1])
+	else:
+		handle(*sys.argv[1:4])
@@ -1,40 +1,131 @@
 #encoding: utf-8
 
+import numpy
 import sys
+from functools import partial
+from hashlib import blake2b
+from itertools import islice
+from multiprocessing import Pool
+from unicodedata import category
+from zlib import crc32
 
 from utils.fmt.base import FileList, all_le, clean_liststr_lentok
 
-def handle(srcfl, tgtfl, max_len=256, drop_tail=False):
+# digest_size: bytes of the digests of lines kept for deduplication instead of lines (8 or 16, i.e., 64/128-bit)
+# normalize: also remove lines which are identical after case folding and removing punctuation and spaces
+# minhash: (number of bands, rows per band) to remove near duplicates with MinHash/LSH over word n-grams (minhash_ngram) of normalized lines, lines sharing a band with a previous line are removed, the threshold of Jaccard similarity is about (1 / bands) ** (1 / rows). None to disable.
+# nproc: number of processes computing digests of chunks (chunk_size lines) of data, deduplication decisions are made in order by the main process.
 
-	_max_len = max(1, max_len - 2)
-	data = set()
+digest_size = 8
+normalize = False
+minhash = None#(16, 4,)
+minhash_ngram = 3
+minhash_seed = 666666
+nproc = 1
+chunk_size = 10000
+
+mersenne_prime = (1 << 61) - 1
+
+def digest(x, digest_size=digest_size):
+
+	return int.from_bytes(blake2b(x, digest_size=digest_size).digest(), "little")
+
+def norm_line(x):
+
+	return "".join(_ for _ in x.casefold() if not (_.isspace() or (category(_)[0] == "P")))
+
+class MinHasher:
+
+	def __init__(self, nband, nrow, ngram=minhash_ngram, seed=minhash_seed, digest_size=digest_size, **kwargs):
+
+		self.nband, self.nrow, self.ngram, self.digest_size = nband, nrow, ngram, digest_size
+		_rand = numpy.random.RandomState(seed)
+		_nperm = nband * nrow
+		# coefficients below 2 ** 32 keep a * h + b (h is a crc32 value) in uint64
+		self.a = _rand.randint(1, 1 << 32, size=(_nperm, 1,), dtype=numpy.uint64)
+		self.b = _rand.randint(0, 1 << 32, size=(_nperm, 1,), dtype=numpy.uint64)
+
+	def shingles(self, tokens):
+
+		_n = self.ngram
+		if len(tokens) <= _n:
+			return [" ".join(tokens)]
+
+		return [" ".join(tokens[_i:_i + _n]) for _i in range(len(tokens) - _n + 1)]
+
+	# return the LSH keys of bands of the MinHash signature of lines (a list of str)
+
+	def __call__(self, lines):
+
+		_h = numpy.array(list(set(crc32(_.encode("utf-8")) for _line in lines for _ in self.shingles([_t for _t in (norm_line(_w) for _w in _line.split()) if _t]))), dtype=numpy.uint64)
+		_sig = ((self.a * _h + self.b) % mersenne_prime).min(-1)
+		_nrow = self.nrow
+
+		return [digest(_sig[_i * _nrow:(_i + 1) * _nrow].tobytes(), digest_size=self.digest_size) for _i in range(self.nband)]
+
+# return None for filtered (empty or too long) lines, or (cleaned lines, the digest, the digest after normalization, the LSH keys of MinHash)
+
+def line_keys(lines, max_len=256, drop_tail=False, digest_size=digest_size, normalize=normalize, minhasher=None):
+
+	lines = [line.strip() for line in lines]
+	if all(lines):
+		lines, lens = zip(*[clean_liststr_lentok(line.decode("utf-8").split()) for line in lines])
+		if all_le(lens, max_len):
+			_klines = lines[:1] if drop_tail else lines
+			return tuple(line.encode("utf-8") for line in lines), digest("\n".join(_klines).encode("utf-8"), digest_size=digest_size), digest("\n".join(norm_line(_) for _ in _klines).encode("utf-8"), digest_size=digest_size) if normalize else None, None if minhasher is None else minhasher(_klines)
+
+	return None
+
+def chunk_keys(chunk, **kwargs):
+
+	return [line_keys(_, **kwargs) for _ in chunk]
+
+def iter_chunks(data, chunk_size=chunk_size):
+
+	return iter(lambda: list(islice(data, chunk_size)), [])
+
+def handle(srcfl, tgtfl, max_len=256, drop_tail=False, digest_size=digest_size, normalize=normalize, minhash=minhash, nproc=nproc):
+
+	_minhasher = None if minhash is None else MinHasher(*minhash, digest_size=digest_size)
+	_process = partial(chunk_keys, max_len=max_len, drop_tail=drop_tail, digest_size=digest_size, normalize=normalize, minhasher=_minhasher)
+	data, data_norm = set(), set()
+	data_band = None if _minhasher is None else [set() for _ in range(_minhasher.nband)]
+	nfilter = nexact = nnorm = nnear = nkeep = 0
 	ens = "\n".encode("utf-8")
 
 	with FileList(srcfl, "rb") as frl, FileList(tgtfl, "wb") as fwl:
-		if drop_tail:
-			for lines in zip(*frl):
-				lines = [line.strip() for line in lines]
-				if all(lines):
-					lines, lens = zip(*[clean_liststr_lentok(line.decode("utf-8").split()) for line in lines])
-					if all_le(lens, max_len):
-						tmp = lines[0].encode("utf-8")
-						if tmp not in data:
-							for du, f in zip(lines, fwl):
-								f.write(du.encode("utf-8"))
-								f.write(ens)
-							data.add(tmp)
-		else:
-			for lines in zip(*frl):
-				lines = [line.strip() for line in lines]
-				if all(lines):
-					lines, lens = zip(*[clean_liststr_lentok(line.decode("utf-8").split()) for line in lines])
-					if all_le(lens, max_len):
-						lines = tuple(line.encode("utf-8") for line in lines)
-						if lines not in data:
-							for du, f in zip(lines, fwl):
-								f.write(du)
-								f.write(ens)
-							data.add(lines)
+		_chunks = iter_chunks(zip(*frl))
+		_pool = Pool(nproc) if nproc > 1 else None
+		for _chunk_rs in (map(_process, _chunks) if _pool is None else _pool.imap(_process, _chunks)):
+			for _rs in _chunk_rs:
+				if _rs is None:
+					nfilter += 1
+					continue
+				lines, _k, _k_norm, _k_bands = _rs
+				if _k in data:
+					nexact += 1
+					continue
+				data.add(_k)
+				if _k_norm is not None:
+					if _k_norm in data_norm:
+						nnorm += 1
+						continue
+					data_norm.add(_k_norm)
+				if _k_bands is not None:
+					if any(_kb in _db for _kb, _db in zip(_k_bands, data_band)):
+						nnear += 1
+						continue
+					for _kb, _db in zip(_k_bands, data_band):
+						_db.add(_kb)
+				for du, f in zip(lines, fwl):
+					f.write(du)
+					f.write(ens)
+				nkeep += 1
+		if _pool is not None:
+			_pool.close()
+			_pool.join()
+
+	print("Total: %d, kept: %d, removed: %d empty/too long, %d exact duplicates, %d normalized duplicates, %d near duplicates" % (nfilter + nexact + nnorm + nnear + nkeep, nkeep, nfilter, nexact, nnorm, nnear,))
 
 if __name__ == "__main__":
 	_nargs = len(sys.argv)
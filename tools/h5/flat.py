@@ -0,0 +1,32 @@
+#encoding: utf-8
+
+""" this file converts HDF5 training data (generated by `tools/mkiodata.py`, `tools/plm/mkbart_data.py`, etc.) to the flat data format (`utils/fmt/flat.py`), which can be used in place of the HDF5 file in `cnfg/base.py` (train_data/dev_data) by training scripts. Usage:
+	python tools/h5/flat.py path/to/data.h5 path/to/rs/directory [pad_id]
+"""
+
+import numpy
+import sys
+from h5py import Group
+
+from utils.fmt.flat import FlatWriter
+from utils.h5serial import h5File
+from utils.tqdm import tqdm
+
+from cnfg.ihyp import *
+from cnfg.vocab.base import pad_id as pad_id_default
+
+def handle(h5f, rsf, pad_id=pad_id_default):
+
+	with h5File(h5f, "r") as td:
+		ndata = td["ndata"][()].item()
+		_keys = [_k for _k in td.keys() if isinstance(td[_k], Group)]
+		_data = {_k: td[_k][()].tolist() for _k in td.keys() if (_k not in _keys) and (_k != "ndata")}
+		_grps = [td[_k] for _k in _keys]
+		# tokens are stored with int32 (the dtype of loaded batches), so that batches without padding are loaded without copying
+		with FlatWriter(rsf, keys=_keys, dtype=numpy.int32, pad_id=pad_id, data=_data) as wrt:
+			for i in tqdm(range(ndata), mininterval=tqdm_mininterval):
+				_bid = str(i)
+				wrt.write(*[_g[_bid][()] for _g in _grps])
+
+if __name__ == "__main__":
+	handle(sys.argv[1], sys.argv[2], *[int(_) for _ in sys.argv[3:4]])
@@ -0,0 +1,74 @@
+#encoding: utf-8
+
+""" benchmark of sorting with `tools/lsort/` on a synthetic parallel corpus (with duplicated lines), reports the time and the peak memory (of the process and its workers) of partsort.py and merge.py. Usage:
+	python tools/lsort/bench.py $work_dir [$nlines (10000000)] [$cache_tokens (500000000)] [$nproc]
+"""
+
+import sys
+from multiprocessing import Process, Queue
+from os import makedirs
+from os.path import join as pjoin
+from random import choices, randint, random, seed as rpyseed
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from shutil import rmtree
+from time import time
+
+from merge import handle as merge
+from partsort import handle as partsort
+
+from utils.fmt.base import FileList
+
+vocab = ["w%d" % _ for _ in range(32000)]
+max_len = 64
+dup_ratio = 0.05
+
+def rand_line():
+
+	return " ".join(choices(vocab, k=randint(1, max_len))).encode("utf-8")
+
+def gen_data(srcf, tgtf, nlines):
+
+	ens = "\n".encode("utf-8")
+	_prev = None
+	with FileList([srcf, tgtf], "wb") as fl:
+		for _ in range(nlines):
+			_du = _prev if (_prev is not None) and (random() < dup_ratio) else (rand_line(), rand_line(),)
+			for _l, _f in zip(_du, fl):
+				_f.write(_l)
+				_f.write(ens)
+			_prev = _du
+
+def run_core(q, func, *args, **kwargs):
+
+	_st = time()
+	func(*args, **kwargs)
+	q.put((time() - _st, max(getrusage(RUSAGE_SELF).ru_maxrss, getrusage(RUSAGE_CHILDREN).ru_maxrss) / 1024.0,))
+
+# run func in a new process to measure its peak memory
+
+def run(func, *args, **kwargs):
+
+	_q = Queue()
+	_p = Process(target=run_core, args=(_q, func, *args,), kwargs=kwargs)
+	_p.start()
+	rs = _q.get()
+	_p.join()
+
+	return rs
+
+def handle(wkd, nlines=10000000, cache_token=500000000, nproc=None):
+
+	rpyseed(666666)
+	_cached = pjoin(wkd, "cache")
+	rmtree(_cached, ignore_errors=True)
+	makedirs(_cached)
+	srcf, tgtf, rs_srcf, rs_tgtf = pjoin(wkd, "src.txt"), pjoin(wkd, "tgt.txt"), pjoin(wkd, "src.srt"), pjoin(wkd, "tgt.srt")
+	_st = time()
+	gen_data(srcf, tgtf, nlines)
+	print("Generate %d lines: %.2fs" % (nlines, time() - _st,))
+	print("partsort.py: %.2fs, peak memory: %.1f MB" % run(partsort, [srcf, tgtf], _cached, cache_token=cache_token, nproc=nproc))
+	print("merge.py: %.2fs, peak memory: %.1f MB" % run(merge, _cached, [rs_srcf, rs_tgtf]))
+	rmtree(_cached, ignore_errors=True)
+
+if __name__ == "__main__":
+	handle(sys.argv[1], *[int(_) for _ in sys.argv[2:]])
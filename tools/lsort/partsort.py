@@ -1,45 +1,101 @@
 #encoding: utf-8
 
 import sys
+from multiprocessing import Pool
+from os import cpu_count
 from os.path import join as pjoin
 
-from utils.fmt.base import FileList, all_le, clean_liststr_lentok, dict_insert_list, dict_insert_set, iter_dict_sort
+from utils.fmt.base import FileList, all_le, clean_liststr_lentok
 
-def handle(srcfl, tgtd, max_len=256, remove_same=False, cache_token=500000000):
+# sort a chunk of lines in a worker process and write it to part files (tgtfl), lines are sorted by their sort keys (total length and lengths of sides from the last one), which can be recomputed from the cleaned lines by merge.py.
 
-	def save_cache(cache, tgtfl):
+def sort_chunk(lines, tgtfl, max_len=256, remove_same=False):
 
+	data = []
+	for _lines in lines:
+		_lines = [line.strip() for line in _lines]
+		if all(_lines):
+			_lines, lens = zip(*[clean_liststr_lentok(line.decode("utf-8").split()) for line in _lines])
+			if all_le(lens, max_len):
+				data.append(((sum(lens), *reversed(lens[1:]),), tuple(line.encode("utf-8") for line in _lines),))
+	if remove_same:
+		data = list(set(data))
+	data.sort(key=lambda x: x[0])
+	if data:
 		ens = "\n".encode("utf-8")
-
 		with FileList(tgtfl, "wb") as wfl:
-			for tmp in iter_dict_sort(cache, free=True):
-				lines = zip(*tmp)
-				for du, f in zip(lines, wfl):
-					f.write(ens.join(du))
-					f.write(ens)
+			for du, f in zip(zip(*[_[1] for _ in data]), wfl):
+				f.write(ens.join(du))
+				f.write(ens)
 
-	_max_len = max(1, max_len - 2)
+	return len(data)
 
-	_insert_func = dict_insert_set if remove_same else dict_insert_list
-	data = {}
-	mem_token = curf = 0
-	num_files = len(srcfl)
+# read lines of a chunk (starting at offsets, sizes bytes of each file) in the worker, so that only the offsets are passed from the main process
+
+def chunk_reader(srcfl, offsets, sizes):
+
+	_size = sizes[0]
 	with FileList(srcfl, "rb") as fl:
+		for f, offset in zip(fl, offsets):
+			f.seek(offset)
 		for lines in zip(*fl):
-			lines = [line.strip() for line in lines]
-			if all(lines):
-				lines, lens = zip(*[clean_liststr_lentok(line.decode("utf-8").split()) for line in lines])
-				if all_le(lens, max_len):
-					lgth = sum(lens)
-					data = _insert_func(data, tuple(line.encode("utf-8") for line in lines), lgth, *reversed(lens[1:]))
-					mem_token += lgth
-					if mem_token >= cache_token:
-						save_cache(data, [pjoin(tgtd, "%d.%d.txt" % (i, curf,)) for i in range(num_files)])
-						data = {}
-						mem_token = 0
-						curf += 1
-	if data:
-		save_cache(data, [pjoin(tgtd, "%d.%d.txt" % (i, curf,)) for i in range(num_files)])
+			yield lines
+			_size -= len(lines[0])
+			if _size <= 0:
+				break
+
+def sort_file_chunk(srcfl, offsets, sizes, tgtfl, **kwargs):
+
+	return sort_chunk(chunk_reader(srcfl, offsets, sizes), tgtfl, **kwargs)
+
+def is_seekable(fname):
+
+	return not ((fname == "-") or fname.endswith((".gz", ".bz2", ".xz",)))
+
+# the main process scans lines and splits them into chunks of about cache_token / (nproc + 1) tokens (counted by spaces), which are cleaned, filtered and sorted by nproc worker processes in parallel. Workers read their chunks from uncompressed files by offsets, while lines of chunks are sent to workers for compressed files, at most nproc + 1 chunks are in memory.
+
+def handle(srcfl, tgtd, max_len=256, remove_same=False, cache_token=500000000, nproc=None):
+
+	_nproc = max(cpu_count() if nproc is None else nproc, 1)
+	_chunk_token = max(cache_token // (_nproc + 1), 1)
+	num_files = len(srcfl)
+	_seek = all(is_seekable(_) for _ in srcfl)
+	_kwargs = {"max_len": max_len, "remove_same": remove_same}
+	_pending = []
+	chunk = None if _seek else []
+	offsets = [0 for _ in srcfl]
+	sizes = [0 for _ in srcfl]
+	mem_token = curf = 0
+
+	def submit(pool):
+
+		if len(_pending) > _nproc:
+			_pending.pop(0).get()
+		_tgtfl = [pjoin(tgtd, "%d.%d.txt" % (i, curf,)) for i in range(num_files)]
+		_pending.append(pool.apply_async(sort_file_chunk, (srcfl, tuple(offsets), tuple(sizes), _tgtfl,), _kwargs) if _seek else pool.apply_async(sort_chunk, (chunk, _tgtfl,), _kwargs))
+
+	with FileList(srcfl, "rb") as fl, Pool(_nproc) as pool:
+		for lines in zip(*fl):
+			if _seek:
+				for _i, line in enumerate(lines):
+					sizes[_i] += len(line)
+			else:
+				chunk.append(lines)
+			mem_token += sum(line.count(b" ") + 1 for line in lines)
+			if mem_token >= _chunk_token:
+				submit(pool)
+				if _seek:
+					for _i, _size in enumerate(sizes):
+						offsets[_i] += _size
+						sizes[_i] = 0
+				else:
+					chunk = []
+				mem_token = 0
+				curf += 1
+		if mem_token > 0:
+			submit(pool)
+		for _ in _pending:
+			_.get()
 
 if __name__ == "__main__":
 	handle(sys.argv[1:-2], sys.argv[-2], int(sys.argv[-1]))
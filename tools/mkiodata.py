@@ -1,15 +1,46 @@
 #encoding: utf-8
 
 import sys
+from multiprocessing import Pool
 from numpy import array as np_array, int32 as np_int32
+from os import remove
 
-from utils.fmt.dual import batch_padder
+from utils.fmt.base import list_reader
+from utils.fmt.dual import batch_array_padder, batch_loader
+from utils.fmt.shard import merge_h5, plan_shards, range_reader
 from utils.fmt.vocab.token import ldvocab
 from utils.h5serial import h5File
 
 from cnfg.ihyp import *
 
-def handle(finput, ftarget, fvocab_i, fvocab_t, frs, minbsize=1, expand_for_mulgpu=True, bsize=max_sentences_gpu, maxpad=max_pad_tokens_sentence, maxpart=normal_tokens_vs_pad_tokens, maxtoken=max_tokens_gpu, minfreq=False, vsize=False):
+def write_batches(rsf, batches):
+
+	src_grp = rsf.create_group("src")
+	tgt_grp = rsf.create_group("tgt")
+	curd = 0
+	for i_d, td in batches:
+		rid = np_array(i_d, dtype=np_int32)
+		rtd = np_array(td, dtype=np_int32)
+		#rld = np_array(ld, dtype=np_int32)
+		wid = str(curd)
+		src_grp.create_dataset(wid, data=rid, **h5datawargs)
+		tgt_grp.create_dataset(wid, data=rtd, **h5datawargs)
+		#rsf["l" + wid] = rld
+		curd += 1
+	rsf["ndata"] = np_array([curd], dtype=np_int32)
+
+	return curd
+
+# build the batches of lines [start, end) into the shard file frs in a worker process
+
+def handle_shard(finput, ftarget, fvocab_i, fvocab_t, frs, start, end, minbsize, bsize, maxpad, maxpart, maxtoken, minfreq, vsize):
+
+	vcbi = ldvocab(fvocab_i, minf=minfreq, omit_vsize=vsize, vanilla=False)[0]
+	vcbt = ldvocab(fvocab_t, minf=minfreq, omit_vsize=vsize, vanilla=False)[0]
+	with h5File(frs, "w", libver=h5_libver) as rsf:
+		return write_batches(rsf, batch_array_padder(finput, ftarget, vcbi, vcbt, bsize, maxpad, maxpart, maxtoken, minbsize, file_reader=range_reader(list_reader, start, end)))
+
+def handle(finput, ftarget, fvocab_i, fvocab_t, frs, minbsize=1, expand_for_mulgpu=True, bsize=max_sentences_gpu, maxpad=max_pad_tokens_sentence, maxpart=normal_tokens_vs_pad_tokens, maxtoken=max_tokens_gpu, minfreq=False, vsize=False, nproc=1):
 	vcbi, nwordi = ldvocab(fvocab_i, minf=minfreq, omit_vsize=vsize, vanilla=False)
 	vcbt, nwordt = ldvocab(fvocab_t, minf=minfreq, omit_vsize=vsize, vanilla=False)
 	if expand_for_mulgpu:
@@ -18,22 +49,23 @@ def handle(finput, ftarget, fvocab_i, fvocab_t, frs, minbsize=1, expand_for_mulg
 	else:
 		_bsize = bsize
 		_maxtoken = maxtoken
-	with h5File(frs, "w", libver=h5_libver) as rsf:
-		src_grp = rsf.create_group("src")
-		tgt_grp = rsf.create_group("tgt")
-		curd = 0
-		for i_d, td in batch_padder(finput, ftarget, vcbi, vcbt, _bsize, maxpad, maxpart, _maxtoken, minbsize):
-			rid = np_array(i_d, dtype=np_int32)
-			rtd = np_array(td, dtype=np_int32)
-			#rld = np_array(ld, dtype=np_int32)
-			wid = str(curd)
-			src_grp.create_dataset(wid, data=rid, **h5datawargs)
-			tgt_grp.create_dataset(wid, data=rtd, **h5datawargs)
-			#rsf["l" + wid] = rld
-			curd += 1
-		rsf["ndata"] = np_array([curd], dtype=np_int32)
-		rsf["nword"] = np_array([nwordi, nwordt], dtype=np_int32)
+	if nproc > 1:
+		# batches are split into shards of consecutive batches, which are built and compressed in parallel and then merged in order into frs, the result is the same as the single-process one.
+		_shards = plan_shards(nproc, finput, ftarget, _bsize, maxpad, maxpart, _maxtoken, minbsize, batch_loader=batch_loader)
+		_fshards = ["%s.%d.shard" % (frs, _i,) for _i in range(len(_shards))]
+		with Pool(len(_shards)) as pool:
+			pool.starmap(handle_shard, [(finput, ftarget, fvocab_i, fvocab_t, _fshard, _start, _end, minbsize, _bsize, maxpad, maxpart, _maxtoken, minfreq, vsize,) for _fshard, (_start, _end, _,) in zip(_fshards, _shards)])
+		curd = merge_h5(frs, _fshards, keys=("src", "tgt",))
+		for _ in _fshards:
+			remove(_)
+		with h5File(frs, "a", libver=h5_libver) as rsf:
+			rsf["ndata"] = np_array([curd], dtype=np_int32)
+			rsf["nword"] = np_array([nwordi, nwordt], dtype=np_int32)
+	else:
+		with h5File(frs, "w", libver=h5_libver) as rsf:
+			curd = write_batches(rsf, batch_array_padder(finput, ftarget, vcbi, vcbt, _bsize, maxpad, maxpart, _maxtoken, minbsize))
+			rsf["nword"] = np_array([nwordi, nwordt], dtype=np_int32)
 	print("Number of batches: %d\nSource Vocabulary Size: %d\nTarget Vocabulary Size: %d" % (curd, nwordi, nwordt,))
 
 if __name__ == "__main__":
-	handle(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], int(sys.argv[6]))
+	handle(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], int(sys.argv[6]), nproc=int(sys.argv[7]) if len(sys.argv) > 7 else 1)
@@ -10,4 +10,4 @@ def handle(*inputs, **kwargs):
 	return map_func(*inputs, **kwargs, Tokenizer=Tokenizer)
 
 if __name__ == "__main__":
-	handle(sys.argv[1], sys.argv[2], sys.argv[3])
+	handle(sys.argv[1], sys.argv[2], sys.argv[3], nproc=int(sys.argv[4]) if len(sys.argv) > 4 else 1)
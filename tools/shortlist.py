@@ -0,0 +1,73 @@
+#encoding: utf-8
+
+""" this file builds the lexical shortlist (`utils/decode/shortlist.py`) from the co-occurrence of source and target tokens in the training set (HDF5 data generated by `tools/mkiodata.py`), set `shortlist` in `cnfg/base.py` to the result file to use it in decoding. Usage:
+	python tools/shortlist.py path/to/train.h5 path/to/shortlist.h5 [number of candidates per source token] [number of most frequent target tokens]
+"""
+
+import sys
+import torch
+from numpy import array as np_array, int32 as np_int32
+
+from utils.h5serial import h5File
+from utils.tqdm import tqdm
+
+from cnfg.ihyp import *
+from cnfg.vocab.base import init_normal_token_id, pad_id
+
+# merge co-occurrence counts of pair keys every merge_every batches to bound memory consumption
+merge_every = 64
+
+def merge_counts(keys, counts, new_keys):
+
+	_keys = torch.cat([keys] + new_keys, 0) if keys is not None else torch.cat(new_keys, 0)
+	_counts = torch.cat((counts, torch.ones(_keys.size(0) - counts.size(0), dtype=counts.dtype),), 0) if counts is not None else torch.ones(_keys.size(0), dtype=torch.long)
+	_keys, _inv = _keys.unique(sorted=True, return_inverse=True)
+
+	return _keys, _counts.new_zeros(_keys.size(0)).index_add_(0, _inv, _counts)
+
+def handle(h5f, rsf, k=64, ncommon=256, nspecial=init_normal_token_id):
+
+	with h5File(h5f, "r") as td:
+		ntrain = td["ndata"][()].item()
+		nwordi, nwordt = td["nword"][()].tolist()[:2]
+		src_grp, tgt_grp = td["src"], td["tgt"]
+		# co-occurrence counts of source-target token pairs (keys: src * nwordt + tgt) and numbers of sentences containing each target token
+		keys = counts = None
+		tgt_freq = torch.zeros(nwordt, dtype=torch.long)
+		_new_keys = []
+		for i in tqdm(range(ntrain), mininterval=tqdm_mininterval):
+			_bid = str(i)
+			for _src, _tgt in zip(torch.from_numpy(src_grp[_bid][()]).long().unbind(0), torch.from_numpy(tgt_grp[_bid][()]).long().unbind(0)):
+				_src, _tgt = _src[_src.ge(nspecial)].unique(), _tgt[_tgt.ge(nspecial)].unique()
+				if (_src.numel() > 0) and (_tgt.numel() > 0):
+					tgt_freq.index_add_(0, _tgt, torch.ones(_tgt.size(0), dtype=torch.long))
+					_new_keys.append((_src.unsqueeze(1) * nwordt + _tgt.unsqueeze(0)).view(-1))
+			if ((i + 1) % merge_every == 0) and _new_keys:
+				keys, counts = merge_counts(keys, counts, _new_keys)
+				_new_keys = []
+		if _new_keys:
+			keys, counts = merge_counts(keys, counts, _new_keys)
+
+	rs = torch.full((nwordi, k,), pad_id, dtype=torch.long)
+	if keys is not None:
+		_src, _tgt = keys.div(nwordt, rounding_mode="floor"), keys.remainder(nwordt)
+		# association score: p(t|s) * p(s|t) ~ c(s, t) ^ 2 / c(t), prefers target tokens specific to the source token over frequent ones (which are covered by the most frequent target tokens)
+		_scores = counts.double().pow(2) / tgt_freq.index_select(0, _tgt).double()
+		# sort by source token, and then by score (descending) for each source token
+		_ind = _scores.argsort(descending=True)
+		_ind = _ind.index_select(0, _src.index_select(0, _ind).argsort(stable=True))
+		_src, _tgt = _src.index_select(0, _ind), _tgt.index_select(0, _ind)
+		_stoks, _scnt = _src.unique_consecutive(return_counts=True)
+		for _s, _t in zip(_stoks.tolist(), _tgt.split(_scnt.tolist())):
+			_n = min(k, _t.size(0))
+			rs[_s, :_n] = _t[:_n]
+
+	_common = tgt_freq.narrow(0, nspecial, nwordt - nspecial).topk(min(ncommon, nwordt - nspecial))[1] + nspecial
+
+	with h5File(rsf, "w", libver=h5_libver) as f:
+		f.create_dataset("shortlist", data=rs.to(torch.int32).numpy(), **h5datawargs)
+		f.create_dataset("common", data=_common.to(torch.int32).numpy(), **h5datawargs)
+		f["nword"] = np_array([nwordi, nwordt], dtype=np_int32)
+
+if __name__ == "__main__":
+	handle(sys.argv[1], sys.argv[2], *[int(_) for _ in sys.argv[3:5]])
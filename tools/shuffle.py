@@ -1,26 +1,88 @@
 #encoding: utf-8
 
 import sys
-from random import seed as rpyseed, shuffle
+from multiprocessing import Pool
+from os import remove
+from os.path import dirname
+from random import Random
+from shutil import copyfileobj, rmtree
+from tempfile import mkdtemp
 
-from utils.fmt.base import FileList, clean_str, sys_open
+from utils.fmt.base import FileList, clean_str
 
-def handle(srcfl, rsfl):
+# out-of-core shuffle: aligned lines are scattered into nbucket temporary bucket files by random keys, then each bucket is shuffled in memory and they are concatenated, so that only one bucket (of each process) is kept in memory. Buckets are shuffled by nproc processes in parallel if nproc > 1. Results are decided by seed, regardless of nproc.
+
+nbucket = 64
+nproc = 1
+seed = 666666
+
+def bucket_files(tmpd, i, num_files, suffix="txt"):
+
+	return ["%s/%d.%d.%s" % (tmpd, i, _, suffix,) for _ in range(num_files)]
+
+def load_bucket(srcfl, seed):
 
-	data = []
 	with FileList(srcfl, "rb") as files:
-		for lines in zip(*files):
-			data.append([clean_str(tmpu.strip().decode("utf-8")) for tmpu in lines])
+		rs = list(zip(*files))
+	Random(seed).shuffle(rs)
+
+	return rs
+
+def write_bucket(data, files):
+
+	for du, f in zip(zip(*data), files):
+		f.write(b"".join(du))
 
-	shuffle(data)
+def shuffle_bucket(srcfl, rsfl, seed):
 
+	with FileList(rsfl, "wb") as files:
+		write_bucket(load_bucket(srcfl, seed), files)
+
+	return rsfl
+
+def shuffle_bucket_args(args):
+
+	return shuffle_bucket(*args)
+
+def handle(srcfl, rsfl, nbucket=nbucket, nproc=nproc, seed=seed):
+
+	num_files = len(srcfl)
+	tmpd = mkdtemp(dir=dirname(rsfl[0]) or None)
 	ens = "\n".encode("utf-8")
-	for du, rsf in zip(zip(*data), rsfl):
-		with sys_open(rsf, "wb") as fwrt:
-			fwrt.write("\n".join(du).encode("utf-8"))
-			fwrt.write(ens)
+	_rand = Random(seed)
+	_bucketfl = [bucket_files(tmpd, _, num_files) for _ in range(nbucket)]
+	_bucket_out = []
+	try:
+		try:
+			for _ in _bucketfl:
+				_bucket_out.append(FileList(_, "wb"))
+			with FileList(srcfl, "rb") as files:
+				for lines in zip(*files):
+					for tmpu, f in zip(lines, _bucket_out[_rand.randrange(nbucket)]):
+						f.write(clean_str(tmpu.strip().decode("utf-8")).encode("utf-8"))
+						f.write(ens)
+		finally:
+			for _ in _bucket_out:
+				for _f in _:
+					_f.close()
+			_bucket_out = None
+
+		_args = [(_srcfl, bucket_files(tmpd, _i, num_files, suffix="shuf"), seed + _i + 1,) for _i, _srcfl in enumerate(_bucketfl)]
+		with FileList(rsfl, "wb") as wfl:
+			if nproc > 1:
+				with Pool(nproc) as pool:
+					for _shuffl in pool.imap(shuffle_bucket_args, _args):
+						with FileList(_shuffl, "rb") as rfl:
+							for _rf, _wf in zip(rfl, wfl):
+								copyfileobj(_rf, _wf)
+						for _ in _shuffl:
+							remove(_)
+			else:
+				for _srcfl, _, _seed in _args:
+					write_bucket(load_bucket(_srcfl, _seed), wfl)
+	finally:
+		rmtree(tmpd, ignore_errors=True)
 
 if __name__ == "__main__":
-	rpyseed(666666)
 	_ind = (len(sys.argv) + 1) // 2
 	handle(sys.argv[1:_ind], sys.argv[_ind:])
@@ -5,9 +5,10 @@ from random import shuffle
 #from torch import nn
 from torch.optim import Adam as Optimizer
 
-from loss.base import LabelSmoothingLoss
+from loss.base import FusedLabelSmoothingLoss, LabelSmoothingLoss
 from lrsch import GoogleLR as LRScheduler
 from parallel.base import DataParallelCriterion
+from parallel.dist import DistributedModel, HostAllReduce, all_reduce_host, close_dist, grad_sync, init_dist, is_dist_launched, master_only, rank_fname, shard_list, shard_start
 from parallel.optm import MultiGPUGradScaler
 from parallel.parallelMT import DataParallelMT
 from transformer.NMT import NMT
@@ -15,9 +16,12 @@ from utils.base import free_cache, get_logger, mkdir, set_random_seed
 from utils.contpara import get_model_parameters
 from utils.fmt.base import iter_to_str
 from utils.fmt.base4torch import load_emb, parse_cuda
-from utils.h5serial import h5File
+from utils.fmt.flat import FlatData, open_data
+from utils.fmt.pack import Packer
+from utils.fmt.rebatch import Rebatcher
 from utils.init.base import init_model_params
 from utils.io import load_model_cpu, save_model, save_states
+from utils.prefetch import BatchPrefetcher
 from utils.state.holder import Holder
 from utils.state.pyrand import PyRandomState
 from utils.state.thrand import THRandomState
@@ -25,6 +29,8 @@ from utils.torch.comp import torch_autocast, torch_compile, torch_inference_mode
 from utils.tqdm import tqdm
 from utils.train.base import getlr, optm_step, optm_step_zero_grad_set_none, reset_Adam
 from utils.train.dss import dynamic_sample
+from utils.train.metric import MetricAccumulator
+from utils.train.telemetry import Telemetry
 
 import cnfg.base as cnfg
 from cnfg.ihyp import *
@@ -32,48 +38,58 @@ from cnfg.vocab.base import pad_id
 
 def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tokens, multi_gpu, multi_gpu_optimizer, tokens_optm=32768, nreport=None, save_every=None, chkpf=None, state_holder=None, statesf=None, num_checkpoint=1, cur_checkid=0, report_eva=True, remain_steps=None, save_loss=False, save_checkp_epoch=False, scaler=None):
 
-	sum_loss = part_loss = 0.0
-	sum_wd = part_wd = 0
 	_done_tokens, _cur_checkid, _cur_rstep, _use_amp = done_tokens, cur_checkid, remain_steps, scaler is not None
 	global minerr, minloss, wkdir, save_auto_clean, namin
 	model.train()
-	cur_b, _ls = 1, {} if save_loss else None
-	src_grp, tgt_grp = td["src"], td["tgt"]
-	for i_d in tqdm(tl, mininterval=tqdm_mininterval):
-		seq_batch = torch.from_numpy(src_grp[i_d][()])
-		seq_o = torch.from_numpy(tgt_grp[i_d][()])
+	cur_b, metrics = 1, MetricAccumulator(save_loss=save_loss, distributed=dist_training)
+	data_loader = BatchPrefetcher(td, shard_list(tl), ("src", "tgt",), pin_memory=mv_device is not None)
+	packer = Packer(pad_id=pad_id) if packed_training else None
+	telemetry.tick()
+	for i_d, seq_batch, seq_o in tqdm(data_loader, mininterval=tqdm_mininterval):
+		# count target tokens on the host before moving data, each sentence starts with <sos> which is not a target
+		wd_add = seq_o.ne(pad_id).int().sum().item() - seq_o.size(0)
+		_wd_all = HostAllReduce(wd_add) if dist_training else None
+		if packer is not None:
+			seq_batch, seq_o, _pack = packer(seq_batch, seq_o)
+		telemetry.add_batch(seq_batch, seq_o)
 		lo = seq_o.size(1) - 1
 		if mv_device:
 			seq_batch = seq_batch.to(mv_device, non_blocking=True)
 			seq_o = seq_o.to(mv_device, non_blocking=True)
 		seq_batch, seq_o = seq_batch.long(), seq_o.long()
+		telemetry.tick("data")
 
 		oi = seq_o.narrow(1, 0, lo)
 		ot = seq_o.narrow(1, 1, lo).contiguous()
-		with torch_autocast(enabled=_use_amp):
-			output = model(seq_batch, oi)
-			loss = lossf(output, ot)
-			if multi_gpu:
-				loss = loss.sum()
-		loss_add = loss.data.item()
-
-		# scale the sum of losses down according to the number of tokens adviced by: https://mp.weixin.qq.com/s/qAHZ4L5qK3rongCIIq5hQw, I think not reasonable.
-		#loss /= wd_add
-		if scaler is None:
-			loss.backward()
+		if packer is None:
+			_pack_kwargs = {}
 		else:
-			scaler.scale(loss).backward()
+			ot, _pack_kwargs = packer.model_kwargs(_pack, ot, device=mv_device)
+		# the number of target tokens of all processes decides optimizer steps consistently across processes, gradients are only all-reduced in the backward pass of the last batch before each optimizer step
+		_wd_step = wd_add if _wd_all is None else _wd_all.wait()[0]
+		with grad_sync(model, (_done_tokens + _wd_step) >= tokens_optm):
+			with torch_autocast(enabled=_use_amp):
+				output = model(seq_batch, oi, word_prediction="fused" if fused_loss else True, **_pack_kwargs)
+				loss = lossf(output, ot)
+				if multi_gpu:
+					loss = loss.sum()
+			metrics.add(loss, wd_add, key=i_d)
+			telemetry.tick("forward")
+
+			# scale the sum of losses down according to the number of tokens adviced by: https://mp.weixin.qq.com/s/qAHZ4L5qK3rongCIIq5hQw, I think not reasonable.
+			#loss /= wd_add
+			if scaler is None:
+				loss.backward()
+			else:
+				scaler.scale(loss).backward()
+		telemetry.tick("backward")
 
-		wd_add = ot.ne(pad_id).int().sum().item()
 		loss = output = oi = ot = seq_batch = seq_o = None
-		sum_loss += loss_add
-		if save_loss:
-			_ls[i_d] = loss_add / wd_add
-		sum_wd += wd_add
-		_done_tokens += wd_add
+		_done_tokens += _wd_step
 
 		if _done_tokens >= tokens_optm:
 			optm_step(optm, model=model, scaler=scaler, multi_gpu=multi_gpu, multi_gpu_optimizer=multi_gpu_optimizer, zero_grad_none=optm_step_zero_grad_set_none)
+			telemetry.tick("optimizer")
 			_done_tokens = 0
 			if _cur_rstep is not None:
 				if save_checkp_epoch and (save_every is not None) and (_cur_rstep % save_every == 0) and (chkpf is not None) and (_cur_rstep > 0):
@@ -83,26 +99,28 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 						_cur_checkid = (_cur_checkid + 1) % num_checkpoint
 					else:
 						_chkpf = chkpf
-					save_model(model, _chkpf, multi_gpu, print_func=logger.info)
+					save_model(model, _chkpf, multi_gpu or dist_training, print_func=logger.info)
 					if statesf is not None:
-						save_states(state_holder.state_dict(update=False, **{"remain_steps": _cur_rstep, "checkpoint_id": _cur_checkid, "training_list": tl[cur_b - 1:]}), statesf, print_func=logger.info)
+						save_states(state_holder.state_dict(update=False, **{"remain_steps": _cur_rstep, "checkpoint_id": _cur_checkid, "training_list": tl[shard_start(cur_b - 1):]}), statesf, print_func=logger.info)
+					telemetry.tick("save")
 				_cur_rstep -= 1
 				if _cur_rstep <= 0:
 					break
 			lrsch.step()
 
 		if nreport is not None:
-			part_loss += loss_add
-			part_wd += wd_add
 			if cur_b % nreport == 0:
+				part_loss, part_wd = metrics.report()
 				if report_eva:
 					_leva, _eeva = eva(ed, nd, model, lossf, mv_device, multi_gpu, _use_amp)
+					telemetry.tick("eva")
 					logger.info("Average loss over %d tokens: %.3f, valid loss/error: %.3f %.2f" % (part_wd, part_loss / part_wd, _leva, _eeva,))
 					if (_eeva < minerr) or (_leva < minloss):
-						save_model(model, wkdir + "eva_%.3f_%.2f.h5" % (_leva, _eeva,), multi_gpu, print_func=logger.info, mtyp="ieva" if save_auto_clean else None)
+						save_model(model, wkdir + "eva_%.3f_%.2f.h5" % (_leva, _eeva,), multi_gpu or dist_training, print_func=logger.info, mtyp="ieva" if save_auto_clean else None)
 						if statesf is not None:
-							save_states(state_holder.state_dict(update=False, **{"remain_steps": _cur_rstep, "checkpoint_id": _cur_checkid, "training_list": tl[cur_b - 1:]}), statesf, print_func=logger.info)
-						logger.info("New best model saved")
+							save_states(state_holder.state_dict(update=False, **{"remain_steps": _cur_rstep, "checkpoint_id": _cur_checkid, "training_list": tl[shard_start(cur_b - 1):]}), statesf, print_func=logger.info)
+						telemetry.tick("save")
+						save_logger("New best model saved")
 						namin = 0
 						if _eeva < minerr:
 							minerr = _eeva
@@ -112,8 +130,7 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 					model.train()
 				else:
 					logger.info("Average loss over %d tokens: %.3f" % (part_wd, part_loss / part_wd,))
-				part_loss = 0.0
-				part_wd = 0
+				telemetry.report(cur_b)
 
 		if save_checkp_epoch and (_cur_rstep is None) and (save_every is not None) and (cur_b % save_every == 0) and (chkpf is not None) and (cur_b < ntrain):
 			if num_checkpoint > 1:
@@ -123,13 +140,23 @@ def train(td, tl, ed, nd, optm, lrsch, model, lossf, mv_device, logger, done_tok
 			else:
 				_chkpf = chkpf
 			#save_model(model, _chkpf, isinstance(model, nn.DataParallel), print_func=logger.info)
-			save_model(model, _chkpf, multi_gpu, print_func=logger.info)
+			save_model(model, _chkpf, multi_gpu or dist_training, print_func=logger.info)
 			if statesf is not None:
-				save_states(state_holder.state_dict(update=False, **{"remain_steps": _cur_rstep, "checkpoint_id": _cur_checkid, "training_list": tl[cur_b - 1:]}), statesf, print_func=logger.info)
+				save_states(state_holder.state_dict(update=False, **{"remain_steps": _cur_rstep, "checkpoint_id": _cur_checkid, "training_list": tl[shard_start(cur_b - 1):]}), statesf, print_func=logger.info)
+			telemetry.tick("save")
 		cur_b += 1
-	if part_wd != 0.0:
-		logger.info("Average loss over %d tokens: %.3f" % (part_wd, part_loss / part_wd,))
-	return sum_loss / sum_wd, _done_tokens, _cur_checkid, _cur_rstep, _ls
+	data_loader.close()
+	if nreport is not None:
+		part_loss, part_wd = metrics.report()
+		if part_wd != 0.0:
+			logger.info("Average loss over %d tokens: %.3f" % (part_wd, part_loss / part_wd,))
+	logger.info(data_loader.report())
+	if packer is not None:
+		logger.info(packer.report())
+	if telemetry.nbatch > 0:
+		telemetry.report()
+	sum_loss, sum_wd = metrics.total()
+	return sum_loss / sum_wd, _done_tokens, _cur_checkid, _cur_rstep, metrics.ls
 
 def eva(ed, nd, model, lossf, mv_device, multi_gpu, use_amp=False):
 	r = w = 0
@@ -137,7 +164,7 @@ def eva(ed, nd, model, lossf, mv_device, multi_gpu, use_amp=False):
 	model.eval()
 	src_grp, tgt_grp = ed["src"], ed["tgt"]
 	with torch_inference_mode():
-		for i in tqdm(range(nd), mininterval=tqdm_mininterval):
+		for i in tqdm(shard_list(range(nd), even=False), mininterval=tqdm_mininterval):
 			bid = str(i)
 			seq_batch = torch.from_numpy(src_grp[bid][()])
 			seq_o = torch.from_numpy(tgt_grp[bid][()])
@@ -161,6 +188,8 @@ def eva(ed, nd, model, lossf, mv_device, multi_gpu, use_amp=False):
 			w += data_mask.int().sum().item()
 			r += correct.sum().item()
 			correct = data_mask = trans = loss = output = ot = seq_batch = seq_o = None
+	if dist_training:
+		sum_loss, w, r = all_reduce_host(sum_loss, w, r)
 	w = float(w)
 	return sum_loss / w, (w - r) / w * 100.0
 
@@ -204,15 +233,22 @@ if save_every is not None:
 if cnfg.save_train_state:
 	statesf = wkdir + "train.states.t7"
 
-logger = get_logger(wkdir + "train.log")
-
-use_cuda, cuda_device, cuda_devices, multi_gpu = parse_cuda(cnfg.use_cuda, cnfg.gpuid)
+dist_training = is_dist_launched()
+if dist_training:
+	use_cuda, cuda_device, cuda_devices, multi_gpu = init_dist(cnfg.use_cuda, cnfg.gpuid)
+	save_model, save_states = master_only(save_model), master_only(save_states)
+else:
+	use_cuda, cuda_device, cuda_devices, multi_gpu = parse_cuda(cnfg.use_cuda, cnfg.gpuid)
 multi_gpu_optimizer = multi_gpu and cnfg.multi_gpu_optimizer
 
+logger = get_logger(rank_fname(wkdir + "train.log"))
+# models are only saved by the first process, and so are messages about saving them
+save_logger = master_only(logger.info)
+
 set_random_seed(cnfg.seed, use_cuda)
 
-td = h5File(cnfg.train_data, "r")
-vd = h5File(cnfg.dev_data, "r")
+td = open_data(cnfg.train_data)
+vd = open_data(cnfg.dev_data)
 
 ntrain = td["ndata"][()].item()
 nvalid = vd["ndata"][()].item()
@@ -220,6 +256,12 @@ nword = td["nword"][()].tolist()
 nwordi, nwordt = nword[0], nword[-1]
 
 tl = [str(i) for i in range(ntrain)]
+rebatcher = None
+if dynamic_rebatch:
+	if isinstance(td, FlatData):
+		rebatcher = Rebatcher(td, minbsize=len(cuda_devices) if multi_gpu else 1)
+	else:
+		logger.warning("dynamic_rebatch requires the flat data format (tools/h5/flat.py), the fixed batches of the HDF5 training data are used")
 
 logger.info("Design models with seed: %d" % torch.initial_seed())
 mymodel = NMT(cnfg.isize, nwordi, nwordt, cnfg.nlayer, cnfg.ff_hsize, cnfg.drop, cnfg.attn_drop, cnfg.act_drop, cnfg.share_emb, cnfg.nhead, cache_len_default, cnfg.attn_hsize, cnfg.norm_output, cnfg.bindDecoderEmb, cnfg.forbidden_indexes)
@@ -234,7 +276,7 @@ if fine_tune_m is not None:
 	mymodel.apply(load_fixing)
 
 #lossf = NLLLoss(ignore_index=pad_id, reduction="sum")
-lossf = LabelSmoothingLoss(nwordt, cnfg.label_smoothing, ignore_index=pad_id, reduction="sum", forbidden_index=cnfg.forbidden_indexes)
+lossf = (FusedLabelSmoothingLoss if fused_loss else LabelSmoothingLoss)(nwordt, cnfg.label_smoothing, ignore_index=pad_id, reduction="sum", forbidden_index=cnfg.forbidden_indexes)
 
 if cnfg.src_emb is not None:
 	logger.info("Load source embedding from: " + cnfg.src_emb)
@@ -254,6 +296,8 @@ if multi_gpu:
 	#mymodel = nn.DataParallel(mymodel, device_ids=cuda_devices, output_device=cuda_device.index)
 	mymodel = DataParallelMT(mymodel, device_ids=cuda_devices, output_device=cuda_device.index, host_replicate=True, gather_output=False)
 	lossf = DataParallelCriterion(lossf, device_ids=cuda_devices, output_device=cuda_device.index, replicate_once=True)
+elif dist_training:
+	mymodel = DistributedModel(mymodel, device=cuda_device)
 
 if multi_gpu:
 	optimizer = mymodel.build_optimizer(Optimizer, lr=init_lr, betas=adam_betas_default, eps=ieps_adam_default, weight_decay=cnfg.weight_decay, amsgrad=use_ams, multi_gpu_optimizer=multi_gpu_optimizer, contiguous_parameters=contiguous_parameters)
@@ -270,6 +314,8 @@ lossf = torch_compile(lossf, *torch_compile_args, **torch_compile_kwargs)
 
 state_holder = None if statesf is None and cnt_states is None else Holder(**{"optm": optimizer, "lrsch": lrsch, "pyrand": PyRandomState(), "thrand": THRandomState(use_cuda=use_cuda)})
 
+telemetry = Telemetry(logger=logger, jsonf=rank_fname(wkdir + "telemetry.jsonl"), device=cuda_device, optm=optimizer, pad_id=pad_id)
+
 num_checkpoint = cnfg.num_checkpoint
 cur_checkid = 0
 
@@ -279,26 +325,32 @@ minloss, minerr = eva(vd, nvalid, mymodel, lossf, cuda_device, multi_gpu, use_am
 logger.info("Init lr: %s, Dev Loss/Error: %.3f %.2f" % (" ".join(iter_to_str(getlr(optimizer))), minloss, minerr,))
 
 if fine_tune_m is None:
-	save_model(mymodel, wkdir + "init.h5", multi_gpu, print_func=logger.info)
-	logger.info("Initial model saved")
+	save_model(mymodel, wkdir + "init.h5", multi_gpu or dist_training, print_func=logger.info)
+	save_logger("Initial model saved")
 else:
 	if cnt_states is not None:
 		logger.info("Loading training states")
 		_remain_states = state_holder.load_state_dict(torch.load(cnt_states))
 		remain_steps, cur_checkid = _remain_states["remain_steps"], _remain_states["checkpoint_id"]
-		if "training_list" in _remain_states:
+		# batch keys in the saved training list are only valid for fixed batches
+		if ("training_list" in _remain_states) and (rebatcher is None):
 			_ctl = _remain_states["training_list"]
 		else:
+			if rebatcher is not None:
+				tl = rebatcher()
+				ntrain = len(tl)
 			shuffle(tl)
 			_ctl = tl
 		tminerr, done_tokens, cur_checkid, remain_steps, _ = train(td, _ctl, vd, nvalid, optimizer, lrsch, mymodel, lossf, cuda_device, logger, done_tokens, multi_gpu, multi_gpu_optimizer, tokens_optm, batch_report, save_every, chkpf, state_holder, statesf, num_checkpoint, cur_checkid, report_eva, remain_steps, False, False, scaler)
 		_ctl = _remain_states = None
 		vloss, vprec = eva(vd, nvalid, mymodel, lossf, cuda_device, multi_gpu, use_amp)
+		telemetry.tick("eva")
 		logger.info("Epoch: 0, train loss: %.3f, valid loss/error: %.3f %.2f" % (tminerr, vloss, vprec,))
-		save_model(mymodel, wkdir + "train_0_%.3f_%.3f_%.2f.h5" % (tminerr, vloss, vprec,), multi_gpu, print_func=logger.info, mtyp=("eva" if overwrite_eva else "train") if save_auto_clean else None)
+		save_model(mymodel, wkdir + "train_0_%.3f_%.3f_%.2f.h5" % (tminerr, vloss, vprec,), multi_gpu or dist_training, print_func=logger.info, mtyp=("eva" if overwrite_eva else "train") if save_auto_clean else None)
 		if statesf is not None:
 			save_states(state_holder.state_dict(update=False, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid}), statesf, print_func=logger.info)
-		logger.info("New best model saved")
+		telemetry.tick("save")
+		save_logger("New best model saved")
 
 if cnfg.dss_ws is not None and cnfg.dss_ws > 0.0 and cnfg.dss_ws < 1.0:
 	dss_ws = int(cnfg.dss_ws * ntrain)
@@ -317,17 +369,22 @@ else:
 namin = 0
 
 for i in range(1, maxrun + 1):
+	if rebatcher is not None:
+		tl = rebatcher()
+		ntrain = len(tl)
 	shuffle(tl)
 	free_cache(use_cuda)
 	terr, done_tokens, cur_checkid, remain_steps, _Dws = train(td, tl, vd, nvalid, optimizer, lrsch, mymodel, lossf, cuda_device, logger, done_tokens, multi_gpu, multi_gpu_optimizer, tokens_optm, batch_report, save_every, chkpf, state_holder, statesf, num_checkpoint, cur_checkid, report_eva, remain_steps, dss_ws > 0, i >= start_chkp_save, scaler)
 	vloss, vprec = eva(vd, nvalid, mymodel, lossf, cuda_device, multi_gpu, use_amp)
+	telemetry.tick("eva")
 	logger.info("Epoch: %d, train loss: %.3f, valid loss/error: %.3f %.2f" % (i, terr, vloss, vprec,))
 
 	if (vprec <= minerr) or (vloss <= minloss):
-		save_model(mymodel, wkdir + "eva_%d_%.3f_%.3f_%.2f.h5" % (i, terr, vloss, vprec,), multi_gpu, print_func=logger.info, mtyp="eva" if save_auto_clean else None)
+		save_model(mymodel, wkdir + "eva_%d_%.3f_%.3f_%.2f.h5" % (i, terr, vloss, vprec,), multi_gpu or dist_training, print_func=logger.info, mtyp="eva" if save_auto_clean else None)
 		if statesf is not None:
 			save_states(state_holder.state_dict(update=False, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid}), statesf, print_func=logger.info)
-		logger.info("New best model saved")
+		telemetry.tick("save")
+		save_logger("New best model saved")
 
 		namin = 0
 
@@ -339,17 +396,21 @@ for i in range(1, maxrun + 1):
 	else:
 		if terr < tminerr:
 			tminerr = terr
-			save_model(mymodel, wkdir + "train_%d_%.3f_%.3f_%.2f.h5" % (i, terr, vloss, vprec,), multi_gpu, print_func=logger.info, mtyp=("eva" if overwrite_eva else "train") if save_auto_clean else None)
+			save_model(mymodel, wkdir + "train_%d_%.3f_%.3f_%.2f.h5" % (i, terr, vloss, vprec,), multi_gpu or dist_training, print_func=logger.info, mtyp=("eva" if overwrite_eva else "train") if save_auto_clean else None)
 			if statesf is not None:
 				save_states(state_holder.state_dict(update=False, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid}), statesf, print_func=logger.info)
+			telemetry.tick("save")
 		elif epoch_save:
-			save_model(mymodel, wkdir + "epoch_%d_%.3f_%.3f_%.2f.h5" % (i, terr, vloss, vprec,), multi_gpu, print_func=logger.info)
+			save_model(mymodel, wkdir + "epoch_%d_%.3f_%.3f_%.2f.h5" % (i, terr, vloss, vprec,), multi_gpu or dist_training, print_func=logger.info)
 			if statesf is not None:
 				save_states(state_holder.state_dict(update=False, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid}), statesf, print_func=logger.info)
+			telemetry.tick("save")
 
 		namin += 1
 		if namin >= earlystop:
 			if done_tokens > 0:
+				if dist_training:
+					mymodel.sync_gradients()
 				optm_step(optimizer, model=mymodel, scaler=scaler, multi_gpu=multi_gpu, multi_gpu_optimizer=multi_gpu_optimizer)
 				lrsch.step()
 				done_tokens = 0
@@ -377,14 +438,19 @@ for i in range(1, maxrun + 1):
 		#hook_lr_update(optimizer, use_ams)
 
 if done_tokens > 0:
+	if dist_training:
+		mymodel.sync_gradients()
 	optm_step(optimizer, model=mymodel, scaler=scaler, multi_gpu=multi_gpu, multi_gpu_optimizer=multi_gpu_optimizer)
 	lrsch.step()
 	#done_tokens = 0
 
-save_model(mymodel, wkdir + "last.h5", multi_gpu, print_func=logger.info)
+save_model(mymodel, wkdir + "last.h5", multi_gpu or dist_training, print_func=logger.info)
 if statesf is not None:
 	save_states(state_holder.state_dict(update=False, **{"remain_steps": remain_steps, "checkpoint_id": cur_checkid}), statesf, print_func=logger.info)
-logger.info("model saved")
+save_logger("model saved")
 
 td.close()
 vd.close()
+
+if dist_training:
+	close_dist()
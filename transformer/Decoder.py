@@ -5,8 +5,11 @@ from math import sqrt
 from torch import nn
 
 from modules.base import CrossAttn, Dropout, Linear, MultiHeadAttn, PositionalEmb, PositionwiseFF, ResCrossAttn, ResSelfAttn
-from utils.base import index_tensors, select_zero_
-from utils.decode.beam import expand_bsize_for_beam
+from utils.base import index_tensors, pad_tensors
+from utils.decode.base import get_inc_pos
+from utils.decode.beam import beam_step, expand_bsize_for_beam
+from utils.decode.cache import narrow_states
+from utils.decode.stream import beam_stream_update
 from utils.fmt.parser import parse_none
 from utils.sampler import SampleMax
 from utils.torch.comp import all_done, mask_tensor_type, torch_no_grad
@@ -39,7 +42,7 @@ class DecoderLayer(nn.Module):
 	# inputo: embedding of decoded translation (bsize, nquery, isize)
 	# src_pad_mask: mask for given encoding source sentence (bsize, nquery, seql), see Encoder, expanded after generated with:
 	#	src_pad_mask = input.eq(pad_id).unsqueeze(1)
-	# tgt_pad_mask: mask to hide the future input
+	# tgt_pad_mask: mask to hide the future input, or to hide cached steps (bsize, nquery, seql) in incremental decoding
 	# query_unit: single query to decode, used to support decoding for given step
 
 	def forward(self, inpute, inputo, src_pad_mask=None, tgt_pad_mask=None, query_unit=None, **kwargs):
@@ -47,7 +50,7 @@ class DecoderLayer(nn.Module):
 		if query_unit is None:
 			context = self.self_attn(inputo, mask=tgt_pad_mask)
 		else:
-			context, states_return = self.self_attn(query_unit, states=inputo)
+			context, states_return = self.self_attn(query_unit, mask=tgt_pad_mask, states=inputo)
 
 		context = self.cross_attn(context, inpute, mask=src_pad_mask)
 
@@ -171,18 +174,18 @@ class Decoder(nn.Module):
 	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql), see Encoder, generated with:
 	#	src_pad_mask = input.eq(pad_id).unsqueeze(1)
 
-	def forward(self, inpute, inputo, src_pad_mask=None, **kwargs):
+	def forward(self, inpute, inputo, src_pad_mask=None, word_prediction=True, pos=None, tgt_mask=None, **kwargs):
 
 		nquery = inputo.size(-1)
 
 		out = self.wemb(inputo)
 
 		if self.pemb is not None:
-			out = self.pemb(inputo, expand=False).add(out, alpha=sqrt(out.size(-1)))
+			out = self.pemb(inputo, expand=False, pos=pos).add(out, alpha=sqrt(out.size(-1)))
 		if self.drop is not None:
 			out = self.drop(out)
 
-		_mask = self._get_subsequent_mask(nquery)
+		_mask = self._get_subsequent_mask(nquery) if tgt_mask is None else tgt_mask
 
 		# the following line of code is to mask <pad> for the decoder,
 		# which I think is useless, since only <pad> may pay attention to previous <pad> tokens, whos loss will be omitted by the loss function.
@@ -194,10 +197,16 @@ class Decoder(nn.Module):
 		if self.out_normer is not None:
 			out = self.out_normer(out)
 
-		out = self.lsm(self.classifier(out))
+		out = self.fused_output(out) if word_prediction == "fused" else self.lsm(self.classifier(out))
 
 		return out
 
+	# (hidden states, classifier weight, classifier bias) for the classifier fused with the loss (loss.base.FusedLabelSmoothingLoss) instead of log-probabilities, with word_prediction="fused"
+
+	def fused_output(self, out):
+
+		return out, self.classifier.weight, self.classifier.bias
+
 	def load_base(self, base_decoder):
 
 		self.drop = base_decoder.drop
@@ -305,6 +314,131 @@ class Decoder(nn.Module):
 
 		return torch.cat(trans, 1)
 
+	# embed decoded tokens wds (bsize, nquery) from step start for incremental decoding, or the given embedding emb (of <sos>) instead.
+	# start can also be a tensor of the start step of each sequence (bsize), max_pos: an upper bound (exclusive) of steps in that case, see PositionalEmb.get_steps
+
+	def get_inc_emb(self, start, wds=None, emb=None, max_pos=None):
+
+		out = self.wemb(wds) if emb is None else emb
+		if self.pemb is not None:
+			out = (self.pemb.get_range(start, out.size(1)) if isinstance(start, int) else self.pemb.get_steps(get_inc_pos(start, out.size(1)), max_pos=max_pos)).add(out, alpha=sqrt(out.size(-1)))
+		if self.drop is not None:
+			out = self.drop(out)
+
+		return out
+
+	# hidden states fed into the classifier of the last decoder layer output in incremental decoding
+
+	def get_inc_hidden(self, out):
+
+		return out if self.out_normer is None else self.out_normer(out)
+
+	# classifier output (without self.lsm) of the last decoder layer in incremental decoding
+
+	def get_inc_out(self, out):
+
+		return self.classifier(self.get_inc_hidden(out))
+
+	# run decoder layers (self.nets if nets is None) incrementally on out (bsize, nquery, isize), decoding states (a dict of layer index: state) are updated in place.
+	# tgt_pad_mask: mask to hide cached steps (bsize, nquery, seql), or future steps when nquery > 1 (1, nquery, seql), see get_inc_mask
+	# hidden: return the input to the classifier instead of its output
+
+	def inc_forward(self, inpute, out, states, src_pad_mask=None, tgt_pad_mask=None, nets=None, hidden=False):
+
+		for _tmp, net in enumerate(self.nets if nets is None else nets):
+			out, states[_tmp] = net(inpute, states.get(_tmp, (None, None,)), src_pad_mask, tgt_pad_mask, out)
+
+		return self.get_inc_hidden(out) if hidden else self.get_inc_out(out)
+
+	def get_inc_mask(self, nquery, seql):
+
+		_mask = self._get_subsequent_mask(nquery)
+
+		return torch.cat((_mask.new_zeros(1, nquery, seql - nquery), _mask,), dim=-1) if seql > nquery else _mask
+
+	# speculative greedy decoding: the draft decoder proposes nstep tokens one by one, and this decoder verifies them in one forward pass. Proposed tokens are accepted as long as they match the predictions of this decoder for all unfinished sentences in the batch, so the translations are the same as greedy_decode, while this decoder runs much fewer steps.
+	# inpute: encoded representation from encoder (bsize, seql, isize)
+	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql), see Encoder, generated with:
+	#	src_pad_mask = input.eq(pad_id).unsqueeze(1)
+	# max_len: maximum length to generate
+	# draft: the draft decoder, the first draft_layers layers of this decoder are used as the draft if it is None
+	# draft_inpute/draft_src_pad_mask: encoder output and source mask for the draft decoder (for draft models with their own encoders), inpute and src_pad_mask are used if draft_inpute is None
+	# nstep: number of tokens proposed by the draft for each verification
+
+	def speculative_greedy_decode(self, inpute, src_pad_mask=None, max_len=512, draft=None, draft_layers=speculative_draft_layers, draft_inpute=None, draft_src_pad_mask=None, nstep=speculative_draft_steps, fill_pad=False, **kwargs):
+
+		bsize = inpute.size(0)
+
+		if draft is None:
+			draft, draft_nets = self, self.nets[:max(1, parse_none(draft_layers, 1))]
+		else:
+			draft_nets = draft.nets
+		if draft_inpute is None:
+			draft_inpute, draft_src_pad_mask = inpute, src_pad_mask
+
+		states, dstates = {}, {}
+
+		# wds: (bsize, 1)
+		wds = self.inc_forward(inpute, self.get_inc_emb(0, emb=self.get_sos_emb(inpute)), states, src_pad_mask).argmax(dim=-1)
+		draft.inc_forward(draft_inpute, draft.get_inc_emb(0, emb=draft.get_sos_emb(draft_inpute)), dstates, draft_src_pad_mask, nets=draft_nets)
+
+		trans = [wds]
+		done_trans = wds.squeeze(1).eq(eos_id)
+		# ntrans: number of decoded tokens, the last one (wds) has not been fed into this decoder
+		# dwds: tokens not fed into the draft yet, (wds or the last accepted proposal followed by wds)
+		ntrans, dwds = 1, wds
+
+		while (ntrans < max_len) and (not all_done(done_trans, bsize)):
+
+			_nstep = min(nstep, max_len - ntrans - 1)
+
+			_prop = []
+			_dstart = ntrans + 1 - dwds.size(1)
+			_wds = dwds
+			for _ in range(_nstep):
+				_nq = _wds.size(1)
+				_out = draft.inc_forward(draft_inpute, draft.get_inc_emb(_dstart, _wds), dstates, draft_src_pad_mask, draft.get_inc_mask(_nq, _dstart + _nq) if _nq > 1 else None, nets=draft_nets)
+				_wds = _out.narrow(1, _nq - 1, 1).argmax(dim=-1)
+				_prop.append(_wds)
+				_dstart += _nq
+
+			_nq = _nstep + 1
+			# _out: (bsize, _nstep + 1), predictions of this decoder after wds and each proposed token
+			_out = self.inc_forward(inpute, self.get_inc_emb(ntrans, torch.cat([wds] + _prop, 1) if _prop else wds), states, src_pad_mask, self.get_inc_mask(_nq, ntrans + _nq) if _nq > 1 else None).argmax(dim=-1)
+
+			if _nstep > 0:
+				# _nacc: number of leading proposals accepted for unfinished sentences
+				_nacc = torch.cat(_prop, 1).eq(_out.narrow(1, 0, _nstep)).long().cumprod(1).sum(1).masked_fill_(done_trans, _nstep).min().item()
+			else:
+				_nacc = 0
+			_wds = _out.narrow(1, 0, _nacc + 1)
+
+			if fill_pad:
+				_eos = _wds.eq(eos_id)
+				trans.append(_wds.masked_fill((_eos.long().cumsum(1) - _eos.long()).gt(0) | done_trans.unsqueeze(1), pad_id))
+			else:
+				trans.append(_wds)
+			done_trans = done_trans | _wds.eq(eos_id).any(1)
+
+			ntrans += _nacc + 1
+			wds = _wds.narrow(1, _nacc, 1)
+			# discard the cached steps of rejected proposals
+			narrow_states(states, ntrans)
+			if _nacc < _nstep:
+				narrow_states(dstates, ntrans)
+				dwds = wds
+			else:
+				dwds = torch.cat((_prop[-1], wds,), 1) if _prop else torch.cat((dwds, wds,), 1)
+
+		rs = torch.cat(trans, 1)
+		# accepted tokens may go beyond the step where all sentences are finished, at which greedy_decode stops
+		if all_done(done_trans, bsize):
+			_len = rs.eq(eos_id).long().cumsum(1).eq(0).long().sum(1).max().item() + 1
+			if _len < rs.size(1):
+				rs = rs.narrow(1, 0, _len)
+
+		return rs
+
 	# inpute: encoded representation from encoder (bsize, seql, isize)
 	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql), see Encoder, generated with:
 	#	src_pad_mask = input.eq(pad_id).unsqueeze(1)
@@ -315,8 +449,6 @@ class Decoder(nn.Module):
 
 		bsize, seql = inpute.size()[:2]
 
-		beam_size2 = beam_size * beam_size
-		bsizeb2 = bsize * beam_size2
 		real_bsize = bsize * beam_size
 
 		out = self.get_sos_emb(inpute)
@@ -325,6 +457,8 @@ class Decoder(nn.Module):
 			# lpv: length penalty vector for each beam (bsize * beam_size, 1)
 			lpv = out.new_ones(real_bsize, 1)
 			lpv_base = 6.0 ** length_penalty
+		else:
+			lpv = None
 
 		if self.pemb is not None:
 			sqrt_isize = sqrt(out.size(-1))
@@ -355,7 +489,6 @@ class Decoder(nn.Module):
 		sum_scores = scores
 		wds = wds.view(real_bsize, 1)
 		trans = wds
-		_inds_add_beam2 = torch.arange(0, bsizeb2, beam_size2, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
 		_inds_add_beam = torch.arange(0, real_bsize, beam_size, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
 
 		# done_trans: (bsize, beam_size)
@@ -395,62 +528,25 @@ class Decoder(nn.Module):
 
 			out = self.lsm(self.classifier(out)).view(bsize, beam_size, -1)
 
-			# find the top k ** 2 candidates and calculate route scores for them
-			# _scores: (bsize, beam_size, beam_size)
-			# done_trans: (bsize, beam_size)
+			# find the top k ** 2 candidates, and keep the top-k of them for each sentence with utils.decode.beam.beam_step
 			# scores: (bsize, beam_size)
-			# _wds: (bsize, beam_size, beam_size)
-			# mask_from_done_trans: (bsize, beam_size) => (bsize, beam_size * beam_size)
-			# added_scores: (bsize, 1, beam_size) => (bsize, beam_size, beam_size)
-
-			_scores, _wds = out.topk(beam_size, dim=-1)
-			_done_trans_unsqueeze = done_trans.unsqueeze(2)
-			_scores = (_scores.masked_fill(_done_trans_unsqueeze.expand(bsize, beam_size, beam_size), 0.0) + sum_scores.unsqueeze(2).repeat(1, 1, beam_size).masked_fill_(select_zero_(_done_trans_unsqueeze.repeat(1, 1, beam_size), -1, 0), -inf_default))
-
-			if length_penalty > 0.0:
-				lpv.masked_fill_(~done_trans.view(real_bsize, 1), ((step + 6.0) ** length_penalty) / lpv_base)
-
-			# clip from k ** 2 candidate and remain the top-k for each path
-			# scores: (bsize, beam_size * beam_size) => (bsize, beam_size)
-			# _inds: indexes for the top-k candidate (bsize, beam_size)
-
-			if clip_beam and (length_penalty > 0.0):
-				scores, _inds = (_scores.view(real_bsize, beam_size) / lpv.expand(real_bsize, beam_size)).view(bsize, beam_size2).topk(beam_size, dim=-1)
-				_tinds = (_inds + _inds_add_beam2).view(real_bsize)
-				sum_scores = _scores.view(bsizeb2).index_select(0, _tinds).view(bsize, beam_size)
-			else:
-				scores, _inds = _scores.view(bsize, beam_size2).topk(beam_size, dim=-1)
-				_tinds = (_inds + _inds_add_beam2).view(real_bsize)
-				sum_scores = scores
+			# wds: (bsize * beam_size, 1)
+			# _inds: indexes of the beams extended by the top-k candidates (bsize * beam_size)
 
-			# select the top-k candidate with higher route score and update translation record
-			# wds: (bsize, beam_size, beam_size) => (bsize * beam_size, 1)
-			# this can also be done simply with the below line, but it is slightly slower.
-			# wds = _wds.view(bsize, beam_size2).gather(-1, _inds).view(real_bsize, 1)
-			wds = _wds.view(bsizeb2).index_select(0, _tinds).view(real_bsize, 1)
-
-			# reduces indexes in _inds from (beam_size ** 2) to beam_size
-			# thus the fore path of the top-k candidate is pointed out
-			# _inds: indexes for the top-k candidate (bsize, beam_size)
-
-			_inds = (_inds // beam_size + _inds_add_beam).view(real_bsize)
+			scores, sum_scores, wds, _inds, _done_trans, lpv = beam_step(out, sum_scores, done_trans, lpv, ((step + 6.0) ** length_penalty) / lpv_base if length_penalty > 0.0 else None, clip_beam)
 
 			# select the corresponding translation history for the top-k candidate and update translation records
 			# trans: (bsize * beam_size, nquery) => (bsize * beam_size, nquery + 1)
 
 			trans = torch.cat((trans.index_select(0, _inds), wds.masked_fill(done_trans.view(real_bsize, 1), pad_id) if fill_pad else wds), 1)
 
-			done_trans = (done_trans.view(real_bsize).index_select(0, _inds) | wds.eq(eos_id).squeeze(1)).view(bsize, beam_size)
+			done_trans = _done_trans
 
 			# check early stop for beam search
 			# done_trans: (bsize, beam_size)
 			# scores: (bsize, beam_size)
 
-			_done = False
-			if length_penalty > 0.0:
-				lpv = lpv.index_select(0, _inds)
-			elif (not return_all) and all_done(done_trans.select(1, 0), bsize):
-				_done = True
+			_done = (length_penalty <= 0.0) and (not return_all) and all_done(done_trans.select(1, 0), bsize)
 
 			# check beam states(done or not)
 
@@ -477,6 +573,106 @@ class Decoder(nn.Module):
 
 			return trans.view(bsize, beam_size, -1).select(1, 0)
 
+	# streaming decoding, returns a generator which yields the tokens committed at each decoding step, a list (bsize) of lists of newly committed token indices (<eos> is the last committed token of each sentence if it is reached). Stopping the iteration stops decoding.
+	# inpute: encoded representation from encoder (bsize, seql, isize)
+	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql), see Encoder, generated with:
+	#	src_pad_mask = input.eq(pad_id).unsqueeze(1)
+
+	def decode_stream(self, inpute, src_pad_mask=None, beam_size=1, max_len=512, length_penalty=0.0, **kwargs):
+
+		return self.beam_decode_stream(inpute, src_pad_mask, beam_size, max_len, length_penalty, **kwargs) if beam_size > 1 else self.greedy_decode_stream(inpute, src_pad_mask, max_len, **kwargs)
+
+	# greedy decoding commits the decoded token of each unfinished sentence at every step, the results are the same as greedy_decode.
+
+	def greedy_decode_stream(self, inpute, src_pad_mask=None, max_len=512, sample=False, **kwargs):
+
+		bsize = inpute.size(0)
+
+		states = {}
+		out = self.inc_forward(inpute, self.get_inc_emb(0, emb=self.get_sos_emb(inpute)), states, src_pad_mask)
+		done_trans = None
+
+		for i in range(1, max_len + 1):
+
+			# wds: (bsize, 1)
+			wds = SampleMax(out.softmax(-1), dim=-1, keepdim=False) if sample else out.argmax(dim=-1)
+			_wds = wds.squeeze(1)
+			if done_trans is None:
+				yield [[_w] for _w in _wds.tolist()]
+				done_trans = _wds.eq(eos_id)
+			else:
+				yield [[] if _d else [_w] for _w, _d in zip(_wds.tolist(), done_trans.tolist())]
+				done_trans = done_trans | _wds.eq(eos_id)
+
+			if (i == max_len) or all_done(done_trans, bsize):
+				break
+
+			out = self.inc_forward(inpute, self.get_inc_emb(i, wds), states, src_pad_mask)
+
+	# beam search commits the common prefix of all beams of each sentence, and the best beam once it is determined (when it is finished without length penalty, or when decoding ends), the results are the same as beam_decode.
+
+	def beam_decode_stream(self, inpute, src_pad_mask=None, beam_size=8, max_len=512, length_penalty=0.0, clip_beam=clip_beam_with_lp, **kwargs):
+
+		bsize, seql = inpute.size()[:2]
+
+		real_bsize = bsize * beam_size
+
+		states = {}
+		# out: (bsize, 1, nwd)
+		out = self.lsm(self.inc_forward(inpute, self.get_inc_emb(0, emb=self.get_sos_emb(inpute)), states, src_pad_mask))
+
+		if length_penalty > 0.0:
+			lpv = out.new_ones(real_bsize, 1)
+			lpv_base = 6.0 ** length_penalty
+		else:
+			lpv = None
+
+		scores, wds = out.topk(beam_size, dim=-1)
+		scores = scores.squeeze(1)
+		sum_scores = scores
+		wds = wds.view(real_bsize, 1)
+		trans = wds
+		_inds_add_beam = torch.arange(0, real_bsize, beam_size, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
+
+		done_trans = wds.view(bsize, beam_size).eq(eos_id)
+
+		self.repeat_cross_attn_buffer(beam_size)
+		_src_pad_mask = None if src_pad_mask is None else src_pad_mask.repeat(1, beam_size, 1).view(real_bsize, 1, seql)
+		states = expand_bsize_for_beam(states, beam_size=beam_size)
+
+		# nout: numbers of committed tokens of sentences, see utils.decode.stream.beam_stream_update
+		nout = [0 for _ in range(bsize)]
+
+		for step in range(1, max_len):
+
+			# without length penalty, the scores of other beams can only decrease, so finished best beams are determined
+			yield beam_stream_update(trans.view(bsize, beam_size, -1), nout, None if length_penalty > 0.0 else done_trans.select(1, 0).tolist())
+
+			# out: (bsize, beam_size, nwd)
+			out = self.lsm(self.inc_forward(inpute, self.get_inc_emb(step, wds), states, _src_pad_mask)).view(bsize, beam_size, -1)
+
+			scores, sum_scores, wds, _inds, _done_trans, lpv = beam_step(out, sum_scores, done_trans, lpv, ((step + 6.0) ** length_penalty) / lpv_base if length_penalty > 0.0 else None, clip_beam)
+
+			# tokens after <eos> are always filled with pad_id to find common prefixes
+			trans = torch.cat((trans.index_select(0, _inds), wds.masked_fill(done_trans.view(real_bsize, 1), pad_id)), 1)
+
+			done_trans = _done_trans
+
+			_done = (length_penalty <= 0.0) and all_done(done_trans.select(1, 0), bsize)
+
+			if _done or all_done(done_trans, real_bsize):
+				break
+
+			states = index_tensors(states, indices=_inds, dim=0)
+
+		if (not clip_beam) and (length_penalty > 0.0):
+			scores = scores / lpv.view(bsize, beam_size)
+			scores, _inds = scores.topk(beam_size, dim=-1)
+			_inds = (_inds + _inds_add_beam).view(real_bsize)
+			trans = trans.view(real_bsize, -1).index_select(0, _inds)
+
+		yield beam_stream_update(trans.view(bsize, beam_size, -1), nout, [True for _ in range(bsize)])
+
 	# inpute: encoded representation from encoder (bsize, seql, isize)
 
 	def get_sos_emb(self, inpute, bsize=None):
@@ -494,7 +690,8 @@ class Decoder(nn.Module):
 
 	def fix_load(self):
 
-		if (self.fbl is not None) and (self.classifier.bias is not None):
+		# the bias of int8 quantized classifiers (utils.torch.quant) is not a tensor, but it has been fixed before quantization
+		if (self.fbl is not None) and isinstance(self.classifier.bias, torch.Tensor):
 			with torch_no_grad():
 				self.classifier.bias.index_fill_(0, torch.as_tensor(self.fbl, dtype=torch.long, device=self.classifier.bias.device), -inf_default)
 
@@ -554,84 +751,46 @@ class Decoder(nn.Module):
 	#	src_pad_mask = input.eq(pad_id).unsqueeze(1)
 	# beam_size: the beam size for beam search
 	# max_len: maximum length to generate
+	# return_mat: pad translations into a tensor, or return a list of translations
+	# finished sentences are removed from the decoding batch (together with their decoding states, cross-attention buffers and source masks), and their results are put back to their original positions in the end.
 
-	def decode_clip(self, inpute, src_pad_mask, beam_size=1, max_len=512, length_penalty=0.0, return_mat=True):
+	def decode_clip(self, inpute, src_pad_mask=None, beam_size=1, max_len=512, length_penalty=0.0, return_mat=True, fill_pad=False, **kwargs):
 
-		return self.beam_decode_clip(inpute, src_pad_mask, beam_size, max_len, length_penalty, return_mat) if beam_size > 1 else self.greedy_decode_clip(inpute, src_pad_mask, max_len, return_mat)
+		return self.beam_decode_clip(inpute, src_pad_mask, beam_size, max_len, length_penalty, return_mat=return_mat, fill_pad=fill_pad, **kwargs) if beam_size > 1 else self.greedy_decode_clip(inpute, src_pad_mask, max_len, return_mat=return_mat, **kwargs)
 
 	# inpute: encoded representation from encoder (bsize, seql, isize)
 	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql), see Encoder, generated with:
 	#	src_pad_mask = input.eq(pad_id).unsqueeze(1)
 	# max_len: maximum length to generate
 
-	def greedy_decode_clip(self, inpute, src_pad_mask=None, max_len=512, return_mat=True):
+	def greedy_decode_clip(self, inpute, src_pad_mask=None, max_len=512, return_mat=True, sample=False, **kwargs):
 
 		bsize = inpute.size(0)
 
-		out = self.get_sos_emb(inpute)
-
-		# out: input to the decoder for the first step (bsize, 1, isize)
-
-		if self.pemb is not None:
-			sqrt_isize = sqrt(out.size(-1))
-			out = self.pemb.get_pos(0).add(out, alpha=sqrt_isize)
-		if self.drop is not None:
-			out = self.drop(out)
-
 		states = {}
 
-		for _tmp, net in enumerate(self.nets):
-			out, _state = net(inpute, (None, None,), src_pad_mask, None, out)
-			states[_tmp] = _state
-
-		if self.out_normer is not None:
-			out = self.out_normer(out)
-
 		# out: (bsize, 1, nwd)
-
-		out = self.lsm(self.classifier(out))
-
+		out = self.inc_forward(inpute, self.get_inc_emb(0, emb=self.get_sos_emb(inpute)), states, src_pad_mask)
 		# wds: (bsize, 1)
+		wds = SampleMax(out.softmax(-1), dim=-1, keepdim=False) if sample else out.argmax(dim=-1)
+
+		trans = [wds]
 
-		wds = out.argmax(dim=-1)
+		# done_trans: (bsize)
+		done_trans = wds.squeeze(1).eq(eos_id)
 
+		# mapper: the index in the input batch of each sentence in the decoding batch
 		mapper = list(range(bsize))
 		rs = [None for i in range(bsize)]
 
-		trans = [wds]
-
 		for i in range(1, max_len):
 
-			out = self.wemb(wds)
-			if self.pemb is not None:
-				out = self.pemb.get_pos(i).add(out, alpha=sqrt_isize)
-			if self.drop is not None:
-				out = self.drop(out)
-
-			for _tmp, net in enumerate(self.nets):
-				out, _state = net(inpute, states[_tmp], src_pad_mask, None, out)
-				states[_tmp] = _state
-
-			if self.out_normer is not None:
-				out = self.out_normer(out)
-
-			# out: (bsize, 1, nwd)
-			out = self.lsm(self.classifier(out))
-			wds = out.argmax(dim=-1)
-
-			trans.append(wds)
-
-			# done_trans: (bsize)
-			done_trans = wds.squeeze(1).eq(eos_id)
-
 			_ndone = done_trans.int().sum().item()
 			if _ndone == bsize:
-				for _iu, _tran in enumerate(torch.cat(trans, 1).unbind(0)):
-					rs[mapper[_iu]] = _tran
 				break
 			elif _ndone > 0:
-				_dind = done_trans.nonzero().squeeze(1)
 				_trans = torch.cat(trans, 1)
+				_dind = done_trans.nonzero().squeeze(1)
 				for _iu, _tran in zip(_dind.tolist(), _trans.index_select(0, _dind).unbind(0)):
 					rs[mapper[_iu]] = _tran
 
@@ -639,16 +798,22 @@ class Decoder(nn.Module):
 				_ndid = (~done_trans).nonzero().squeeze(1)
 				bsize = _ndid.size(0)
 				wds = wds.index_select(0, _ndid)
-				#inpute = inpute.index_select(0, _ndid)
 				self.index_cross_attn_buffer(_ndid)
 				if src_pad_mask is not None:
 					src_pad_mask = src_pad_mask.index_select(0, _ndid)
 				states = index_tensors(states, indices=_ndid, dim=0)
-				trans = list(_trans.index_select(0, _ndid).unbind(1))
+				trans = [_trans.index_select(0, _ndid)]
+				mapper = [mapper[_iu] for _iu in _ndid.tolist()]
 
-				# update mapper
-				for _ind, _iu in enumerate(_ndid.tolist()):
-					mapper[_ind] = mapper[_iu]
+			out = self.inc_forward(inpute, self.get_inc_emb(i, wds), states, src_pad_mask)
+			wds = SampleMax(out.softmax(-1), dim=-1, keepdim=False) if sample else out.argmax(dim=-1)
+
+			trans.append(wds)
+
+			done_trans = wds.squeeze(1).eq(eos_id)
+
+		for _iu, _tran in zip(mapper, torch.cat(trans, 1).unbind(0)):
+			rs[_iu] = _tran
 
 		return torch.stack(pad_tensors(rs), 0) if return_mat else rs
 
@@ -658,12 +823,10 @@ class Decoder(nn.Module):
 	# beam_size: beam size
 	# max_len: maximum length to generate
 
-	def beam_decode_clip(self, inpute, src_pad_mask=None, beam_size=8, max_len=512, length_penalty=0.0, return_mat=True, return_all=False, clip_beam=clip_beam_with_lp):
+	def beam_decode_clip(self, inpute, src_pad_mask=None, beam_size=8, max_len=512, length_penalty=0.0, return_mat=True, return_all=False, clip_beam=clip_beam_with_lp, fill_pad=False, **kwargs):
 
 		bsize, seql = inpute.size()[:2]
 
-		beam_size2 = beam_size * beam_size
-		bsizeb2 = bsize * beam_size2
 		real_bsize = bsize * beam_size
 
 		out = self.get_sos_emb(inpute)
@@ -672,25 +835,14 @@ class Decoder(nn.Module):
 			# lpv: length penalty vector for each beam (bsize * beam_size, 1)
 			lpv = out.new_ones(real_bsize, 1)
 			lpv_base = 6.0 ** length_penalty
-
-		if self.pemb is not None:
-			sqrt_isize = sqrt(out.size(-1))
-			out = self.pemb.get_pos(0).add(out, alpha=sqrt_isize)
-		if self.drop is not None:
-			out = self.drop(out)
+		else:
+			lpv = None
 
 		states = {}
 
-		for _tmp, net in enumerate(self.nets):
-			out, _state = net(inpute, (None, None,), src_pad_mask, None, out)
-			states[_tmp] = _state
-
-		if self.out_normer is not None:
-			out = self.out_normer(out)
-
 		# out: (bsize, 1, nwd)
 
-		out = self.lsm(self.classifier(out))
+		out = self.lsm(self.inc_forward(inpute, self.get_inc_emb(0, emb=out), states, src_pad_mask))
 
 		# scores: (bsize, 1, beam_size) => (bsize, beam_size)
 		# wds: (bsize * beam_size, 1)
@@ -701,14 +853,13 @@ class Decoder(nn.Module):
 		sum_scores = scores
 		wds = wds.view(real_bsize, 1)
 		trans = wds
+		_inds_add_beam = torch.arange(0, real_bsize, beam_size, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
+		_inds_beam = torch.arange(0, beam_size, dtype=wds.dtype, device=wds.device)
 
 		# done_trans: (bsize, beam_size)
 
 		done_trans = wds.view(bsize, beam_size).eq(eos_id)
 
-		# inpute: (bsize, seql, isize) => (bsize * beam_size, seql, isize)
-		#inpute = inpute.repeat(1, beam_size, 1).view(real_bsize, seql, isize)
-
 		self.repeat_cross_attn_buffer(beam_size)
 
 		# _src_pad_mask: (bsize, 1, seql) => (bsize * beam_size, 1, seql)
@@ -719,162 +870,84 @@ class Decoder(nn.Module):
 
 		states = expand_bsize_for_beam(states, beam_size=beam_size)
 
+		# mapper: the index in the input batch of each sentence in the decoding batch
 		mapper = list(range(bsize))
 		rs = [None for i in range(bsize)]
 		if return_all:
 			rscore = [None for i in range(bsize)]
 
-		for step in range(1, max_len):
-
-			out = self.wemb(wds)
-			if self.pemb is not None:
-				out = self.pemb.get_pos(step).add(out, alpha=sqrt_isize)
-			if self.drop is not None:
-				out = self.drop(out)
-
-			for _tmp, net in enumerate(self.nets):
-				out, _state = net(inpute, states[_tmp], _src_pad_mask, None, out)
-				states[_tmp] = _state
-
-			if self.out_normer is not None:
-				out = self.out_normer(out)
-
-			# out: (bsize, beam_size, nwd)
-
-			out = self.lsm(self.classifier(out)).view(bsize, beam_size, -1)
-
-			# find the top k ** 2 candidates and calculate route scores for them
-			# _scores: (bsize, beam_size, beam_size)
-			# done_trans: (bsize, beam_size)
-			# scores: (bsize, beam_size)
-			# _wds: (bsize, beam_size, beam_size)
-			# mask_from_done_trans_u: (bsize, beam_size) => (bsize, beam_size * beam_size)
-			# added_scores: (bsize, 1, beam_size) => (bsize, beam_size, beam_size)
-
-			_scores, _wds = out.topk(beam_size, dim=-1)
-			_done_trans_unsqueeze = done_trans.unsqueeze(2)
-			_scores = (_scores.masked_fill(_done_trans_unsqueeze.expand(bsize, beam_size, beam_size), 0.0) + sum_scores.unsqueeze(2).repeat(1, 1, beam_size).masked_fill_(select_zero_(_done_trans_unsqueeze.repeat(1, 1, beam_size), -1, 0), -inf_default))
-
-			if length_penalty > 0.0:
-				lpv.masked_fill_(~done_trans.view(real_bsize, 1), ((step + 6.0) ** length_penalty) / lpv_base)
-
-			# clip from k ** 2 candidate and remain the top-k for each path
-			# scores: (bsize, beam_size * beam_size) => (bsize, beam_size)
-			# _inds: indexes for the top-k candidate (bsize, beam_size)
-
-			if clip_beam and (length_penalty > 0.0):
-				scores, _inds = (_scores.view(real_bsize, beam_size) / lpv.expand(real_bsize, beam_size)).view(bsize, beam_size2).topk(beam_size, dim=-1)
-				_tinds = (_inds + torch.arange(0, bsizeb2, beam_size2, dtype=_inds.dtype, device=_inds.device).unsqueeze(1).expand_as(_inds)).view(real_bsize)
-				sum_scores = _scores.view(bsizeb2).index_select(0, _tinds).view(bsize, beam_size)
+		# collect results of the sentences with indexes _sind (in the decoding batch)
+		# _trans: (nsel * beam_size, nquery)
+		# _scores: (nsel, beam_size)
+		# _lpv: (nsel * beam_size, 1), only required when the length penalty is applied in the last step
+
+		def collect_rs(_sind, _trans, _scores, _lpv=None):
+
+			_nsel = _scores.size(0)
+			if (not clip_beam) and (length_penalty > 0.0):
+				_scores, _inds = (_scores / _lpv.view(_nsel, beam_size)).topk(beam_size, dim=-1)
+				_trans = _trans.index_select(0, (_inds + _inds_add_beam.narrow(0, 0, _nsel)).view(-1))
+			_trans = _trans.view(_nsel, beam_size, -1)
+			if return_all:
+				for _iu, _tran, _score in zip(_sind, _trans.unbind(0), _scores.unbind(0)):
+					_rid = mapper[_iu]
+					rs[_rid] = _tran
+					rscore[_rid] = _score
 			else:
-				scores, _inds = _scores.view(bsize, beam_size2).topk(beam_size, dim=-1)
-				_tinds = (_inds + torch.arange(0, bsizeb2, beam_size2, dtype=_inds.dtype, device=_inds.device).unsqueeze(1).expand_as(_inds)).view(real_bsize)
-				sum_scores = scores
-
-			# select the top-k candidate with higher route score and update translation record
-			# wds: (bsize, beam_size, beam_size) => (bsize * beam_size, 1)
+				for _iu, _tran in zip(_sind, _trans.unbind(0)):
+					rs[mapper[_iu]] = _tran[0]
 
-			wds = _wds.view(bsizeb2).index_select(0, _tinds).view(real_bsize, 1)
-
-			# reduces indexes in _inds from (beam_size ** 2) to beam_size
-			# thus the fore path of the top-k candidate is pointed out
-			# _inds: indexes for the top-k candidate (bsize, beam_size)
+		for step in range(1, max_len):
 
-			# using "_inds / beam_size" in case old pytorch does not support "//" operation
-			_inds = (_inds // beam_size + torch.arange(0, real_bsize, beam_size, dtype=_inds.dtype, device=_inds.device).unsqueeze(1).expand_as(_inds)).view(real_bsize)
+			# out: (bsize, beam_size, nwd)
 
-			# select the corresponding translation history for the top-k candidate and update translation records
-			# trans: (bsize * beam_size, nquery) => (bsize * beam_size, nquery + 1)
+			out = self.lsm(self.inc_forward(inpute, self.get_inc_emb(step, wds), states, _src_pad_mask)).view(bsize, beam_size, -1)
 
-			trans = torch.cat((trans.index_select(0, _inds), wds), 1)
+			scores, sum_scores, wds, _inds, _done_trans, lpv = beam_step(out, sum_scores, done_trans, lpv, ((step + 6.0) ** length_penalty) / lpv_base if length_penalty > 0.0 else None, clip_beam)
 
-			done_trans = (done_trans.view(real_bsize).index_select(0, _inds) | wds.eq(eos_id).squeeze(1)).view(bsize, beam_size)
+			trans = torch.cat((trans.index_select(0, _inds), wds.masked_fill(done_trans.view(real_bsize).index_select(0, _inds).unsqueeze(1), pad_id) if fill_pad else wds), 1)
 
-			# check early stop for beam search
-			# done_trans: (bsize, beam_size)
-			# scores: (bsize, beam_size)
+			done_trans = _done_trans
 
-			if length_penalty > 0.0:
-				lpv = lpv.index_select(0, _inds)
-				_done_trans_u = done_trans.sum(1).eq(beam_size)
-			elif return_all:
-				_done_trans_u = done_trans.sum(1).eq(beam_size)
-			else:
-				_done_trans_u = done_trans.select(1, 0)
+			# _done_trans_u: whether the decoding of each sentence is finished (bsize)
 
-			# check beam states(done or not)
+			_done_trans_u = done_trans.sum(1).eq(beam_size) if (length_penalty > 0.0) or return_all else done_trans.select(1, 0)
 
 			_ndone = _done_trans_u.int().sum().item()
 			if _ndone == bsize:
-				if (not clip_beam) and (length_penalty > 0.0):
-					scores = scores / lpv.view(bsize, beam_size)
-					scores, _inds = scores.topk(beam_size, dim=-1)
-					_inds = (_inds + torch.arange(0, real_bsize, beam_size, dtype=_inds.dtype, device=_inds.device).unsqueeze(1).expand_as(_inds)).view(real_bsize)
-					trans = trans.view(real_bsize, -1).index_select(0, _inds)
-				if return_all:
-					for _iu, (_tran, _score) in enumerate(zip(trans.view(bsize, beam_size, -1).unbind(0), scores.view(bsize, beam_size).unbind(0))):
-						_rid = mapper[_iu]
-						rs[_rid] = _tran
-						rscore[_rid] = _score
-				else:
-					for _iu, _tran in enumerate(trans.view(bsize, beam_size, -1).unbind(0)):
-						rs[mapper[_iu]] = _tran[0]
 				break
-
-			# update the corresponding hidden states
-			# states[i]: (bsize * beam_size, nquery, isize)
-			# _inds: (bsize, beam_size) => (bsize * beam_size)
-
-			states = index_tensors(states, indices=_inds, dim=0)
-
-			if _ndone > 0:
+			elif _ndone > 0:
 				_dind = _done_trans_u.nonzero().squeeze(1)
-				_trans = trans.view(bsize, beam_size, -1)
-				_trans_sel = _trans.index_select(0, _dind)
-
-				if (not clip_beam) and (length_penalty > 0.0):
-					_scores_sel = scores.index_select(0, _dind) / lpv.view(bsize, beam_size).index_select(0, _dind)
-					_sel_bsize = _dind.size(0)
-					_sel_real_bsize = _sel_bsize * beam_size
-					_scores_sel, _inds = _scores_sel.topk(beam_size, dim=-1)
-					_inds = (_inds + torch.arange(0, _sel_real_bsize, beam_size, dtype=_inds.dtype, device=_inds.device).unsqueeze(1).expand_as(_inds)).view(_sel_real_bsize)
-					_trans_sel = _trans_sel.view(_sel_real_bsize, -1).index_select(0, _inds).view(_sel_bsize, beam_size, -1)
-				if return_all:
-						for _iu, _tran, _score in zip(_dind.tolist(), _trans_sel.unbind(0), _scores_sel.unbind(0)):
-							_rid = mapper[_iu]
-							rs[_rid] = _tran
-							rscore[_rid] = _score
-				else:
-						for _iu, _tran in zip(_dind.tolist(), _trans_sel.unbind(0)):
-							rs[mapper[_iu]] = _tran[0]
+				_rind = (_dind.unsqueeze(1) * beam_size + _inds_beam).view(-1)
+				collect_rs(_dind.tolist(), trans.index_select(0, _rind), scores.index_select(0, _dind), lpv.index_select(0, _rind) if length_penalty > 0.0 else None)
 
 				# reduce bsize for not finished decoding
+				# _rind: indexes of beams of not finished sentences (bsize * beam_size)
 				_ndid = (~_done_trans_u).nonzero().squeeze(1)
+				_rind = (_ndid.unsqueeze(1) * beam_size + _inds_beam).view(-1)
+				bsize = _ndid.size(0)
+				real_bsize = bsize * beam_size
 
-				_bsize = _ndid.size(0)
-				bsizeb2 = _bsize * beam_size2
-				_real_bsize = _bsize * beam_size
-
-				wds = wds.view(bsize, beam_size).index_select(0, _ndid).view(_real_bsize, 1)
-				#inpute = inpute.view(bsize, beam_size, seql, isize).index_select(0, _ndid).view(_real_bsize, seql, isize)
-				for _m in self.modules():
-					if isinstance(layer, (CrossAttn, MultiHeadAttn,)) and layer.real_iK is not None:
-						layer.real_iK, layer.real_iV = tuple(_vu.view(bsize, beam_size, *list(_vu.size()[1:])).index_select(0, _ndid).view(_real_bsize, *list(_vu.size()[1:])) for _vu in (layer.real_iK, layer.real_iV,))
-				if _src_pad_mask is not None:
-					_src_pad_mask = _src_pad_mask.view(bsize, beam_size, 1, seql).index_select(0, _ndid).view(_real_bsize, 1, seql)
-				for k, value in states.items():
-					states[k] = [_vu.view(bsize, beam_size, *list(_vu.size()[1:])).index_select(0, _ndid).view(_real_bsize, *list(_vu.size()[1:])) for _vu in value]
+				wds = wds.index_select(0, _rind)
+				trans = trans.index_select(0, _rind)
+				scores = scores.index_select(0, _ndid)
 				sum_scores = sum_scores.index_select(0, _ndid)
-				trans = _trans.index_select(0, _ndid).view(_real_bsize, -1)
-				if length_penalty > 0.0:
-					lpv = lpv.view(bsize, beam_size).index_select(0, _ndid).view(_real_bsize, 1)
 				done_trans = done_trans.index_select(0, _ndid)
+				if length_penalty > 0.0:
+					lpv = lpv.index_select(0, _rind)
+				self.index_cross_attn_buffer(_rind)
+				if _src_pad_mask is not None:
+					_src_pad_mask = _src_pad_mask.index_select(0, _rind)
+				_inds_add_beam = _inds_add_beam.narrow(0, 0, bsize)
+				mapper = [mapper[_iu] for _iu in _ndid.tolist()]
+				# merge the removal of finished sentences into the reordering of states
+				_inds = _inds.index_select(0, _rind)
 
-				bsize, real_bsize = _bsize, _real_bsize
+			# states[i]: (bsize * beam_size, nquery, isize)
+
+			states = index_tensors(states, indices=_inds, dim=0)
 
-				# update mapper
-				for _ind, _iu in enumerate(_ndid.tolist()):
-					mapper[_ind] = mapper[_iu]
+		collect_rs(list(range(bsize)), trans, scores, lpv if length_penalty > 0.0 else None)
 
 		if return_mat:
 			rs = torch.stack(pad_tensors(rs), 0)
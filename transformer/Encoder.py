@@ -117,11 +117,11 @@ class Encoder(nn.Module):
 	# mask: (bsize, 1, seql), generated with:
 	#	mask = inputs.eq(pad_id).unsqueeze(1)
 
-	def forward(self, inputs, mask=None, **kwargs):
+	def forward(self, inputs, mask=None, pos=None, **kwargs):
 
 		out = self.wemb(inputs)
 		if self.pemb is not None:
-			out = self.pemb(inputs, expand=False).add(out, alpha=sqrt(out.size(-1)))
+			out = self.pemb(inputs, expand=False, pos=pos).add(out, alpha=sqrt(out.size(-1)))
 
 		if self.drop is not None:
 			out = self.drop(out)
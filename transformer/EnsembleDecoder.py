@@ -4,7 +4,8 @@ import torch
 from math import sqrt
 from torch import nn
 
-from utils.base import index_tensors
+from parallel.ensemble import MemberExecutor
+from utils.base import index_tensors, select_zero_
 from utils.decode.beam import expand_bsize_for_beam
 from utils.sampler import SampleMax
 from utils.torch.comp import all_done
@@ -15,12 +16,17 @@ from cnfg.vocab.base import eos_id, pad_id
 class Decoder(nn.Module):
 
 	# models: list of decoders
+	# executor: runs members one by one or concurrently, see parallel.ensemble.MemberExecutor
+	# stack_classifier: compute classifiers of members with one batched matrix multiplication if possible
 
-	def __init__(self, models, **kwargs):
+	def __init__(self, models, executor=None, stack_classifier=ensemble_stack_classifier, **kwargs):
 
 		super(Decoder, self).__init__()
 
 		self.nets = nn.ModuleList(models)
+		self.executor = MemberExecutor(len(models)) if executor is None else executor
+		self.stack_classifier = stack_classifier
+		self.stacked_classifier = None
 
 	# inpute: encoded representation from encoders [(bsize, seql, isize)...]
 	# inputo: decoded translation (bsize, nquery)
@@ -29,114 +35,141 @@ class Decoder(nn.Module):
 
 	def forward(self, inpute, inputo, src_pad_mask=None, **kwargs):
 
-		bsize, nquery = inputo.size()
+		_nm = len(self.nets)
+		outs = self.executor(self.member_forward, inpute, [inputo] * _nm, [src_pad_mask] * _nm)
 
-		outs = []
+		return torch.stack(outs).mean(0).log()
+
+	# inpute: encoded representation from encoders [(bsize, seql, isize)...]
+	# src_pad_mask: mask for given encoding source sentence (bsize, seql), see Encoder, get by:
+	#	src_pad_mask = input.eq(pad_id).unsqueeze(1)
+	# beam_size: the beam size for beam search
+	# max_len: maximum length to generate
+
+	def decode(self, inpute, src_pad_mask=None, beam_size=1, max_len=512, length_penalty=0.0, fill_pad=False, **kwargs):
+
+		return self.beam_decode(inpute, src_pad_mask, beam_size, max_len, length_penalty, fill_pad=fill_pad, **kwargs) if beam_size > 1 else self.greedy_decode(inpute, src_pad_mask, max_len, fill_pad=fill_pad, **kwargs)
+
+	# probabilities of the i-th member for forward
 
-		_mask = self.nets[0]._get_subsequent_mask(nquery)
+	def member_forward(self, i, inpute, inputo, src_pad_mask=None):
+
+		model = self.nets[i]
+		inputo, src_pad_mask = self.executor.to_member(i, inputo), self.executor.to_member(i, src_pad_mask)
+
+		_mask = model._get_subsequent_mask(inputo.size(1))
 
 		# the following line of code is to mask <pad> for the decoder,
 		# which I think is useless, since only <pad> may pay attention to previous <pad> tokens, whos loss will be omitted by the loss function.
 		#_mask = torch.gt(_mask + inputo.eq(pad_id).unsqueeze(1), 0)
 
-		for model, inputu in zip(self.nets, inpute):
+		out = model.wemb(inputo)
 
-			out = model.wemb(inputo)
+		if model.pemb is not None:
+			out = model.pemb(inputo, expand=False).add(out, alpha=sqrt(out.size(-1)))
+		if model.drop is not None:
+			out = model.drop(out)
 
-			if model.pemb is not None:
-				out = model.pemb(inputo, expand=False).add(out, alpha=sqrt(out.size(-1)))
-			if model.drop is not None:
-				out = model.drop(out)
+		for net in model.nets:
+			out = net(inpute, out, src_pad_mask, _mask)
 
-			for net in model.nets:
-				out = net(inputu, out, src_pad_mask, _mask)
+		if model.out_normer is not None:
+			out = model.out_normer(out)
 
-			if model.out_normer is not None:
-				out = model.out_normer(out)
+		return model.classifier(out).softmax(dim=-1)
 
-			outs.append(model.classifier(out).softmax(dim=-1))
+	# whether the classifiers of members can be computed with one batched matrix multiplication (identical shapes and devices)
 
-		return torch.stack(outs).mean(0).log()
+	def is_classifier_stackable(self):
 
-	# inpute: encoded representation from encoders [(bsize, seql, isize)...]
-	# src_pad_mask: mask for given encoding source sentence (bsize, seql), see Encoder, get by:
-	#	src_pad_mask = input.eq(pad_id).unsqueeze(1)
-	# beam_size: the beam size for beam search
-	# max_len: maximum length to generate
+		_cl = [model.classifier for model in self.nets]
+		if (not self.stack_classifier) or (len(_cl) < 2) or (self.executor.devices is not None) or (not all(isinstance(_, nn.Linear) for _ in _cl)):
+			return False
+		_w = _cl[0].weight
+		_has_bias = _cl[0].bias is not None
 
-	def decode(self, inpute, src_pad_mask=None, beam_size=1, max_len=512, length_penalty=0.0, fill_pad=False, **kwargs):
+		return all((_.weight.size() == _w.size()) and (_.weight.device == _w.device) and (_.weight.dtype == _w.dtype) and ((_.bias is not None) == _has_bias) for _ in _cl)
 
-		return self.beam_decode(inpute, src_pad_mask, beam_size, max_len, length_penalty, fill_pad=fill_pad, **kwargs) if beam_size > 1 else self.greedy_decode(inpute, src_pad_mask, max_len, fill_pad=fill_pad, **kwargs)
+	# stack classifier weights (and biases) of members into single tensors, and make the parameters of members views of them to avoid copies. Classifier weights bound to embeddings are bound to the views as well.
 
-	# inpute: encoded representation from encoders [(bsize, seql, isize)...]
-	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql), see Encoder, generated with:
-	#	src_pad_mask = input.eq(pad_id).unsqueeze(1)
-	# max_len: maximum length to generate
-
-	def greedy_decode(self, inpute, src_pad_mask=None, max_len=512, fill_pad=False, sample=False, **kwargs):
+	def get_stacked_classifier(self):
 
-		bsize, seql, isize = inpute[0].size()
+		_cl = [model.classifier for model in self.nets]
+		if (self.stacked_classifier is None) or any(_.weight.data_ptr() != _w.data_ptr() for _, _w in zip(_cl, self.stacked_classifier[0])):
+			_w = torch.stack([_.weight.data for _ in _cl], 0)
+			_b = None if _cl[0].bias is None else torch.stack([_.bias.data for _ in _cl], 0)
+			for _i, (model, _c) in enumerate(zip(self.nets, _cl)):
+				_bind = model.wemb.weight.is_set_to(_c.weight)
+				_c.weight = nn.Parameter(_w[_i], requires_grad=_c.weight.requires_grad)
+				if _bind:
+					model.wemb.weight = _c.weight
+				if _b is not None:
+					_c.bias = nn.Parameter(_b[_i], requires_grad=_c.bias.requires_grad)
+			self.stacked_classifier = (_w, _b,)
 
-		sqrt_isize = sqrt(out.size(-1))
+		return self.stacked_classifier
 
-		outs = []
+	# outs: [(bsize, nquery, isize)...] inputs to classifiers of members
+	# return probabilities averaged over members (bsize, nquery, nwd)
 
-		for model, inputu in zip(self.nets, inpute):
+	def stacked_classify(self, outs):
 
-			out = model.get_sos_emb(inputu)
+		_w, _b = self.get_stacked_classifier()
+		out = torch.stack(outs, 0)
+		_nm, bsize, nquery, isize = out.size()
+		out = out.view(_nm, bsize * nquery, isize)
+		out = out.bmm(_w.transpose(1, 2)) if _b is None else _b.unsqueeze(1).baddbmm(out, _w.transpose(1, 2))
 
-			# out: input to the decoder for the first step (bsize, 1, isize)
+		return out.softmax(dim=-1).mean(0).view(bsize, nquery, -1)
 
-			if model.pemb is not None:
-				out = model.pemb.get_pos(0).add(out, alpha=sqrt_isize)
-			if model.drop is not None:
-				out = model.drop(out)
+	# decode one step with the i-th member, the decoding states (dict) of the member are updated in place. wds (bsize, nquery) are decoded tokens from step (<sos> is used if wds is None)
+	# return probabilities (bsize, nquery, nwd) or inputs to the classifier (bsize, nquery, isize) if hidden
 
-			states = {}
+	def member_step(self, i, inpute, states, src_pad_mask, step, wds, hidden=False):
 
-			for _tmp, net in enumerate(model.nets):
-				out, _state = net(inputu, None, src_pad_mask, None, out)
-				states[_tmp] = _state
+		model = self.nets[i]
+		out = model.get_inc_emb(step, emb=model.get_sos_emb(inpute)) if wds is None else model.get_inc_emb(step, self.executor.to_member(i, wds))
+		out = model.inc_forward(inpute, out, states, self.executor.to_member(i, src_pad_mask), hidden=hidden)
 
-			if model.out_normer is not None:
-				out = model.out_normer(out)
+		return out if hidden else out.softmax(dim=-1)
 
-			# outs: [(bsize, 1, nwd)...]
+	# inpute: encoded representation from encoders [(bsize, seql, isize)...]
+	# states: list of decoding states of members
+	# return probabilities averaged over members (bsize, nquery, nwd)
 
-			outs.append(model.classifier(out).softmax(dim=-1))
+	def step(self, inpute, states, src_pad_mask, step, wds=None, stack=False):
 
-		out = torch.stack(outs).mean(0)
-		wds = SampleMax(out, dim=-1, keepdim=False) if sample else out.argmax(dim=-1)
+		_nm = len(self.nets)
+		outs = self.executor(self.member_step, inpute, states, [src_pad_mask] * _nm, [step] * _nm, [wds] * _nm, [stack] * _nm)
 
-		trans = [wds]
+		return self.stacked_classify(outs) if stack else torch.stack(outs).mean(0)
 
-		# done_trans: (bsize, 1)
+	# inpute: encoded representation from encoders [(bsize, seql, isize)...]
+	# src_pad_mask: mask for given encoding source sentence (bsize, 1, seql), see Encoder, generated with:
+	#	src_pad_mask = input.eq(pad_id).unsqueeze(1)
+	# max_len: maximum length to generate
 
-		done_trans = wds.eq(eos_id)
+	def greedy_decode(self, inpute, src_pad_mask=None, max_len=512, fill_pad=False, sample=False, **kwargs):
 
-		for i in range(1, max_len):
+		bsize = inpute[0].size(0)
 
-			outs = []
+		_stack = self.is_classifier_stackable()
+		states = [{} for _ in self.nets]
 
-			for model, inputu in zip(self.nets, inpute):
+		# out: (bsize, 1, nwd)
+		out = self.step(inpute, states, src_pad_mask, 0, stack=_stack)
+		# wds: (bsize, 1)
+		wds = SampleMax(out, dim=-1, keepdim=False) if sample else out.argmax(dim=-1)
 
-				out = model.wemb(wds)
-				if model.pemb is not None:
-					out = model.pemb.get_pos(i).add(out, alpha=sqrt_isize)
-				if model.drop is not None:
-					out = model.drop(out)
+		trans = [wds]
 
-				for _tmp, net in enumerate(model.nets):
-					out, _state = net(inputu, states[_tmp], src_pad_mask, None, out)
-					states[_tmp] = _state
+		# done_trans: (bsize, 1)
 
-				if model.out_normer is not None:
-					out = model.out_normer(out)
+		done_trans = wds.eq(eos_id)
 
-				# outs: [(bsize, 1, nwd)...]
-				outs.append(model.classifier(out).softmax(dim=-1))
+		for i in range(1, max_len):
 
-			out = torch.stack(outs).mean(0)
+			out = self.step(inpute, states, src_pad_mask, i, wds, stack=_stack)
 			wds = SampleMax(out, dim=-1, keepdim=False) if sample else out.argmax(dim=-1)
 
 			trans.append(wds.masked_fill(done_trans, pad_id) if fill_pad else wds)
@@ -155,46 +188,23 @@ class Decoder(nn.Module):
 
 	def beam_decode(self, inpute, src_pad_mask=None, beam_size=8, max_len=512, length_penalty=0.0, return_all=False, clip_beam=clip_beam_with_lp, fill_pad=False, **kwargs):
 
-		bsize, seql, isize = inpute[0].size()
+		bsize, seql = inpute[0].size()[:2]
 
 		beam_size2 = beam_size * beam_size
 		bsizeb2 = bsize * beam_size2
 		real_bsize = bsize * beam_size
 
-		sqrt_isize = sqrt(out.size(-1))
+		_stack = self.is_classifier_stackable()
+		states = [{} for _ in self.nets]
+
+		# out: (bsize, 1, nwd)
+		out = self.step(inpute, states, src_pad_mask, 0, stack=_stack).log()
 
 		if length_penalty > 0.0:
 			# lpv: length penalty vector for each beam (bsize * beam_size, 1)
-			lpv = inpute[0].new_ones(real_bsize, 1)
+			lpv = out.new_ones(real_bsize, 1)
 			lpv_base = 6.0 ** length_penalty
 
-		states = {}
-
-		outs = []
-
-		for _inum, (model, inputu) in enumerate(zip(self.nets, inpute)):
-
-			out = model.get_sos_emb(inputu)
-			if model.pemb is not None:
-				out = model.pemb.get_pos(0).add(out, alpha=sqrt_isize)
-			if model.drop is not None:
-				out = model.drop(out)
-
-			states[_inum] = {}
-
-			for _tmp, net in enumerate(model.nets):
-				out, _state = net(inputu, None, src_pad_mask, None, out)
-				states[_inum][_tmp] = _state
-
-			if model.out_normer is not None:
-				out = model.out_normer(out)
-
-			# outs: [(bsize, 1, nwd)]
-
-			outs.append(model.classifier(out).softmax(dim=-1))
-
-		out = torch.stack(outs).mean(0).log()
-
 		# scores: (bsize, 1, beam_size) => (bsize, beam_size)
 		# wds: (bsize * beam_size, 1)
 		# trans: (bsize * beam_size, 1)
@@ -211,9 +221,10 @@ class Decoder(nn.Module):
 
 		done_trans = wds.view(bsize, beam_size).eq(eos_id)
 
-		# inpute: (bsize, seql, isize) => (bsize * beam_size, seql, isize)
+		# instead of expanding inpute for beams, only update cross-attention buffers of members as Decoder.beam_decode.
 
-		inpute = [inputu.repeat(1, beam_size, 1).view(real_bsize, seql, isize) for inputu in inpute]
+		for model in self.nets:
+			model.repeat_cross_attn_buffer(beam_size)
 
 		# _src_pad_mask: (bsize, 1, seql) => (bsize * beam_size, 1, seql)
 
@@ -225,28 +236,8 @@ class Decoder(nn.Module):
 
 		for step in range(1, max_len):
 
-			outs = []
-
-			for _inum, (model, inputu) in enumerate(zip(self.nets, inpute)):
-
-				out = model.wemb(wds)
-				if model.pemb is not None:
-					out = model.pemb.get_pos(step).add(out, alpha=sqrt_isize)
-				if model.drop is not None:
-					out = model.drop(out)
-
-				for _tmp, net in enumerate(model.nets):
-					out, _state = net(inputu, states[_inum][_tmp], _src_pad_mask, None, out)
-					states[_inum][_tmp] = _state
-
-				if model.out_normer is not None:
-					out = model.out_normer(out)
-
-				# outs: [(bsize, beam_size, nwd)...]
-
-				outs.append(model.classifier(out).softmax(dim=-1).view(bsize, beam_size, -1))
-
-			out = torch.stack(outs).mean(0).log()
+			# out: (bsize, beam_size, nwd)
+			out = self.step(inpute, states, _src_pad_mask, step, wds, stack=_stack).log().view(bsize, beam_size, -1)
 
 			# find the top k ** 2 candidates and calculate route scores for them
 			# _scores: (bsize, beam_size, beam_size)
@@ -257,7 +248,8 @@ class Decoder(nn.Module):
 			# added_scores: (bsize, 1, beam_size) => (bsize, beam_size, beam_size)
 
 			_scores, _wds = out.topk(beam_size, dim=-1)
-			_scores = (_scores.masked_fill(done_trans.unsqueeze(2).expand(bsize, beam_size, beam_size), 0.0) + scores.unsqueeze(2).expand(bsize, beam_size, beam_size))
+			_done_trans_unsqueeze = done_trans.unsqueeze(2)
+			_scores = (_scores.masked_fill(_done_trans_unsqueeze.expand(bsize, beam_size, beam_size), 0.0) + sum_scores.unsqueeze(2).repeat(1, 1, beam_size).masked_fill_(select_zero_(_done_trans_unsqueeze.repeat(1, 1, beam_size), -1, 0), -inf_default))
 
 			if length_penalty > 0.0:
 				lpv.masked_fill_(~done_trans.view(real_bsize, 1), ((step + 6.0) ** length_penalty) / lpv_base)
@@ -310,9 +302,9 @@ class Decoder(nn.Module):
 
 			# update the corresponding hidden states
 			# states[i][j]: (bsize * beam_size, nquery, isize)
-			# _inds: (bsize, beam_size) => (bsize * beam_size)
+			# _inds: (bsize, beam_size) => (bsize * beam_size), moved to the devices of members
 
-			states = index_tensors(states, indices=_inds, dim=0)
+			states = self.executor(lambda i, x: index_tensors(x, indices=self.executor.to_member(i, _inds), dim=0), states, gather=False)
 
 		# if length penalty is only applied in the last step, apply length penalty
 		if (not clip_beam) and (length_penalty > 0.0):
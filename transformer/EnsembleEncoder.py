@@ -2,17 +2,28 @@
 
 from torch import nn
 
+from parallel.ensemble import MemberExecutor
+
 class Encoder(nn.Module):
 
-	def __init__(self, models, **kwargs):
+	# models: list of encoders
+	# executor: runs members one by one or concurrently, see parallel.ensemble.MemberExecutor
+
+	def __init__(self, models, executor=None, **kwargs):
 
 		super(Encoder, self).__init__()
 		self.nets = nn.ModuleList(models)
+		self.executor = MemberExecutor(len(models)) if executor is None else executor
 
 	# inputs: (bsize, seql)
 	# mask: (bsize, 1, seql), generated with:
 	#	mask = inputs.eq(pad_id).unsqueeze(1)
+	# outputs stay on the devices of members
 
 	def forward(self, *inputs, **kwargs):
 
-		return [model(*inputs, **kwargs) for model in self.nets]
+		def member_forward(i, *args):
+
+			return self.nets[i](*[self.executor.to_member(i, _) for _ in args], **kwargs)
+
+		return self.executor(member_forward, *[[_ for _i in range(len(self.nets))] for _ in inputs], gather=False)
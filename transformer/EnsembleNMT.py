@@ -3,11 +3,13 @@
 import torch
 from torch import nn
 
+from parallel.ensemble import MemberExecutor
 from transformer.EnsembleEncoder import Encoder
 # switch the comment between the following two lines to choose standard decoder or average decoder
 from transformer.EnsembleDecoder import Decoder
 #from transformer.EnsembleAvgDecoder import Decoder
 from utils.base import select_zero_
+from utils.decode.shortlist import shortlist_decode
 from utils.torch.comp import all_done
 
 from cnfg.ihyp import *
@@ -15,12 +17,24 @@ from cnfg.vocab.base import eos_id, pad_id
 
 class NMT(nn.Module):
 
-	def __init__(self, models, **kwargs):
+	# models: list of NMT models
+	# parallel: run members concurrently on a thread pool ("thread" or "device", for the latter members are distributed over devices with distribute), or one by one (None)
+
+	def __init__(self, models, parallel=ensemble_parallel, **kwargs):
 
 		super(NMT, self).__init__()
 
-		self.enc = Encoder([model.enc for model in models])
-		self.dec = Decoder([model.dec for model in models])
+		self.executor = MemberExecutor(len(models), parallel=parallel is not None)
+		self.enc = Encoder([model.enc for model in models], executor=self.executor)
+		self.dec = Decoder([model.dec for model in models], executor=self.executor)
+
+	# place members on devices in turn to run them concurrently (in decoding), inputs are expected on the first device, where outputs are gathered.
+
+	def distribute(self, devices):
+
+		self.executor.distribute([nn.ModuleList([_enc, _dec]) for _enc, _dec in zip(self.enc.nets, self.dec.nets)], devices)
+
+		return self
 
 	# inpute: source sentences from encoder (bsize, seql)
 	# inputo: decoded translation (bsize, nquery)
@@ -36,8 +50,18 @@ class NMT(nn.Module):
 	# inpute: source sentences from encoder (bsize, seql)
 	# beam_size: the beam size for beam search
 	# max_len: maximum length to generate
+	# shortlist: lexical shortlist (utils.decode.shortlist.Shortlist) to restrict the target vocabulary of all members
+
+	def decode(self, inpute, beam_size=1, max_len=None, length_penalty=0.0, shortlist=None, **kwargs):
+
+		if shortlist is not None:
+			# classifiers of members are restored after decoding, so that their stacked weights (see transformer.EnsembleDecoder) are still valid
+			_stacked = getattr(self.dec, "stacked_classifier", None)
+			rs = shortlist_decode(self, shortlist, inpute, beam_size, max_len, length_penalty, decoders=self.dec.nets, **kwargs)
+			if _stacked is not None:
+				self.dec.stacked_classifier = _stacked
 
-	def decode(self, inpute, beam_size=1, max_len=None, length_penalty=0.0, **kwargs):
+			return rs
 
 		mask = inpute.eq(pad_id).unsqueeze(1)
 
@@ -8,6 +8,8 @@ from transformer.Encoder import Encoder
 from transformer.Decoder import Decoder
 #from transformer.AvgDecoder import Decoder
 from utils.base import select_zero_
+from utils.decode.base import parse_draft
+from utils.decode.shortlist import shortlist_decode
 from utils.fmt.parser import parse_double_value_tuple
 from utils.relpos.base import share_rel_pos_cache
 from utils.torch.comp import all_done
@@ -48,24 +50,43 @@ class NMT(nn.Module):
 	# inputo: decoded translation (bsize, nquery)
 	# mask: user specified mask, otherwise it will be:
 	#	inpute.eq(pad_id).unsqueeze(1)
+	# src_pos, tgt_pos, tgt_mask, cross_mask: positions of inpute and inputo, the decoder self attention mask and the cross attention mask for packed sequences, see utils.fmt.pack.Packer.model_kwargs
 
-	def forward(self, inpute, inputo, mask=None, **kwargs):
+	def forward(self, inpute, inputo, mask=None, word_prediction=True, src_pos=None, tgt_pos=None, tgt_mask=None, cross_mask=None, **kwargs):
 
 		_mask = inpute.eq(pad_id).unsqueeze(1) if mask is None else mask
 
-		return self.dec(self.enc(inpute, _mask), inputo, _mask)
+		return self.dec(self.enc(inpute, _mask, pos=src_pos), inputo, _mask if cross_mask is None else cross_mask, word_prediction=word_prediction, pos=tgt_pos, tgt_mask=tgt_mask)
 
 	# inpute: source sentences from encoder (bsize, seql)
 	# beam_size: the beam size for beam search
 	# max_len: maximum length to generate
+	# draft: draft for speculative greedy decoding, see utils.decode.base.parse_draft
+	# shortlist: lexical shortlist (utils.decode.shortlist.Shortlist) to restrict the target vocabulary
 
-	def decode(self, inpute, beam_size=1, max_len=None, length_penalty=0.0, **kwargs):
+	def decode(self, inpute, beam_size=1, max_len=None, length_penalty=0.0, draft=None, shortlist=None, **kwargs):
+
+		if shortlist is not None:
+			return shortlist_decode(self, shortlist, inpute, beam_size, max_len, length_penalty, draft=draft, **kwargs)
+
+		mask = inpute.eq(pad_id).unsqueeze(1)
+
+		_max_len = (inpute.size(1) + max(64, inpute.size(1) // 4)) if max_len is None else max_len
+
+		if (beam_size == 1) and ((draft is not None) or (speculative_draft_layers is not None)):
+			return self.dec.speculative_greedy_decode(self.enc(inpute, mask), mask, _max_len, **parse_draft(draft, inpute, mask))
+
+		return (self.dec.decode_clip if decode_clip_finished else self.dec.decode)(self.enc(inpute, mask), mask, beam_size, _max_len, length_penalty)
+
+	# streaming decoding, returns a generator of tokens committed at each decoding step, see Decoder.decode_stream
+
+	def decode_stream(self, inpute, beam_size=1, max_len=None, length_penalty=0.0, **kwargs):
 
 		mask = inpute.eq(pad_id).unsqueeze(1)
 
 		_max_len = (inpute.size(1) + max(64, inpute.size(1) // 4)) if max_len is None else max_len
 
-		return self.dec.decode(self.enc(inpute, mask), mask, beam_size, _max_len, length_penalty)
+		return self.dec.decode_stream(self.enc(inpute, mask), mask, beam_size, _max_len, length_penalty, **kwargs)
 
 	def load_base(self, base_nmt):
 
@@ -7,8 +7,9 @@ from torch import nn
 from modules.TA import PositionwiseFF, ResCrossAttn, ResSelfAttn
 from modules.dropout import Dropout
 from transformer.Decoder import Decoder as DecoderBase, DecoderLayer as DecoderLayerBase
-from utils.base import index_tensors, select_zero_
-from utils.decode.beam import expand_bsize_for_beam
+from utils.base import index_tensors
+from utils.decode.base import get_inc_pos
+from utils.decode.beam import beam_step, expand_bsize_for_beam
 from utils.fmt.parser import parse_none
 from utils.plm.base import copy_plm_parameter
 from utils.sampler import SampleMax
@@ -102,25 +103,25 @@ class Decoder(DecoderBase):
 		else:
 			self.nets = nn.ModuleList([DecoderLayer(isize, fhsize=_fhsize, dropout=dropout, attn_drop=attn_drop, num_head=num_head, ahsize=_ahsize, model_name=model_name) for i in range(num_layer)])
 
-	def forward(self, inpute, inputo, src_pad_mask=None, word_prediction=False, **kwargs):
+	def forward(self, inpute, inputo, src_pad_mask=None, word_prediction=False, pos=None, tgt_mask=None, **kwargs):
 
 		nquery = inputo.size(-1)
 
 		out = self.wemb(inputo)
 		if self.pemb is not None:
-			out = out + self.pemb.narrow(0, pemb_start_ind, nquery)
+			out = out + (self.pemb.narrow(0, pemb_start_ind, nquery) if pos is None else self.pemb[pos + pemb_start_ind])
 		if self.out_normer is not None:
 			out = self.out_normer(out)
 		if self.drop is not None:
 			out = self.drop(out)
 
-		_mask = self._get_subsequent_mask(nquery)
+		_mask = self._get_subsequent_mask(nquery) if tgt_mask is None else tgt_mask
 
 		for net in self.nets:
 			out = net(inpute, out, src_pad_mask, _mask)
 
 		if word_prediction:
-			out = self.lsm(self.classifier(out))
+			out = self.fused_output(out) if word_prediction == "fused" else self.lsm(self.classifier(out))
 
 		return out
 
@@ -177,8 +178,6 @@ class Decoder(DecoderBase):
 
 		bsize, seql = inpute.size()[:2]
 
-		beam_size2 = beam_size * beam_size
-		bsizeb2 = bsize * beam_size2
 		real_bsize = bsize * beam_size
 
 		out = self.get_sos_emb(inpute)
@@ -186,6 +185,8 @@ class Decoder(DecoderBase):
 		if length_penalty > 0.0:
 			lpv = out.new_ones(real_bsize, 1)
 			lpv_base = 6.0 ** length_penalty
+		else:
+			lpv = None
 
 		if self.pemb is not None:
 			out = out + self.pemb[pemb_start_ind]
@@ -207,7 +208,6 @@ class Decoder(DecoderBase):
 		sum_scores = scores
 		wds = wds.view(real_bsize, 1)
 		trans = wds
-		_inds_add_beam2 = torch.arange(0, bsizeb2, beam_size2, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
 		_inds_add_beam = torch.arange(0, real_bsize, beam_size, dtype=wds.dtype, device=wds.device).unsqueeze(1).expand(bsize, beam_size)
 
 		done_trans = wds.view(bsize, beam_size).eq(eos_id)
@@ -234,35 +234,13 @@ class Decoder(DecoderBase):
 
 			out = self.lsm(self.classifier(out)).view(bsize, beam_size, -1)
 
-			_scores, _wds = out.topk(beam_size, dim=-1)
-			_done_trans_unsqueeze = done_trans.unsqueeze(2)
-			_scores = (_scores.masked_fill(_done_trans_unsqueeze.expand(bsize, beam_size, beam_size), 0.0) + sum_scores.unsqueeze(2).repeat(1, 1, beam_size).masked_fill_(select_zero_(_done_trans_unsqueeze.repeat(1, 1, beam_size), -1, 0), -inf_default))
-
-			if length_penalty > 0.0:
-				lpv.masked_fill_(~done_trans.view(real_bsize, 1), ((step + 6.0) ** length_penalty) / lpv_base)
-
-			if clip_beam and (length_penalty > 0.0):
-				scores, _inds = (_scores.view(real_bsize, beam_size) / lpv.expand(real_bsize, beam_size)).view(bsize, beam_size2).topk(beam_size, dim=-1)
-				_tinds = (_inds + _inds_add_beam2).view(real_bsize)
-				sum_scores = _scores.view(bsizeb2).index_select(0, _tinds).view(bsize, beam_size)
-			else:
-				scores, _inds = _scores.view(bsize, beam_size2).topk(beam_size, dim=-1)
-				_tinds = (_inds + _inds_add_beam2).view(real_bsize)
-				sum_scores = scores
-
-			wds = _wds.view(bsizeb2).index_select(0, _tinds).view(real_bsize, 1)
-
-			_inds = (_inds // beam_size + _inds_add_beam).view(real_bsize)
+			scores, sum_scores, wds, _inds, _done_trans, lpv = beam_step(out, sum_scores, done_trans, lpv, ((step + 6.0) ** length_penalty) / lpv_base if length_penalty > 0.0 else None, clip_beam)
 
 			trans = torch.cat((trans.index_select(0, _inds), wds.masked_fill(done_trans.view(real_bsize, 1), pad_id) if fill_pad else wds), 1)
 
-			done_trans = (done_trans.view(real_bsize).index_select(0, _inds) | wds.eq(eos_id).squeeze(1)).view(bsize, beam_size)
+			done_trans = _done_trans
 
-			_done = False
-			if length_penalty > 0.0:
-				lpv = lpv.index_select(0, _inds)
-			elif (not return_all) and all_done(done_trans.select(1, 0), bsize):
-				_done = True
+			_done = (length_penalty <= 0.0) and (not return_all) and all_done(done_trans.select(1, 0), bsize)
 
 			if _done or all_done(done_trans, real_bsize):
 				break
@@ -282,6 +260,23 @@ class Decoder(DecoderBase):
 
 			return trans.view(bsize, beam_size, -1).select(1, 0)
 
+	def get_inc_emb(self, start, wds=None, emb=None, max_pos=None):
+
+		out = self.wemb(wds) if emb is None else emb
+		if self.pemb is not None:
+			out = out + (self.pemb.narrow(0, pemb_start_ind + start, out.size(1)) if isinstance(start, int) else self.pemb[get_inc_pos(start, out.size(1)) + pemb_start_ind])
+		if self.out_normer is not None:
+			out = self.out_normer(out)
+		if self.drop is not None:
+			out = self.drop(out)
+
+		return out
+
+	# self.out_normer is applied to embeddings in BART
+	def get_inc_hidden(self, out):
+
+		return out
+
 	# BART starts decoding with the <eos> token
 	def get_sos_emb(self, inpute, bsize=None):
 
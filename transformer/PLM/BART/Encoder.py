@@ -72,12 +72,12 @@ class Encoder(EncoderBase):
 		else:
 			self.nets = nn.ModuleList([EncoderLayer(isize, fhsize=_fhsize, dropout=dropout, attn_drop=attn_drop, num_head=num_head, ahsize=_ahsize, model_name=model_name) for i in range(num_layer)])
 
-	def forward(self, inputs, mask=None, **kwargs):
+	def forward(self, inputs, mask=None, pos=None, **kwargs):
 
 		seql = inputs.size(1)
 		out = self.wemb(inputs)
 		if self.pemb is not None:
-			out = out + self.pemb.narrow(0, pemb_start_ind, seql)
+			out = out + (self.pemb.narrow(0, pemb_start_ind, seql) if pos is None else self.pemb[pos + pemb_start_ind])
 		if self.out_normer is not None:
 			out = self.out_normer(out)
 		if self.drop is not None:
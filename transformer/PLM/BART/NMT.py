@@ -3,6 +3,8 @@
 from transformer.PLM.BART.Decoder import Decoder
 from transformer.PLM.BART.Encoder import Encoder
 from transformer.PLM.NMT import NMT as NMTBase
+from utils.decode.base import parse_draft
+from utils.decode.shortlist import shortlist_decode
 from utils.fmt.parser import parse_double_value_tuple, parse_none
 from utils.plm.base import set_ln_ieps
 from utils.relpos.base import share_rel_pos_cache
@@ -33,15 +35,30 @@ class NMT(NMTBase):
 		if rel_pos_enabled:
 			share_rel_pos_cache(self)
 
-	def forward(self, inpute, inputo, mask=None, word_prediction=False, **kwargs):
+	def forward(self, inpute, inputo, mask=None, word_prediction=False, src_pos=None, tgt_pos=None, tgt_mask=None, cross_mask=None, **kwargs):
 
 		_mask = inpute.eq(pad_id).unsqueeze(1) if mask is None else mask
 
-		return self.dec(self.enc(inpute, _mask), inputo, _mask, word_prediction=word_prediction)
+		return self.dec(self.enc(inpute, _mask, pos=src_pos), inputo, _mask if cross_mask is None else cross_mask, word_prediction=word_prediction, pos=tgt_pos, tgt_mask=tgt_mask)
 
-	def decode(self, inpute, beam_size=1, max_len=None, length_penalty=0.0):
+	def decode(self, inpute, beam_size=1, max_len=None, length_penalty=0.0, draft=None, shortlist=None, **kwargs):
+
+		if shortlist is not None:
+			return shortlist_decode(self, shortlist, inpute, beam_size, max_len, length_penalty, draft=draft, **kwargs)
+
+		mask = inpute.eq(pad_id).unsqueeze(1)
+		_max_len = (inpute.size(1) + max(64, inpute.size(1) // 4)) if max_len is None else max_len
+
+		if (beam_size == 1) and ((draft is not None) or (speculative_draft_layers is not None)):
+			return self.dec.speculative_greedy_decode(self.enc(inpute, mask), mask, _max_len, **parse_draft(draft, inpute, mask))
+
+		return (self.dec.decode_clip if decode_clip_finished else self.dec.decode)(self.enc(inpute, mask), mask, beam_size, _max_len, length_penalty)
+
+	# streaming decoding, returns a generator of tokens committed at each decoding step, see Decoder.decode_stream
+
+	def decode_stream(self, inpute, beam_size=1, max_len=None, length_penalty=0.0, **kwargs):
 
 		mask = inpute.eq(pad_id).unsqueeze(1)
 		_max_len = (inpute.size(1) + max(64, inpute.size(1) // 4)) if max_len is None else max_len
 
-		return self.dec.decode(self.enc(inpute, mask), mask, beam_size, _max_len, length_penalty)
+		return self.dec.decode_stream(self.enc(inpute, mask), mask, beam_size, _max_len, length_penalty, **kwargs)
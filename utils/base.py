@@ -97,6 +97,8 @@ def index_tensors(*inputs, indices=None, dim=0):
 			outputs.append(tuple(index_tensors(tmpu, indices=indices, dim=dim) for tmpu in inputu))
 		elif isinstance(inputu, list):
 			outputs.append([index_tensors(tmpu, indices=indices, dim=dim) for tmpu in inputu])
+		elif hasattr(inputu, "index_select"):
+			outputs.append(inputu.index_select(dim, indices))
 		else:
 			outputs.append(inputu)
 
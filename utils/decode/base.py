@@ -1,5 +1,7 @@
 #encoding: utf-8
 
+import torch
+
 def set_is_decoding(m, mode):
 
 	for _ in m.modules():
@@ -24,3 +26,24 @@ class model_decoding:
 	def __exit__(self, *inputs, **kwargs):
 
 		set_is_decoding(self.net, False)
+
+# parse the draft for speculative decoding (`Decoder.speculative_greedy_decode`), which can be the number of decoder layers used as the draft, a draft decoder, or a draft model with its own encoder (to encode inpute with mask).
+
+def parse_draft(draft, inpute, mask):
+
+	if draft is None:
+		return {}
+	elif isinstance(draft, int):
+		return {"draft_layers": draft}
+	elif hasattr(draft, "enc"):
+		return {"draft": draft.dec, "draft_inpute": draft.enc(inpute, mask), "draft_src_pad_mask": mask}
+	else:
+		return {"draft": draft}
+
+# steps (bsize, nquery) of nquery tokens of each sequence from its start step (a tensor of (bsize)) in incremental decoding.
+
+def get_inc_pos(start, nquery):
+
+	_pos = start.unsqueeze(1)
+
+	return _pos if nquery == 1 else _pos + torch.arange(nquery, dtype=start.dtype, device=start.device)
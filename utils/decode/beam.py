@@ -1,7 +1,13 @@
 #encoding: utf-8
 
+import torch
 from torch import Tensor
 
+from utils.base import select_zero_
+
+from cnfg.ihyp import inf_default
+from cnfg.vocab.base import eos_id
+
 def repeat_bsize_for_beam_tensor(tin, beam_size):
 
 	_tsize = list(tin.size())
@@ -23,7 +29,53 @@ def expand_bsize_for_beam(*inputs, beam_size=1):
 			outputs.append(tuple(expand_bsize_for_beam(tmpu, beam_size=beam_size) for tmpu in inputu))
 		elif isinstance(inputu, list):
 			outputs.append([expand_bsize_for_beam(tmpu, beam_size=beam_size) for tmpu in inputu])
+		elif hasattr(inputu, "repeat_bsize_for_beam"):
+			outputs.append(inputu.repeat_bsize_for_beam(beam_size))
 		else:
 			outputs.append(inputu)
 
 	return outputs[0] if len(inputs) == 1 else tuple(outputs)
+
+# one step of beam search: extend each beam with its top beam_size tokens, and keep the top beam_size candidates of each sentence.
+# out: log-probabilities of the next token of beams (bsize, beam_size, nwd)
+# sum_scores: accumulated scores of beams (bsize, beam_size)
+# done_trans: whether beams are finished (bsize, beam_size)
+# lpv: length penalty of beams (bsize * beam_size, 1) or None (without length penalty), values of unfinished beams are replaced with lp (a float, or a tensor of (bsize * beam_size, 1)) before selecting candidates
+# clip_beam: select candidates with length penalty applied
+# return: scores (bsize, beam_size), sum_scores (bsize, beam_size), selected tokens wds (bsize * beam_size, 1), indexes of the beams extended by candidates _inds (bsize * beam_size), and done_trans/lpv of candidates
+
+def beam_step(out, sum_scores, done_trans, lpv=None, lp=None, clip_beam=False):
+
+	bsize, beam_size = done_trans.size()
+	beam_size2 = beam_size * beam_size
+	real_bsize = bsize * beam_size
+
+	# _scores: route scores of the top k ** 2 candidates (bsize, beam_size, beam_size), finished beams are only extended by one candidate without changing their scores
+	_scores, _wds = out.topk(beam_size, dim=-1)
+	_done_trans_unsqueeze = done_trans.unsqueeze(2)
+	_scores = (_scores.masked_fill(_done_trans_unsqueeze.expand(bsize, beam_size, beam_size), 0.0) + sum_scores.unsqueeze(2).repeat(1, 1, beam_size).masked_fill_(select_zero_(_done_trans_unsqueeze.repeat(1, 1, beam_size), -1, 0), -inf_default))
+
+	if lpv is not None:
+		_done = done_trans.view(real_bsize, 1)
+		lpv = torch.where(_done, lpv, lp) if isinstance(lp, Tensor) else lpv.masked_fill_(~_done, lp)
+
+	# _inds: indexes of the top-k candidates (bsize, beam_size) in the k ** 2 ones of each sentence
+	_inds_add_beam2 = torch.arange(0, bsize * beam_size2, beam_size2, dtype=_wds.dtype, device=_wds.device).unsqueeze(1)
+	if clip_beam and (lpv is not None):
+		scores, _inds = (_scores.view(real_bsize, beam_size) / lpv.expand(real_bsize, beam_size)).view(bsize, beam_size2).topk(beam_size, dim=-1)
+		_tinds = (_inds + _inds_add_beam2).view(real_bsize)
+		sum_scores = _scores.view(-1).index_select(0, _tinds).view(bsize, beam_size)
+	else:
+		scores, _inds = _scores.view(bsize, beam_size2).topk(beam_size, dim=-1)
+		_tinds = (_inds + _inds_add_beam2).view(real_bsize)
+		sum_scores = scores
+
+	wds = _wds.view(-1).index_select(0, _tinds).view(real_bsize, 1)
+	# reduce indexes in _inds from (beam_size ** 2) to beam_size, thus the beams extended by candidates are pointed out
+	_inds = (_inds // beam_size + torch.arange(0, real_bsize, beam_size, dtype=_inds.dtype, device=_inds.device).unsqueeze(1)).view(real_bsize)
+
+	done_trans = (done_trans.view(real_bsize).index_select(0, _inds) | wds.eq(eos_id).squeeze(1)).view(bsize, beam_size)
+	if lpv is not None:
+		lpv = lpv.index_select(0, _inds)
+
+	return scores, sum_scores, wds, _inds, done_trans, lpv
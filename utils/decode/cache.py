@@ -0,0 +1,154 @@
+#encoding: utf-8
+
+import torch
+
+from cnfg.ihyp import kv_cache_init_len
+
+# preallocated key/value cache for incremental self-attention in decoding, keys and values are stored step-major: (max_len, bsize, nheads, adim), so that the filled part is always contiguous. The cache grows (doubles) in case the capacity is exceeded.
+class KVCache:
+
+	# size: initial capacity (number of decoding steps)
+
+	def __init__(self, size=kv_cache_init_len, **kwargs):
+
+		self.size = size
+		self.k = self.v = self.k_buf = self.v_buf = None
+		self.length = 0
+
+	# real_iK: keys of new steps (bsize, nheads, adim, nquery)
+	# real_iV: values of new steps (bsize, nheads, nquery, adim)
+	# return keys (bsize, nheads, adim, seql) and values (bsize, nheads, seql, adim) of all cached steps
+
+	def update(self, real_iK, real_iV):
+
+		nquery = real_iV.size(2)
+		_length = self.length + nquery
+		if self.k is None:
+			_size = max(self.size, _length)
+			bsize, nheads, _, adim = real_iV.size()
+			self.k, self.v = real_iK.new_empty(_size, bsize, nheads, adim), real_iV.new_empty(_size, bsize, nheads, adim)
+		elif _length > self.k.size(0):
+			self.resize(max(_length, self.k.size(0) * 2))
+		self.k.narrow(0, self.length, nquery).copy_(real_iK.permute(3, 0, 1, 2))
+		self.v.narrow(0, self.length, nquery).copy_(real_iV.permute(2, 0, 1, 3))
+		self.length = _length
+
+		return self.get()
+
+	def get(self):
+
+		if self.length > 0:
+			_l = self.length
+			return self.k.narrow(0, 0, _l).permute(1, 2, 3, 0), self.v.narrow(0, 0, _l).permute(1, 2, 0, 3)
+		else:
+			return None, None
+
+	# support modules which unpack states as (keys, values,) tuples.
+
+	def __iter__(self):
+
+		return iter(self.get())
+
+	def resize(self, size):
+
+		_k, _v = self.k.new_empty(size, *self.k.size()[1:]), self.v.new_empty(size, *self.v.size()[1:])
+		_l = self.length
+		if _l > 0:
+			_k.narrow(0, 0, _l).copy_(self.k.narrow(0, 0, _l))
+			_v.narrow(0, 0, _l).copy_(self.v.narrow(0, 0, _l))
+		self.k, self.v = _k, _v
+		self.k_buf = self.v_buf = None
+
+	# discard cached steps after the first length ones (e.g., of draft tokens rejected in speculative decoding).
+
+	def narrow(self, length):
+
+		self.length = min(self.length, length)
+
+		return self
+
+	# reorder (beam search) or reduce (removing finished sentences) the batch dimension (dim 0 of decoding states) by gathering into the spare buffer, which is then swapped with the current one.
+
+	def index_select(self, dim, indices):
+
+		if self.length > 0:
+			_l, _dim = self.length, dim + 1
+			_size = list(self.k.size())
+			_size[_dim] = indices.size(0)
+			if (self.k_buf is None) or (list(self.k_buf.size()) != _size):
+				self.k_buf, self.v_buf = self.k.new_empty(_size), self.v.new_empty(_size)
+			torch.index_select(self.k.narrow(0, 0, _l), _dim, indices, out=self.k_buf.narrow(0, 0, _l))
+			torch.index_select(self.v.narrow(0, 0, _l), _dim, indices, out=self.v_buf.narrow(0, 0, _l))
+			self.k, self.k_buf, self.v, self.v_buf = self.k_buf, self.k, self.v_buf, self.v
+
+		return self
+
+	def repeat_bsize_for_beam(self, beam_size):
+
+		if self.length > 0:
+			_l = self.length
+			_size, bsize = self.k.size(0), self.k.size(1)
+			_isize = self.k.size()[2:]
+			_k, _v = self.k.new_empty(_size, bsize * beam_size, *_isize), self.v.new_empty(_size, bsize * beam_size, *_isize)
+			_k.narrow(0, 0, _l).view(_l, bsize, beam_size, *_isize).copy_(self.k.narrow(0, 0, _l).unsqueeze(2))
+			_v.narrow(0, 0, _l).view(_l, bsize, beam_size, *_isize).copy_(self.v.narrow(0, 0, _l).unsqueeze(2))
+			self.k, self.v = _k, _v
+			self.k_buf = self.v_buf = None
+
+		return self
+
+	# select sequences (with indices, or keep all of them if None) from the cached steps after the first start steps (which are masked for all selected sequences), and append the batch of another cache (e.g., of new sentences admitted into the decoding batch, optional) in the same pass. The cached steps of the shorter batch are aligned to the right, and the zero-filled steps in front of them should be masked out in attention.
+
+	def merge(self, indices=None, start=0, other=None):
+
+		_l1 = self.length - start
+		if (other is None) or (other.length == 0):
+			_bsize2 = _l2 = 0
+		else:
+			_l2, _bsize2 = other.length, other.k.size(1)
+		if (self.k is None) or (_l1 <= 0):
+			if _bsize2 > 0:
+				self.k, self.v, self.length = other.k, other.v, _l2
+				self.k_buf = self.v_buf = None
+			return self
+		_bsize1 = self.k.size(1) if indices is None else indices.size(0)
+		_l = max(_l1, _l2)
+		_size = list(self.k.size())
+		_size[0], _size[1] = max(_size[0], _l), _bsize1 + _bsize2
+		if (self.k_buf is None) or (list(self.k_buf.size()) != _size):
+			self.k_buf, self.v_buf = self.k.new_empty(_size), self.v.new_empty(_size)
+		for _src, _tgt in ((self.k, self.k_buf,), (self.v, self.v_buf,),):
+			_s = _src.narrow(0, start, _l1)
+			if _bsize2 > 0:
+				_t = _tgt.narrow(1, 0, _bsize1)
+				if _l > _l1:
+					_t.narrow(0, 0, _l - _l1).zero_()
+				_t.narrow(0, _l - _l1, _l1).copy_(_s if indices is None else _s.index_select(1, indices))
+			elif indices is None:
+				_tgt.narrow(0, 0, _l1).copy_(_s)
+			else:
+				torch.index_select(_s, 1, indices, out=_tgt.narrow(0, 0, _l1))
+		if _bsize2 > 0:
+			for _src, _tgt in ((other.k, self.k_buf,), (other.v, self.v_buf,),):
+				_t = _tgt.narrow(1, _bsize1, _bsize2)
+				if _l > _l2:
+					_t.narrow(0, 0, _l - _l2).zero_()
+				_t.narrow(0, _l - _l2, _l2).copy_(_src.narrow(0, 0, _l2))
+		self.k, self.k_buf, self.v, self.v_buf = self.k_buf, self.k, self.v_buf, self.v
+		self.length = _l
+
+		return self
+
+# keep the first length cached steps of decoding states (a dict of layer index: KVCache or (keys, values,) tuple).
+
+def narrow_states(states, length):
+
+	for _k, _v in states.items():
+		if isinstance(_v, KVCache):
+			_v.narrow(length)
+		else:
+			_iK, _iV = _v
+			if _iK.size(-1) > length:
+				states[_k] = (_iK.narrow(-1, 0, length), _iV.narrow(2, 0, length),)
+
+	return states
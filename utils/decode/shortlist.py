@@ -0,0 +1,90 @@
+#encoding: utf-8
+
+import torch
+from torch import nn
+
+from utils.h5serial import h5File
+from utils.torch.quant import QLinear, qlinear_index_select
+
+from cnfg.vocab.base import init_normal_token_id
+
+# lexical shortlist built by `tools/shortlist.py`: candidate target tokens of each source token and the most frequent target tokens. Special tokens (with indices smaller than nspecial) are always kept at their original positions, so that decoders work in the reduced vocabulary without any change.
+
+class Shortlist:
+
+	def __init__(self, fname, nspecial=init_normal_token_id, **kwargs):
+
+		with h5File(fname, "r") as f:
+			self.table, self.common = torch.from_numpy(f["shortlist"][()]).long(), torch.from_numpy(f["common"][()]).long()
+		self.nspecial = nspecial
+		self.cache = {}
+
+	def get_table(self, device):
+
+		if device not in self.cache:
+			self.cache[device] = (self.table.to(device, non_blocking=True), self.common.to(device, non_blocking=True), torch.arange(self.nspecial, dtype=torch.long, device=device),)
+
+		return self.cache[device]
+
+	# inpute: source sentences (bsize, seql)
+	# return sorted vocabulary indices (nselect) shared by the batch
+
+	def __call__(self, inpute):
+
+		_table, _common, _special = self.get_table(inpute.device)
+		rs = torch.cat((_common, _table.index_select(0, inpute.view(-1)).view(-1),), 0)
+
+		return torch.cat((_special, rs[rs.ge(self.nspecial)].unique(sorted=True),), 0)
+
+# restrict the target vocabulary of decoders (a decoder or a list of them, e.g., with the draft decoder of speculative decoding or members of ensembles) to indices (from Shortlist) by slicing their embeddings and classifiers for decoding, decoded token indices have to be mapped back with indices. Indices are moved to the device of each decoder.
+
+class decoder_shortlist:
+
+	def __init__(self, decoders, indices, **kwargs):
+
+		self.decoders, self.indices = (list(decoders) if isinstance(decoders, (list, tuple,)) else [decoders]), indices
+
+	def __enter__(self):
+
+		self.params = []
+		for _dec in self.decoders:
+			_wemb, _classifier = _dec.wemb, _dec.classifier
+			_wemb_w = _wemb.weight
+			_ind = self.indices.to(_wemb_w.device, non_blocking=True)
+			_wemb.weight = nn.Parameter(_wemb_w.index_select(0, _ind), requires_grad=False)
+			# int8 quantized classifiers (utils.torch.quant) are replaced with their slices
+			if isinstance(_classifier, QLinear):
+				self.params.append((_wemb_w, _classifier,))
+				_dec.classifier = qlinear_index_select(_classifier, _ind)
+			else:
+				self.params.append((_wemb_w, (_classifier.weight, _classifier.bias,),))
+				_classifier.weight = _wemb.weight if _classifier.weight.is_set_to(_wemb_w) else nn.Parameter(_classifier.weight.index_select(0, _ind), requires_grad=False)
+				if _classifier.bias is not None:
+					_classifier.bias = nn.Parameter(_classifier.bias.index_select(0, _ind), requires_grad=False)
+
+		return self.decoders
+
+	def __exit__(self, *inputs, **kwargs):
+
+		for _dec, (_wemb_w, _classifier,) in zip(self.decoders, self.params):
+			_dec.wemb.weight = _wemb_w
+			if isinstance(_classifier, tuple):
+				_dec.classifier.weight, _dec.classifier.bias = _classifier
+			else:
+				_dec.classifier = _classifier
+		self.params = None
+
+# decode inpute (bsize, seql) with model.decode in the vocabulary reduced by shortlist, the draft decoder of speculative decoding (see utils.decode.base.parse_draft) is reduced as well. decoders: decoders to reduce instead of model.dec (e.g., members of ensembles).
+
+def shortlist_decode(model, shortlist, inpute, *args, draft=None, decoders=None, **kwargs):
+
+	_ind = shortlist(inpute)
+	_decs = [model.dec] if decoders is None else list(decoders)
+	if (draft is not None) and (not isinstance(draft, int)):
+		_dec = getattr(draft, "dec", draft)
+		if _dec is not model.dec:
+			_decs.append(_dec)
+	with decoder_shortlist(_decs, _ind):
+		rs = model.decode(inpute, *args, draft=draft, **kwargs)
+
+	return _ind[rs]
@@ -0,0 +1,29 @@
+#encoding: utf-8
+
+from cnfg.vocab.base import eos_id
+
+# collect newly committed tokens of streaming beam decoding (`Decoder.beam_decode_stream`), the common prefix of all beams of a sentence can no longer change, and the best beam is committed for sentences in final.
+# trans: (bsize, beam_size, nquery) with pad_id after <eos>
+# nout: numbers of tokens committed for each sentence (None for finished sentences), updated in place
+# final: list of bools (bsize) for sentences whose translations are determined (by the best beam)
+# return a list (bsize) of lists of newly committed token indices, <eos> is the last committed token of each sentence (if it is reached)
+
+def beam_stream_update(trans, nout, final=None):
+
+	_best = trans.select(1, 0)
+	_plen = trans.eq(_best.unsqueeze(1)).all(1).long().cumprod(1).sum(1).tolist()
+	_final = [False for _ in nout] if final is None else final
+	rs = []
+	for _i, (_tran, _n, _l, _f,) in enumerate(zip(_best.tolist(), nout, _plen, _final)):
+		if _n is None:
+			rs.append([])
+		else:
+			_tran = _tran[_n:] if _f else _tran[_n:_l]
+			if eos_id in _tran:
+				_tran = _tran[:_tran.index(eos_id) + 1]
+				nout[_i] = None
+			else:
+				nout[_i] = _n + len(_tran)
+			rs.append(_tran)
+
+	return rs
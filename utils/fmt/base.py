@@ -6,7 +6,7 @@ from gzip import open as gz_open
 from lzma import open as xz_open
 from random import shuffle
 
-from cnfg.hyp import raw_cache_compression_level
+from cnfg.hyp import attn_cost_ratio, attn_cost_ref_len, raw_cache_compression_level
 from cnfg.vocab.base_bart import pad_id
 
 serial_func, deserial_func = repr, eval
@@ -252,7 +252,7 @@ def shuffle_pair(*inputs):
 
 	return zip(*tmp)
 
-def get_bsize(maxlen, maxtoken, maxbsize):
+def get_bsize_linear(maxlen, maxtoken, maxbsize):
 
 	rs = max(maxtoken // maxlen, 1)
 	if (rs % 2 == 1) and (rs > 1):
@@ -260,6 +260,18 @@ def get_bsize(maxlen, maxtoken, maxbsize):
 
 	return min(rs, maxbsize)
 
+# the cost of a batch is estimated as bsize * maxlen * (1 + ratio * maxlen), the linear term for FFN/classifier and the quadratic term for attention, batch sizes are decided to keep the cost of batches equal to that of maxtoken tokens in sentences of ref_len tokens.
+
+def get_bsize_cost(maxlen, maxtoken, maxbsize, ratio=attn_cost_ratio, ref_len=attn_cost_ref_len):
+
+	rs = max(int(maxtoken * (1.0 + ratio * ref_len) / (maxlen * (1.0 + ratio * maxlen))), 1)
+	if (rs % 2 == 1) and (rs > 1):
+		rs -= 1
+
+	return min(rs, maxbsize)
+
+get_bsize = get_bsize_linear if attn_cost_ratio is None else get_bsize_cost
+
 def list2dict(lin, kfunc=None):
 
 	return {k: lu for k, lu in enumerate(lin)} if kfunc is None else {kfunc(k): lu for k, lu in enumerate(lin)}
@@ -3,7 +3,7 @@
 from math import ceil
 
 from utils.fmt.base import get_bsize, list_reader as file_reader, pad_batch
-from utils.fmt.vocab.base import map_batch
+from utils.fmt.vocab.base import map_batch, map_batch_pad
 
 from cnfg.vocab.base import pad_id
 
@@ -51,3 +51,10 @@ def batch_padder(finput, ftarget, vocabi, vocabt, bsize, maxpad, maxpart, maxtok
 
 	for i_d, td, mlen_i, mlen_t in batch_mapper(finput, ftarget, vocabi, vocabt, bsize, maxpad, maxpart, maxtoken, minbsize, **kwargs):
 		yield pad_batch(i_d, mlen_i, pad_id=pad_id), pad_batch(td, mlen_t, pad_id=pad_id)
+
+# the same as batch_padder, but batches are mapped and padded to numpy arrays at once by map_batch_pad
+
+def batch_array_padder(finput, ftarget, vocabi, vocabt, bsize, maxpad, maxpart, maxtoken, minbsize, map_batch_pad=map_batch_pad, batch_loader=batch_loader, pad_id=pad_id, **kwargs):
+
+	for i_d, td, mlen_i, mlen_t in batch_loader(finput, ftarget, bsize, maxpad, maxpart, maxtoken, minbsize, **kwargs):
+		yield map_batch_pad(i_d, vocabi, mlen=mlen_i + 2, pad_id=pad_id), map_batch_pad(td, vocabt, mlen=mlen_t + 2, pad_id=pad_id)
@@ -0,0 +1,198 @@
+#encoding: utf-8
+
+import numpy
+from os import makedirs
+from os.path import isdir, join as pjoin
+
+from utils.fmt.json import dumpf, loadf
+from utils.h5serial import h5File
+
+from cnfg.vocab.base import pad_id
+
+""" flat data format: a directory with one contiguous unpadded token array (`<key>.bin`) and a sentence offset index (`<key>.idx`, int64, number of sentences + 1) for each side (e.g., src and tgt), a batch plan index (`batch.idx`, int64, sentence offsets of batches, number of batches + 1), and `meta.json` (token dtype, pad_id, keys, and other data like nword). Data is read with numpy.memmap and padded when batches are loaded.
+"""
+
+meta_file = "meta.json"
+batch_file = "batch.idx"
+index_dtype = numpy.int64
+
+# lengths of right-padded sequences in a batch (bsize, seql)
+
+def get_seq_lens(x, pad_id=pad_id):
+
+	_nonpad = x != pad_id
+	_l = x.shape[-1]
+
+	return numpy.where(_nonpad.any(-1), _l - _nonpad[:, ::-1].argmax(-1), 0)
+
+class FlatWriter:
+
+	# data: other data (e.g., {"nword": [nwordi, nwordt]}) saved in meta.json
+
+	def __init__(self, path, keys=("src", "tgt",), dtype=numpy.int32, pad_id=pad_id, data=None, **kwargs):
+
+		if not isdir(path):
+			makedirs(path)
+		self.path, self.keys, self.dtype, self.pad_id, self.data = path, tuple(keys), numpy.dtype(dtype), pad_id, data
+		self.files = {_k: (open(pjoin(path, "%s.bin" % _k), "wb"), open(pjoin(path, "%s.idx" % _k), "wb"),) for _k in self.keys}
+		self.ntok = {_k: 0 for _k in self.keys}
+		self.fbatch = open(pjoin(path, batch_file), "wb")
+		self.nsent = 0
+		for _k in self.keys:
+			numpy.zeros(1, dtype=index_dtype).tofile(self.files[_k][-1])
+		numpy.zeros(1, dtype=index_dtype).tofile(self.fbatch)
+		self.ndata = 0
+
+	# batch: a right-padded numpy array (bsize, seql) for each key
+
+	def write(self, *batch):
+
+		_bsize = None
+		for _k, _b in zip(self.keys, batch):
+			_lens = get_seq_lens(_b, pad_id=self.pad_id)
+			_ftok, _fidx = self.files[_k]
+			_b[numpy.arange(_b.shape[-1]) < _lens[:, None]].astype(self.dtype, copy=False).tofile(_ftok)
+			(numpy.cumsum(_lens, dtype=index_dtype) + self.ntok[_k]).tofile(_fidx)
+			self.ntok[_k] += _lens.sum().item()
+			_bsize = _b.shape[0]
+		self.nsent += _bsize
+		numpy.array([self.nsent], dtype=index_dtype).tofile(self.fbatch)
+		self.ndata += 1
+
+	def close(self):
+
+		for _ in self.files.values():
+			for _f in _:
+				_f.close()
+		self.fbatch.close()
+		_data = {"ndata": [self.ndata]}
+		if self.data is not None:
+			_data.update(self.data)
+		dumpf({"dtype": self.dtype.name, "pad_id": self.pad_id, "keys": list(self.keys), "data": _data}, pjoin(self.path, meta_file))
+
+	def __enter__(self):
+
+		return self
+
+	def __exit__(self, *inputs, **kwargs):
+
+		self.close()
+
+# a side (e.g., "src") of flat data, indexed like HDF5 groups of batches: grp[str(i)][()] returns the i-th padded batch (int32). Batches are the stored ones, or given by plan (a list of sentence index arrays, see `utils/fmt/rebatch.py`) if it is set.
+
+class FlatGroup:
+
+	def __init__(self, tokens, offsets, batches, pad_id=pad_id, dtype=numpy.int32, **kwargs):
+
+		self.tokens, self.offsets, self.batches, self.pad_id, self.dtype = tokens, offsets, batches, pad_id, dtype
+		self.plan = None
+
+	def __len__(self):
+
+		return (self.batches.shape[0] - 1) if self.plan is None else len(self.plan)
+
+	def __contains__(self, key):
+
+		return 0 <= int(key) < len(self)
+
+	def keys(self):
+
+		return (str(_) for _ in range(len(self)))
+
+	def __getitem__(self, key):
+
+		return FlatBatch(self, int(key))
+
+	def get_plan(self, ind):
+
+		_ids = self.plan[ind]
+		_s = self.offsets[_ids]
+		_lens = self.offsets[_ids + 1] - _s
+		_pos = numpy.arange(_lens.max().item())
+		_mask = _pos < _lens[:, None]
+		rs = numpy.full(_mask.shape, self.pad_id, dtype=self.dtype)
+		rs[_mask] = self.tokens[(_s[:, None] + _pos)[_mask]]
+
+		return rs
+
+	def get(self, ind):
+
+		if self.plan is not None:
+			return self.get_plan(ind)
+		_o = self.offsets[self.batches[ind]:self.batches[ind + 1] + 1]
+		_lens = numpy.diff(_o)
+		_mlen = _lens.max().item()
+		_tok = self.tokens[_o[0]:_o[-1]]
+		# batches without padding are reshaped memmap slices without copying if tokens are stored with the dtype of batches
+		if (_lens.min().item() == _mlen) and (_tok.dtype == self.dtype):
+			return _tok.reshape(_lens.shape[0], _mlen)
+		rs = numpy.full((_lens.shape[0], _mlen,), self.pad_id, dtype=self.dtype)
+		rs[numpy.arange(_mlen) < _lens[:, None]] = _tok
+
+		return rs
+
+class FlatBatch:
+
+	def __init__(self, group, ind, **kwargs):
+
+		self.group, self.ind = group, ind
+
+	def __getitem__(self, key):
+
+		return self.group.get(self.ind)[key]
+
+# reader of flat data with the interface of HDF5 files written by `tools/mkiodata.py`: data["ndata"][()], data["nword"][()] and data["src"][str(i)][()].
+
+class FlatData:
+
+	def __init__(self, path, mode="r", **kwargs):
+
+		_meta = loadf(pjoin(path, meta_file))
+		_dtype = numpy.dtype(_meta["dtype"])
+		self.pad_id = _meta["pad_id"]
+		_batches = numpy.memmap(pjoin(path, batch_file), dtype=index_dtype, mode="r")
+		# copy-on-write mappings, so that torch.from_numpy works on (unpadded) slices, while files are never modified
+		self.groups = {_k: FlatGroup(numpy.memmap(pjoin(path, "%s.bin" % _k), dtype=_dtype, mode="c"), numpy.memmap(pjoin(path, "%s.idx" % _k), dtype=index_dtype, mode="r"), _batches, pad_id=self.pad_id) for _k in _meta["keys"]}
+		self.data = {_k: numpy.array(_v, dtype=numpy.int32) for _k, _v in _meta["data"].items()}
+
+	def __getitem__(self, key):
+
+		return self.groups[key] if key in self.groups else self.data[key]
+
+	def seq_lens(self, key):
+
+		return numpy.diff(self.groups[key].offsets)
+
+	# replace the stored batches with plan (a list of sentence index arrays, the stored batches are restored if None), ndata is updated accordingly
+
+	def set_batches(self, plan):
+
+		for _ in self.groups.values():
+			_.plan = plan
+		self.data["ndata"] = numpy.array([len(next(iter(self.groups.values())))], dtype=numpy.int32)
+
+	def __contains__(self, key):
+
+		return (key in self.groups) or (key in self.data)
+
+	def keys(self):
+
+		return list(self.groups.keys()) + list(self.data.keys())
+
+	def close(self):
+
+		self.groups = self.data = None
+
+	def __enter__(self):
+
+		return self
+
+	def __exit__(self, *inputs, **kwargs):
+
+		self.close()
+
+# open training data in the flat format (directories) or HDF5 files
+
+def open_data(fname, mode="r", **kwargs):
+
+	return FlatData(fname, mode=mode) if isdir(fname) else h5File(fname, mode, **kwargs)
@@ -0,0 +1,82 @@
+#encoding: utf-8
+
+import torch
+
+from cnfg.ihyp import *
+from cnfg.vocab.base import pad_id
+
+# pack (source, target) pairs of a batch into rows of at most max(seq_len, the padded length of the batch) tokens on both sides, pairs are added to rows in order (next-fit) since sentences of a batch have similar lengths. Sentences are right padded with pad_id, positions restart from 0 for each sentence, and segment ids (from 1, 0 for padding) tell sentences in rows apart.
+
+class Packer:
+
+	def __init__(self, seq_len=pack_seq_len, pad_id=pad_id, **kwargs):
+
+		self.seq_len, self.pad_id = seq_len, pad_id
+		self.ntoken = self.nbefore = self.nafter = 0
+
+	# src: (bsize, seql_src), tgt: (bsize, seql_tgt) with <sos> and <eos>
+	# returns packed src, tgt and (src segment ids, src positions, tgt segment ids, tgt positions) to be converted by model_kwargs
+
+	def __call__(self, src, tgt):
+
+		_src_mask, _tgt_mask = src.ne(self.pad_id), tgt.ne(self.pad_id)
+		slens, tlens = _src_mask.sum(-1), _tgt_mask.sum(-1)
+		scap, tcap = max(src.size(1), self.seq_len), max(tgt.size(1), self.seq_len)
+		rows, soff, toff, segs = [], [], [], []
+		_r = -1
+		_s, _t, _k = scap, tcap, 0
+		for _sl, _tl in zip(slens.tolist(), tlens.tolist()):
+			if ((_s + _sl) > scap) or ((_t + _tl) > tcap):
+				_r += 1
+				_s = _t = _k = 0
+			_k += 1
+			rows.append(_r)
+			soff.append(_s)
+			toff.append(_t)
+			segs.append(_k)
+			_s += _sl
+			_t += _tl
+		nrow = _r + 1
+		rows, soff, toff, segs = [torch.as_tensor(_, dtype=torch.long) for _ in (rows, soff, toff, segs,)]
+
+		def pack(x, mask, off, width):
+
+			_cols = off.unsqueeze(1) + torch.arange(x.size(1), dtype=torch.long).unsqueeze(0)
+			_ind = (rows.unsqueeze(1).expand_as(x)[mask], _cols[mask],)
+			rs = x.new_full((nrow, width,), self.pad_id)
+			rs[_ind] = x[mask]
+			seg = torch.zeros((nrow, width,), dtype=torch.long)
+			seg[_ind] = segs.unsqueeze(1).expand_as(x)[mask]
+			pos = torch.zeros((nrow, width,), dtype=torch.long)
+			pos[_ind] = torch.arange(x.size(1), dtype=torch.long).unsqueeze(0).expand_as(x)[mask]
+
+			return rs, seg, pos
+
+		src_rs, src_seg, src_pos = pack(src, _src_mask, soff, (soff + slens).max().item())
+		tgt_rs, tgt_seg, tgt_pos = pack(tgt, _tgt_mask, toff, (toff + tlens).max().item())
+		_ntoken = slens.sum().item() + tlens.sum().item()
+		self.ntoken += _ntoken
+		self.nbefore += src.numel() + tgt.numel() - _ntoken
+		self.nafter += src_rs.numel() + tgt_rs.numel() - _ntoken
+
+		return src_rs, tgt_rs, (src_seg, src_pos, tgt_seg, tgt_pos,)
+
+	# build arguments of models from the packing information (on device), and ignore targets (ot) across sentence boundaries, i.e., the <sos> of the next sentence predicted from the <eos> of the previous one. Returns the targets and keyword arguments of models.
+	# mask: block-diagonal mask of the encoder self attention, tgt_mask: block-diagonal causal mask of the decoder self attention, cross_mask: mask of the cross attention, padding queries attend to all keys to avoid NaN.
+
+	def model_kwargs(self, pack, ot, device=None):
+
+		src_seg, src_pos, tgt_seg, tgt_pos = pack if device is None else [_.to(device, non_blocking=True) for _ in pack]
+		nquery = ot.size(1)
+		_iseg, _oseg = tgt_seg.narrow(1, 0, nquery), tgt_seg.narrow(1, 1, nquery)
+		ot = ot.masked_fill(_oseg.ne(_iseg) & _oseg.ne(0), self.pad_id)
+		_qseg = _iseg.unsqueeze(-1)
+		_causal = torch.ones((nquery, nquery,), dtype=torch.bool, device=ot.device).triu(1)
+
+		return ot, {"mask": src_seg.unsqueeze(-1).ne(src_seg.unsqueeze(1)), "src_pos": src_pos, "tgt_pos": tgt_pos.narrow(1, 0, nquery), "tgt_mask": _qseg.ne(_iseg.unsqueeze(1)) | _causal, "cross_mask": _qseg.ne(src_seg.unsqueeze(1)) & _qseg.ne(0)}
+
+	def report(self):
+
+		_nbefore, _nafter = self.ntoken + self.nbefore, self.ntoken + self.nafter
+
+		return "Padding ratio: %.2f%% before packing, %.2f%% after packing" % (float(self.nbefore) / _nbefore * 100.0 if _nbefore > 0 else 0.0, float(self.nafter) / _nafter * 100.0 if _nafter > 0 else 0.0,)
@@ -1,26 +1,89 @@
 #encoding: utf-8
 
 import sys
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
+from os import environ
 
-from utils.fmt.base import iter_to_str, loop_file_so, sys_open
+from utils.fmt.base import iter_to_str, sys_open
+
+# files are processed in chunks of chunk_size lines with batch calls of (fast) tokenizers, by nproc processes in parallel if nproc > 1, the order of lines is kept.
+
+chunk_size = 1024
+nproc = 1
 
 tokenize_line = lambda lin, processor: " ".join(processor.convert_ids_to_tokens(processor(lin, return_token_type_ids=False, return_attention_mask=False).input_ids))
 map_line = lambda lin, processor: " ".join(iter_to_str(processor(*lin.split("\t"), return_token_type_ids=False, return_attention_mask=False).input_ids))
 detokenize_line = lambda lin, processor: processor(lin, skip_special_tokens=False, clean_up_tokenization_spaces=False)
 
+def tokenize_lines(lines, processor):
+
+	return [" ".join(processor.convert_ids_to_tokens(_)) for _ in processor(lines, return_token_type_ids=False, return_attention_mask=False).input_ids]
+
+# lines are encoded with one batch call if all of them have the same number of fields (1 for texts or 2 for text pairs, split by tabs)
+
+def map_lines(lines, processor):
+
+	_lines = [_.split("\t") for _ in lines]
+	_nfields = set(len(_) for _ in _lines)
+	if (len(_nfields) == 1) and (_nfields.pop() < 3):
+		return [" ".join(iter_to_str(_)) for _ in processor(*[list(_) for _ in zip(*_lines)], return_token_type_ids=False, return_attention_mask=False).input_ids]
+
+	return [map_line(_, processor) for _ in lines]
+
+def detokenize_lines(lines, processor):
+
+	return [detokenize_line(_, processor.decode) for _ in lines]
+
+def process_chunk_core(lines, process_func, processor):
+
+	_rs = iter(process_func([_ for _ in lines if _], processor))
+	rs = [next(_rs) if _ else "" for _ in lines]
+	rs.append("")
+
+	return "\n".join(rs).encode("utf-8")
+
+_processor = None
+
+def init_processor(build_processor):
+
+	global _processor
+	# processes already run in parallel, avoid the thread pool of fast tokenizers in each of them
+	environ["TOKENIZERS_PARALLELISM"] = "false"
+	_processor = build_processor()
+
+def process_chunk(lines, process_func=None):
+
+	return process_chunk_core(lines, process_func, _processor)
+
+def loop_file_so_chunk(fsrc, frs, process_func=None, build_processor=None, chunk_size=chunk_size, nproc=nproc):
+
+	with sys_open(fsrc, "rb") as frd, sys_open(frs, "wb") as fwrt:
+		_lines = (line.strip().decode("utf-8") for line in frd)
+		_chunks = iter(lambda: list(islice(_lines, chunk_size)), [])
+		if nproc > 1:
+			with Pool(nproc, initializer=init_processor, initargs=(build_processor,)) as pool:
+				for _ in pool.imap(partial(process_chunk, process_func=process_func), _chunks):
+					fwrt.write(_)
+		else:
+			_proc = build_processor()
+			for _ in _chunks:
+				fwrt.write(process_chunk_core(_, process_func, _proc))
+
 def map_line_with_token_type(lin, processor):
 
 	_ = processor(*lin.decode("utf-8").split("\t"), return_token_type_ids=True, return_attention_mask=False)
 
 	return " ".join(iter_to_str(_.input_ids)), " ".join(iter_to_str(_.token_type_ids))
 
-def tokenize_file(fsrc, vcb, frs, Tokenizer=None):
+def tokenize_file(fsrc, vcb, frs, Tokenizer=None, chunk_size=chunk_size, nproc=nproc):
 
-	return loop_file_so(fsrc, frs, process_func=tokenize_line, processor=Tokenizer(vocab_file=vcb))
+	return loop_file_so_chunk(fsrc, frs, process_func=tokenize_lines, build_processor=partial(Tokenizer, vocab_file=vcb), chunk_size=chunk_size, nproc=nproc)
 
-def map_file(fsrc, vcb, frs, Tokenizer=None):
+def map_file(fsrc, vcb, frs, Tokenizer=None, chunk_size=chunk_size, nproc=nproc):
 
-	return loop_file_so(fsrc, frs, process_func=map_line, processor=Tokenizer(vocab_file=vcb))
+	return loop_file_so_chunk(fsrc, frs, process_func=map_lines, build_processor=partial(Tokenizer, vocab_file=vcb), chunk_size=chunk_size, nproc=nproc)
 
 def map_file_with_token_type(fsrc, vcb, frsi, frst, Tokenizer=None):
 
@@ -39,6 +102,6 @@ def map_file_with_token_type(fsrc, vcb, frsi, frst, Tokenizer=None):
 				fwrti.write(ens)
 				fwrtt.write(ens)
 
-def map_back_file(fsrc, vcb, frs, Tokenizer=None):
+def map_back_file(fsrc, vcb, frs, Tokenizer=None, chunk_size=chunk_size, nproc=nproc):
 
-	return loop_file_so(fsrc, frs, process_func=detokenize_line, processor=Tokenizer(vocab_file=vcb).decode)
+	return loop_file_so_chunk(fsrc, frs, process_func=detokenize_lines, build_processor=partial(Tokenizer, vocab_file=vcb), chunk_size=chunk_size, nproc=nproc)
@@ -0,0 +1,61 @@
+#encoding: utf-8
+
+import numpy
+from math import ceil
+from random import getrandbits
+
+from utils.fmt.base import get_bsize
+
+from cnfg.ihyp import max_pad_tokens_sentence, max_sentences_gpu, max_tokens_gpu, normal_tokens_vs_pad_tokens
+
+# sort sentences by lens, with a random order among sentences of the same length (buckets), the random generator is seeded from the python random module, whose state is saved with training states.
+
+def bucket_shuffle(lens):
+
+	_rng = numpy.random.default_rng(getrandbits(64))
+	_perm = _rng.permutation(lens.shape[0])
+
+	return _perm[numpy.argsort(lens[_perm], kind="stable")]
+
+# split sentences sorted by their lengths (slens, total numbers of tokens of all sides) into batches with the rules of `utils.fmt.dual.batch_loader`: the maximum length of a batch is decided by its shortest sentence and maxpad/maxpart, and the batch size by `get_bsize`.
+# return a list of (start, end) of batches
+
+def batch_bounds(slens, bsize, maxpad, maxpart, maxtoken, minbsize):
+
+	_f_maxpart = float(maxpart)
+	_ndata = slens.shape[0]
+	rs = []
+	_s = 0
+	while _s < _ndata:
+		lgth = slens[_s].item()
+		maxlen = lgth + min(maxpad, ceil(lgth / _f_maxpart))
+		_e = min(_s + get_bsize(maxlen, maxtoken, bsize), numpy.searchsorted(slens, maxlen, side="right").item())
+		_e = min(max(_e, _s + minbsize), _ndata)
+		rs.append((_s, _e,))
+		_s = _e
+
+	return rs
+
+# rebuild batches of flat data (`utils/fmt/flat.py`) from its sentences at each call (epoch), so that batches vary across epochs and the token budget can be changed without regenerating data.
+# td: FlatData
+# keys: sides whose lengths are summed for batching
+# minbsize: number of GPUs, bsize and maxtoken are expanded accordingly like `tools/mkiodata.py`
+
+class Rebatcher:
+
+	def __init__(self, td, keys=("src", "tgt",), bsize=max_sentences_gpu, maxpad=max_pad_tokens_sentence, maxpart=normal_tokens_vs_pad_tokens, maxtoken=max_tokens_gpu, minbsize=1, **kwargs):
+
+		self.td, self.maxpad, self.maxpart, self.minbsize = td, maxpad, maxpart, minbsize
+		self.bsize, self.maxtoken = bsize * minbsize, maxtoken * minbsize
+		# stored sentences start with <sos> and end with <eos>, which are not counted in batching by `tools/mkiodata.py`
+		self.lens = sum(td.seq_lens(_) for _ in keys) - 2 * len(keys)
+
+	# return the list of batch keys (unshuffled) of the new plan
+
+	def __call__(self):
+
+		_order = bucket_shuffle(self.lens)
+		_plan = [_order[_s:_e] for _s, _e in batch_bounds(self.lens[_order], self.bsize, self.maxpad, self.maxpart, self.maxtoken, self.minbsize)]
+		self.td.set_batches(_plan)
+
+		return [str(_) for _ in range(len(_plan))]
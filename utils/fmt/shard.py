@@ -0,0 +1,57 @@
+#encoding: utf-8
+
+from itertools import islice
+
+from utils.fmt.dual import batch_loader as dual_batch_loader
+from utils.h5serial import h5File
+
+from cnfg.ihyp import h5_libver
+
+# split sorted data into nshard shards of consecutive batches, batch boundaries are decided by running batch_loader over the whole data, so that batching each shard separately produces exactly the same batches.
+# inputs and kwargs: arguments of batch_loader
+# return a list of (start line, end line, index of the first batch) for each (non-empty) shard
+
+def plan_shards(nshard, *inputs, batch_loader=dual_batch_loader, **kwargs):
+
+	_nsents = [len(_[0]) for _ in batch_loader(*inputs, **kwargs)]
+	_nbatch = len(_nsents)
+	rs = []
+	_lind = _bind = 0
+	for _i in range(1, nshard + 1):
+		_eind = _nbatch * _i // nshard
+		if _eind > _bind:
+			_nline = sum(_nsents[_bind:_eind])
+			rs.append((_lind, _lind + _nline, _bind,))
+			_lind += _nline
+			_bind = _eind
+
+	return rs
+
+# wrap file_reader to only read lines in [start, end)
+
+def range_reader(file_reader, start, end):
+
+	def _reader(*args, **kwargs):
+
+		return islice(file_reader(*args, **kwargs), start, end)
+
+	return _reader
+
+# merge the groups (keys) of HDF5 shards (in order) into frs with continuous batch ids. Compressed chunks are copied as they are, without being decompressed and compressed again.
+# return the number of batches
+
+def merge_h5(frs, fshards, keys=("src", "tgt",), mode="w"):
+
+	curd = 0
+	with h5File(frs, mode, libver=h5_libver) as rsf:
+		_grps = tuple(rsf.require_group(_) for _ in keys)
+		for _fshard in fshards:
+			with h5File(_fshard, "r") as _shard:
+				_ndata = _shard["ndata"][()].item()
+				for _grp, _k in zip(_grps, keys):
+					_sgrp = _shard[_k]
+					for _i in range(_ndata):
+						_grp.copy(_sgrp[str(_i)], _grp, name=str(curd + _i))
+				curd += _ndata
+
+	return curd
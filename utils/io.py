@@ -7,6 +7,7 @@ from threading import Thread
 
 from utils.h5serial import h5load, h5save
 from utils.torch.comp import torch_no_grad
+from utils.torch.quant import is_quant_mp, is_quantized, load_quant_mp, quant_mp_func
 
 from cnfg.ihyp import h5modelwargs, hdf5_save_parameter_name, n_keep_best#, hdf5_load_parameter_name
 
@@ -31,6 +32,8 @@ def load_model_cpu_np(modf, base_model, mp=None, strict=False, print_func=print,
 def load_model_cpu_auto(modf, base_model, mp=None, **kwargs):
 
 	_mp = h5load(modf, restore_list=True) if mp is None else mp
+	if is_quant_mp(_mp):
+		return load_quant_mp(base_model, _mp, **kwargs)
 	_load_model_func = load_model_cpu_p if isinstance(_mp, list) else load_model_cpu_np
 
 	return _load_model_func(modf, base_model, mp=_mp, **kwargs)
@@ -85,7 +88,7 @@ def save_model(model, fname, sub_module=False, print_func=print, mtyp=None, h5ar
 
 	_msave = model.module if sub_module else model
 	try:
-		h5save(mp_func(_msave), fname, h5args=h5args)
+		h5save((quant_mp_func if is_quantized(_msave) else mp_func)(_msave), fname, h5args=h5args)
 		if mtyp is not None:
 			save_model_cleaner(fname, mtyp)
 	except Exception as e:
@@ -0,0 +1,127 @@
+#encoding: utf-8
+
+import torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from cnfg.ihyp import prefetch_batches, prefetch_workers
+
+# a pinned host buffer which is reused for batches of the same slot, it is enlarged when a larger batch comes.
+
+class PinnedBuffer:
+
+	def __init__(self):
+
+		self.data = self.event = None
+
+	def wait(self):
+
+		if self.event is not None:
+			self.event.synchronize()
+			self.event = None
+
+	# record the point where the consumer releases the batch in the buffer, which shall not be overwritten before the copy to GPU issued by the consumer is done
+
+	def release(self):
+
+		self.event = torch.cuda.Event()
+		self.event.record()
+
+	def __call__(self, x):
+
+		_numel = x.numel()
+		if (self.data is None) or (self.data.dtype != x.dtype) or (self.data.numel() < _numel):
+			self.data = torch.empty(_numel, dtype=x.dtype, pin_memory=True)
+
+		return self.data.narrow(0, 0, _numel).view(x.size()).copy_(x)
+
+# iterate over batches of training data (HDF5 or flat) in the order of tl, the next nprefetch batches are read in the background by nworkers threads and handed over as tensors (in pinned and reused host buffers if pin_memory is True, to be moved with `.to(device, non_blocking=True)`).
+# td: the opened training data
+# tl: list of batch keys
+# keys: the groups (e.g., ("src", "tgt",)) to read, the batch key followed by a tensor for each group is yielded for each batch
+# the time the consumer waits for data and the number of ready batches in the queue are counted for report.
+
+class BatchPrefetcher:
+
+	def __init__(self, td, tl, keys=("src", "tgt",), nprefetch=prefetch_batches, nworkers=prefetch_workers, pin_memory=False, **kwargs):
+
+		self.grps, self.tl, self.nprefetch = tuple(td[_] for _ in keys), tl, max(nprefetch, 1)
+		self.pin_memory = pin_memory and torch.cuda.is_available()
+		self.pool = ThreadPoolExecutor(max_workers=max(nworkers, 1), thread_name_prefix="prefetch")
+		# each slot is written by the worker only after the batch previously held in it is released, the last two released batches may still be in use
+		self.nbuf = self.nprefetch + 2
+		self.bufs = [tuple(PinnedBuffer() for _ in keys) for _ in range(self.nbuf)] if self.pin_memory else None
+		self.wait_time = 0.0
+		self.nbatch = self.sum_depth = 0
+
+	def load(self, i_d, slot):
+
+		if self.bufs is None:
+			return (i_d, *(torch.from_numpy(_[i_d][()]) for _ in self.grps),)
+		_bufs = self.bufs[slot]
+		rs = [i_d]
+		for _grp, _buf in zip(self.grps, _bufs):
+			_ = torch.from_numpy(_grp[i_d][()])
+			_buf.wait()
+			rs.append(_buf(_))
+
+		return tuple(rs)
+
+	def __iter__(self):
+
+		_tl, _nbuf = self.tl, self.nbuf
+		_q = deque()
+		_ntodo = len(_tl)
+		_ind = _cur = 0
+		while (_ind < _ntodo) and (len(_q) < self.nprefetch):
+			_q.append(self.pool.submit(self.load, _tl[_ind], _ind % _nbuf))
+			_ind += 1
+		_prev_slot = None
+		try:
+			while _q:
+				_f = _q.popleft()
+				if _prev_slot is not None:
+					for _buf in self.bufs[_prev_slot]:
+						_buf.release()
+				self.sum_depth += sum(1 for _ in _q if _.done()) + (1 if _f.done() else 0)
+				_st = time()
+				rs = _f.result()
+				self.wait_time += time() - _st
+				self.nbatch += 1
+				_cur += 1
+				if _ind < _ntodo:
+					_q.append(self.pool.submit(self.load, _tl[_ind], _ind % _nbuf))
+					_ind += 1
+				if self.bufs is not None:
+					_prev_slot = (_cur - 1) % _nbuf
+				yield rs
+		finally:
+			for _ in _q:
+				_.cancel()
+
+	def __len__(self):
+
+		return len(self.tl)
+
+	def status(self):
+
+		return {"wait_time": self.wait_time, "nbatch": self.nbatch, "queue_depth": (self.sum_depth / self.nbatch) if self.nbatch > 0 else 0.0}
+
+	def report(self):
+
+		_ = self.status()
+
+		return "Data wait: %.2fs over %d batches, average ready batches: %.2f/%d" % (_["wait_time"], _["nbatch"], _["queue_depth"], self.nprefetch,)
+
+	def close(self):
+
+		self.pool.shutdown(wait=True, cancel_futures=True)
+
+	def __enter__(self):
+
+		return self
+
+	def __exit__(self, *inputs, **kwargs):
+
+		self.close()
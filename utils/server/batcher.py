@@ -1,131 +1,110 @@
 #encoding: utf-8
 
-from asyncio import sleep as asleep
-from threading import Lock
-from time import sleep
+from asyncio import get_running_loop
+from collections import deque
+from threading import Condition
+from time import time
 
 from utils.thread import start_thread_with_keeper
 
-from cnfg.server import batcher_maintain_interval as maintain_interval, batcher_wait_interval as wait_interval, batcher_watcher_interval as watcher_interval, thread_keeper_interval
+from cnfg.server import batcher_max_sentences as max_sentences, batcher_max_tokens as max_tokens, batcher_max_wait as max_wait, thread_keeper_interval
 
-class BatchWrapper:
+def seq_cost(x):
 
-	def __init__(self, handler, wait_interval=wait_interval, maintain_interval=maintain_interval, watcher_interval=watcher_interval):
+	return len(x.split()) if isinstance(x, str) else len(x)
 
-		self.handler, self.wait_interval, self.maintain_interval, self.watcher_interval = handler, wait_interval, maintain_interval, watcher_interval
-		self.ipool, self.opool, self.rids, self.idpool, self.cid, self.mids, self.ipool_lck, self.opool_lck, self.rids_lck, self.idpool_lck, self.cid_lck, self.mids_lck = {}, {}, set(), set(), 1, set(), Lock(), Lock(), Lock(), Lock(), Lock(), Lock()
-		self.opids = tuple()
-		self.running = True
-		self.t_process, self.t_mnt = start_thread_with_keeper([self.is_running], None, thread_keeper_interval, target=self.processor), start_thread_with_keeper([self.is_running], None, thread_keeper_interval, target=self.maintainer)
+def set_future_result(fut, rs):
 
-	async def __call__(self, x):
+	if not fut.done():
+		fut.set_result(rs)
 
-		_watcher_interval = self.watcher_interval
-		_id = None
-		_rs = x
-		try:
-			_id = self.get_id()
-			with self.ipool_lck:
-				self.ipool[_id] = x
-			while _id in self.ipool:
-				await asleep(_watcher_interval)
-			while _id in self.rids:
-				await asleep(_watcher_interval)
-			if _id in self.opool:
-				with self.opool_lck:
-					_rs = self.opool.pop(_id)
-		finally:
-			if _id is not None:
-				with self.ipool_lck:
-					if _id in self.ipool:
-						del self.ipool[_id]
-				with self.rids_lck:
-					if _id in self.rids:
-						self.rids.remove(_id)
-				with self.opool_lck:
-					if _id in self.opool:
-						del self.opool[_id]
-				with self.idpool_lck:
-					self.idpool.add(_id)
-				if self.mids and (_id in self.mids):
-					with self.mids_lck:
-						if _id in self.mids:
-							self.mids.remove(_id)
-
-		return _rs
+def set_future_exception(fut, e):
 
-	def processor(self):
+	if not fut.done():
+		fut.set_exception(e)
 
-		while self.running:
-			if self.ipool:
-				with self.ipool_lck:
-					_hd = self.ipool
-					with self.rids_lck:
-						self.rids |= set(_hd.keys())
-					self.ipool = {}
-				_i = list(set(_ for _v in _hd.values() for _ in _v))
-				_map = {_k: _v for _k, _v in zip(_i, self.handler(_i))}
-				_rs = {_k: [_map.get(_iu, _iu) for _iu in _i] for _k, _i in _hd.items()}
-				with self.opool_lck:
-					self.opool |= _rs
-				with self.rids_lck:
-					self.rids -= set(_hd.keys())
-			else:
-				sleep(self.wait_interval)
-
-	def maintainer(self):
+# collects the inputs (lists of sequences) of concurrent requests into batches for the handler. Requests are put into a queue and wait on asyncio futures, the processor thread is woken up by a condition variable, and handles a batch once max_sentences sequences or max_tokens (padded) tokens are waiting, or the oldest request has waited for max_wait seconds.
 
-		while self.running:
-			if self.opool:
-				if self.opids:
-					_gc = set()
-					with self.opool_lck:
-						for _ in self.opids:
-							if _ in self.opool:
-								del self.opool[_]
-								_gc.add(_)
-						self.opids = tuple(self.opool.keys())
-					if _gc:
-						with self.idpool_lck:
-							self.idpool |= _gc
-			else:
-				if (not self.rids) and (not self.ipool):
-					if self.mids:
-						with self.mids_lck, self.idpool_lck:
-							self.idpool |= self.mids
-							self.mids.clear()
-					else:
-						with self.idpool_lck, self.cid_lck, self.ipool_lck, self.rids_lck, self.opool_lck:
-							_mids = set(range(1, self.cid)) - self.idpool - set(self.ipool.keys()) - self.rids - set(self.opool.keys())
-						if _mids:
-							with self.mids_lck:
-								self.mids |= _mids
-			sleep(self.maintain_interval)
-
-	def get_id_core(self):
-
-		rs = None
-		with self.idpool_lck:
-			if self.idpool:
-				rs = self.idpool.pop()
-		if rs is None:
-			with self.cid_lck:
-				rs = self.cid
-				self.cid += 1
+class BatchWrapper:
 
-		return rs
+	def __init__(self, handler, max_sentences=max_sentences, max_tokens=max_tokens, max_wait=max_wait, get_cost=seq_cost, **kwargs):
 
-	def get_id(self):
+		self.handler, self.max_sentences, self.max_tokens, self.max_wait, self.get_cost = handler, max_sentences, max_tokens, max_wait, get_cost
+		self.queue = deque()
+		self.cond = Condition()
+		self.nseq = self.mlen = 0
+		self.running = True
+		self.t_process = start_thread_with_keeper([self.is_running], None, thread_keeper_interval, target=self.processor)
+
+	async def __call__(self, x):
 
-		rs = self.get_id_core()
-		while (rs in self.ipool) or (rs in self.rids) or (rs in self.opool):
-			rs = self.get_id_core()
+		if not x:
+			return x
+		_loop = get_running_loop()
+		_fut = _loop.create_future()
+		_nseq, _mlen = len(x), max(self.get_cost(_) for _ in x)
+		with self.cond:
+			self.queue.append((x, _nseq, _mlen, _fut, _loop, time(),))
+			self.nseq += _nseq
+			self.mlen = max(self.mlen, _mlen)
+			# wake up the processor if it is waiting for requests or the batch gets full
+			if (self.nseq == _nseq) or self.is_full():
+				self.cond.notify()
+
+		return await _fut
+
+	def is_full(self):
+
+		return (self.nseq >= self.max_sentences) or ((self.nseq * self.mlen) >= self.max_tokens)
+
+	def get_batch(self):
+
+		rs = []
+		_nseq = _mlen = 0
+		while self.queue:
+			_x, _ns, _ml, _fut, _loop, _ = self.queue[0]
+			if not _fut.cancelled():
+				_nseq += _ns
+				_mlen = max(_mlen, _ml)
+				if rs and ((_nseq > self.max_sentences) or ((_nseq * _mlen) > self.max_tokens)):
+					break
+				rs.append((_x, _fut, _loop,))
+			self.queue.popleft()
+		self.nseq = sum(_[1] for _ in self.queue)
+		self.mlen = max((_[2] for _ in self.queue), default=0)
 
 		return rs
 
+	def processor(self):
+
+		while self.running:
+			with self.cond:
+				while self.running and (not self.queue):
+					self.cond.wait()
+				if not self.running:
+					break
+				_deadline = self.queue[0][-1] + self.max_wait
+				while self.running and (not self.is_full()):
+					_wait = _deadline - time()
+					if _wait <= 0.0:
+						break
+					self.cond.wait(_wait)
+				_batch = self.get_batch()
+			if _batch:
+				try:
+					_i = list(set(_iu for _x, _, _ in _batch for _iu in _x))
+					_map = {_k: _v for _k, _v in zip(_i, self.handler(_i))}
+					for _x, _fut, _loop in _batch:
+						_loop.call_soon_threadsafe(set_future_result, _fut, [_map.get(_iu, _iu) for _iu in _x])
+				except Exception as e:
+					for _x, _fut, _loop in _batch:
+						_loop.call_soon_threadsafe(set_future_exception, _fut, e)
+
 	def status(self, mode):
 
-		self.running = mode
+		with self.cond:
+			self.running = mode
+			self.cond.notify_all()
 
 	def is_running(self):
 
@@ -0,0 +1,120 @@
+#encoding: utf-8
+
+from collections import OrderedDict
+from os.path import exists as fs_check
+from pickle import dump as pkl_dump, load as pkl_load
+from sys import getsizeof
+from threading import Lock
+from time import time
+
+from cnfg.server import tm_cache_file, tm_cache_size, tm_cache_ttl
+
+def entry_size(k, v):
+
+	return getsizeof(k[0]) + getsizeof(k[1]) + getsizeof(v)
+
+# sentence-level translation memory: an LRU cache of translations keyed on the model id and the (normalized, tokenized, truecased and BPE segmented) source sentence. The (estimated) memory consumption of entries is bounded by max_size bytes, entries expire after ttl seconds (never if None), and they are loaded from / saved to fname (if given) for warm restarts. Thread-safe for the threaded server.
+
+class TranslationCache:
+
+	def __init__(self, model_id, max_size=tm_cache_size, ttl=tm_cache_ttl, fname=tm_cache_file, **kwargs):
+
+		self.model_id, self.max_size, self.ttl, self.fname = model_id, max_size, ttl, fname
+		self.data = OrderedDict()
+		self.size = self.hits = self.misses = 0
+		self.lck = Lock()
+		if (fname is not None) and fs_check(fname):
+			self.load(fname)
+
+	def is_valid(self, exp_time, cur_time):
+
+		return (exp_time is None) or (exp_time > cur_time)
+
+	def shrink(self):
+
+		while self.data and (self.size > self.max_size):
+			_k, (_v, _,) = self.data.popitem(last=False)
+			self.size -= entry_size(_k, _v)
+
+	def set(self, k, v, exp_time):
+
+		if k in self.data:
+			self.size -= entry_size(k, self.data.pop(k)[0])
+		_size = entry_size(k, v)
+		if _size <= self.max_size:
+			self.data[k] = (v, exp_time,)
+			self.size += _size
+
+	# sentences: list of source sentences
+	# return the list of cached translations, None for misses
+
+	def get(self, sentences):
+
+		rs = []
+		_cur_time = time()
+		with self.lck:
+			for _s in sentences:
+				_k = (self.model_id, _s,)
+				_v = self.data.get(_k, None)
+				if _v is not None:
+					if self.is_valid(_v[-1], _cur_time):
+						self.data.move_to_end(_k)
+						_v = _v[0]
+					else:
+						del self.data[_k]
+						self.size -= entry_size(_k, _v[0])
+						_v = None
+				if _v is None:
+					self.misses += 1
+				else:
+					self.hits += 1
+				rs.append(_v)
+
+		return rs
+
+	def put(self, sentences, translations):
+
+		_exp_time = None if self.ttl is None else (time() + self.ttl)
+		with self.lck:
+			for _s, _t in zip(sentences, translations):
+				self.set((self.model_id, _s,), _t, _exp_time)
+			self.shrink()
+
+	def __len__(self):
+
+		return len(self.data)
+
+	def status(self):
+
+		_nreq = self.hits + self.misses
+
+		return {"entries": len(self.data), "size": self.size, "hits": self.hits, "misses": self.misses, "hit_rate": (self.hits / _nreq) if _nreq > 0 else 0.0}
+
+	def clear(self):
+
+		with self.lck:
+			self.data.clear()
+			self.size = 0
+
+	def save(self, fname=None):
+
+		_fname = self.fname if fname is None else fname
+		if _fname is not None:
+			with self.lck:
+				_data = list(self.data.items())
+			with open(_fname, "wb") as f:
+				pkl_dump(_data, f)
+
+	# entries of all models are kept (the model id is part of the key), expired ones are dropped.
+
+	def load(self, fname=None):
+
+		_fname = self.fname if fname is None else fname
+		with open(_fname, "rb") as f:
+			_data = pkl_load(f)
+		_cur_time = time()
+		with self.lck:
+			for _k, (_v, _exp_time,) in _data:
+				if self.is_valid(_exp_time, _cur_time):
+					self.set(_k, _v, _exp_time)
+			self.shrink()
@@ -0,0 +1,97 @@
+#encoding: utf-8
+
+import torch
+from collections import OrderedDict
+from torch import nn
+
+try:
+	from torch.ao.nn.quantized.dynamic import Linear as QLinear
+	from torch.ao.quantization import default_dynamic_qconfig, per_channel_dynamic_qconfig, quantize_dynamic
+except Exception as e:
+	from torch.nn.quantized.dynamic import Linear as QLinear
+	from torch.quantization import default_dynamic_qconfig, per_channel_dynamic_qconfig, quantize_dynamic
+
+from cnfg.ihyp import quant_per_channel
+
+# suffixes of the keys of quantized Linear layers in checkpoints, for int8 weights, their scales, zero points, and the channel axis (only for per-channel quantization), and the bias.
+qweight_suffix, qscale_suffix, qzero_point_suffix, qaxis_suffix, qbias_suffix = ".qweight", ".qweight_scale", ".qweight_zero_point", ".qweight_axis", ".qbias"
+
+# quantize all Linear layers (including the classifier, which gets its own int8 copy if it is bound to the embedding) of model to int8 with dynamic quantization for inference on CPU. It is a no-op for quantized models.
+
+def quantize_model(model, per_channel=quant_per_channel):
+
+	return quantize_dynamic(model, {nn.Linear: per_channel_dynamic_qconfig if per_channel else default_dynamic_qconfig}, dtype=torch.qint8, inplace=True)
+
+def is_quantized(model):
+
+	return any(isinstance(_, QLinear) for _ in model.modules())
+
+def make_qweight(weight, scale, zero_point, axis=None):
+
+	return torch._make_per_tensor_quantized_tensor(weight, scale.item(), zero_point.item()) if axis is None else torch._make_per_channel_quantized_tensor(weight, scale, zero_point, axis.item())
+
+# select output features of the quantized Linear layer m with indices, returns a new layer.
+
+def qlinear_index_select(m, indices):
+
+	_w, _b = m._weight_bias()
+	if _w.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric,):
+		_axis = _w.q_per_channel_axis()
+		_qw = torch._make_per_channel_quantized_tensor(_w.int_repr().index_select(0, indices), _w.q_per_channel_scales().index_select(0, indices) if _axis == 0 else _w.q_per_channel_scales(), _w.q_per_channel_zero_points().index_select(0, indices) if _axis == 0 else _w.q_per_channel_zero_points(), _axis)
+	else:
+		_qw = torch._make_per_tensor_quantized_tensor(_w.int_repr().index_select(0, indices), _w.q_scale(), _w.q_zero_point())
+	rs = QLinear(m.in_features, indices.size(0), bias_=_b is not None, dtype=_w.dtype)
+	rs.set_weight_bias(_qw, None if _b is None else _b.index_select(0, indices))
+
+	return rs
+
+# parameters of the quantized model for saving, the int8 weights of quantized Linear layers are saved with their quantization parameters.
+
+def quant_mp_func(model):
+
+	rs = {_k: _t.data for _k, _t in model.named_parameters()}
+	for _name, _m in model.named_modules():
+		if isinstance(_m, QLinear):
+			_w, _b = _m._weight_bias()
+			rs[_name + qweight_suffix] = _w.int_repr()
+			if _w.qscheme() in (torch.per_channel_affine, torch.per_channel_symmetric,):
+				rs[_name + qscale_suffix], rs[_name + qzero_point_suffix], rs[_name + qaxis_suffix] = _w.q_per_channel_scales(), _w.q_per_channel_zero_points(), torch.as_tensor([_w.q_per_channel_axis()], dtype=torch.long)
+			else:
+				rs[_name + qscale_suffix], rs[_name + qzero_point_suffix] = torch.as_tensor([_w.q_scale()], dtype=torch.double), torch.as_tensor([_w.q_zero_point()], dtype=torch.long)
+			if _b is not None:
+				rs[_name + qbias_suffix] = _b.detach()
+
+	return rs
+
+def is_quant_mp(mp):
+
+	return isinstance(mp, dict) and any(_k.endswith(qweight_suffix) for _k in mp.keys())
+
+# load parameters saved by quant_mp_func into model, which is quantized first.
+
+def load_quant_mp(model, mp, strict=False, print_func=print, **kwargs):
+
+	quantize_model(model, per_channel=any(_k.endswith(qaxis_suffix) for _k in mp.keys()))
+	_qkeys, _qprefix = set(), []
+	for _name, _m in model.named_modules():
+		if isinstance(_m, QLinear):
+			_k = _name + qweight_suffix
+			if _k in mp:
+				_m.set_weight_bias(make_qweight(mp[_k], mp[_name + qscale_suffix], mp[_name + qzero_point_suffix], mp.get(_name + qaxis_suffix, None)), mp.get(_name + qbias_suffix, None))
+				_qkeys |= set(_name + _ for _ in (qweight_suffix, qscale_suffix, qzero_point_suffix, qaxis_suffix, qbias_suffix,))
+			elif print_func is not None:
+				print_func("Missing quantized weight: %s" % _k)
+			_qprefix.append(_name + ".")
+	# quantized Linear layers are set above, and their current states (with the version metadata required by their loading functions) are passed to load_state_dict
+	_qprefix = tuple(_qprefix)
+	_sd = model.state_dict()
+	_mp = OrderedDict((_k, _v,) for _k, _v in mp.items() if _k not in _qkeys)
+	_mp.update((_k, _v,) for _k, _v in _sd.items() if _k.startswith(_qprefix))
+	_mp._metadata = getattr(_sd, "_metadata", None)
+	_ = model.load_state_dict(_mp, strict=strict)
+	if (print_func is not None) and (_ is not None):
+		for _msg in _:
+			if _msg:
+				print_func(_msg)
+
+	return model
@@ -0,0 +1,69 @@
+#encoding: utf-8
+
+import torch
+
+from parallel.dist import all_gather_dict, all_reduce_host
+
+# accumulate losses of batches on device without synchronizing with the host for each batch, losses are copied to the host in one transfer only when they are needed (flush, at report boundaries and the end of epochs), while numbers of tokens are counted on the host. Losses of each batch divided by its number of tokens are kept in self.ls (keyed by batch ids) for dynamic sampling if save_loss. Reports and totals are summed over processes (and self.ls is merged) if distributed, they shall be called at the same time by all processes. It is used by `train.py` and the BART training scripts at the root of the repository, training scripts under `adv/train/` still synchronize for the loss of each batch.
+
+class MetricAccumulator:
+
+	def __init__(self, save_loss=False, buf_size=1024, distributed=False, **kwargs):
+
+		self.save_loss, self.buf_size, self.distributed = save_loss, buf_size, distributed
+		self.buf = None
+		self.nbuf = 0
+		self.wds, self.keys = [], []
+		self.sum_loss = self.part_loss = 0.0
+		self.sum_wd = self.part_wd = 0
+		self.ls = {} if save_loss else None
+
+	def add(self, loss, wd, key=None):
+
+		_loss = loss.detach()
+		if self.buf is None:
+			self.buf = _loss.new_zeros(self.buf_size, dtype=torch.float32)
+		elif self.nbuf >= self.buf.size(0):
+			self.buf = torch.cat((self.buf, self.buf.new_zeros(self.buf.size(0)),), 0)
+		self.buf[self.nbuf] = _loss
+		self.nbuf += 1
+		self.sum_wd += wd
+		self.part_wd += wd
+		if self.save_loss:
+			self.wds.append(wd)
+			self.keys.append(key)
+
+	def flush(self):
+
+		if self.nbuf > 0:
+			_losses = self.buf.narrow(0, 0, self.nbuf).tolist()
+			_sum = sum(_losses)
+			self.sum_loss += _sum
+			self.part_loss += _sum
+			if self.save_loss:
+				for _key, _loss, _wd in zip(self.keys, _losses, self.wds):
+					self.ls[_key] = _loss / _wd
+				self.wds, self.keys = [], []
+			self.nbuf = 0
+
+	# return the sum of losses and the number of tokens since the last report
+
+	def report(self):
+
+		self.flush()
+		rs = all_reduce_host(self.part_loss, self.part_wd) if self.distributed else (self.part_loss, self.part_wd,)
+		self.part_loss = 0.0
+		self.part_wd = 0
+
+		return rs
+
+	def total(self):
+
+		self.flush()
+		if self.distributed:
+			if self.save_loss:
+				self.ls = all_gather_dict(self.ls)
+
+			return all_reduce_host(self.sum_loss, self.sum_wd)
+
+		return self.sum_loss, self.sum_wd
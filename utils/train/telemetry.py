@@ -0,0 +1,96 @@
+#encoding: utf-8
+
+import torch
+from json import dumps
+from time import perf_counter, time
+
+from utils.fmt.base import sys_open
+
+from cnfg.ihyp import *
+from cnfg.vocab.base import pad_id
+
+# sections of the time breakdown of training, the time between two consecutive tick(name) calls is counted to name
+sections = ("data", "forward", "backward", "optimizer", "eva", "save",)
+
+# training telemetry of each report interval: source/target tokens per second, the padding ratio of batches fed to the model, the time breakdown over sections, the peak memory of the device, the gradient norm (of parameters updated by each optimizer step, after unscaling with amp) and optimizer steps per hour. Reports are logged and appended to the JSON-lines file jsonf. Gradient norms are kept on the device and only copied to the host at reports.
+
+class Telemetry:
+
+	def __init__(self, logger=None, jsonf=None, device=None, optm=None, sync=telemetry_sync, pad_id=pad_id, **kwargs):
+
+		self.logger, self.jsonf, self.pad_id = logger, jsonf, pad_id
+		self.device = device if (device is not None) and (device.type == "cuda") else None
+		self.sync = sync and (self.device is not None)
+		self.gnorms, self.ngopt = [], 0
+		if optm is not None:
+			# the optimizer of multi-GPU training (`parallel.optm.MultiGPUOptimizer`) runs one optimizer per GPU for a part of parameters
+			_optms = getattr(optm, "optms", None) or [optm]
+			if all(hasattr(_, "register_step_pre_hook") for _ in _optms):
+				for _ in _optms:
+					_.register_step_pre_hook(self.grad_norm_hook)
+				self.ngopt = len(_optms)
+		self.reset()
+
+	def reset(self):
+
+		self.times = {_: 0.0 for _ in sections}
+		self.counts = {_: 0 for _ in sections}
+		self.nbatch = self.nsrc = self.ntgt = self.nall = 0
+		self.gnorms = []
+		if self.device is not None:
+			torch.cuda.reset_peak_memory_stats(self.device)
+		self.start = self.mark = perf_counter()
+
+	# count the time since the last tick to name, name None discards it (e.g., the time between epochs) from the elapsed time as well
+
+	def tick(self, name=None):
+
+		if self.sync:
+			torch.cuda.synchronize(self.device)
+		_t = perf_counter()
+		if name is None:
+			self.start += _t - self.mark
+		else:
+			self.times[name] += _t - self.mark
+			self.counts[name] += 1
+		self.mark = _t
+
+	# src/tgt: batches fed to the model (after packing) on the host
+
+	def add_batch(self, src, tgt):
+
+		self.nbatch += 1
+		self.nsrc += src.ne(self.pad_id).int().sum().item()
+		self.ntgt += tgt.ne(self.pad_id).int().sum().item()
+		self.nall += src.numel() + tgt.numel()
+
+	# squared norms are collected from all optimizers of a step and reduced on the device of the first one
+
+	def grad_norm_hook(self, optm, *args, **kwargs):
+
+		_grads = [_p.grad for _group in optm.param_groups for _p in _group["params"] if _p.grad is not None]
+		if _grads:
+			_norm = torch.stack([torch.linalg.vector_norm(_, dtype=torch.float32) for _ in _grads]).pow(2).sum()
+			self.gnorms.append(_norm if (not self.gnorms) or (_norm.device == self.gnorms[0].device) else _norm.to(self.gnorms[0].device, non_blocking=True))
+
+	def report(self, cur_b=None):
+
+		_elapsed = perf_counter() - self.start
+		_el = max(_elapsed, 1e-9)
+		_nstep = self.counts["optimizer"]
+		_gnorm = None
+		if self.gnorms:
+			_gn = torch.stack(self.gnorms)
+			_ngopt = self.ngopt if (self.ngopt > 1) and (_gn.size(0) % self.ngopt == 0) else 1
+			_gnorm = _gn.view(-1, _ngopt).sum(-1).sqrt().tolist()
+		rs = {"timestamp": time(), "batch": cur_b, "nbatch": self.nbatch, "elapsed": _elapsed, "src_tokens_per_sec": self.nsrc / _el, "tgt_tokens_per_sec": self.ntgt / _el, "padding_ratio": (1.0 - (self.nsrc + self.ntgt) / self.nall) if self.nall > 0 else 0.0, "time": dict(self.times), "peak_memory_mb": (torch.cuda.max_memory_allocated(self.device) / 1048576.0) if self.device is not None else None, "grad_norm": (sum(_gnorm) / len(_gnorm)) if _gnorm else None, "grad_norm_max": max(_gnorm) if _gnorm else None, "steps_per_hour": _nstep * 3600.0 / _el}
+		if self.logger is not None:
+			_times = ", ".join("%s %.2fs (%.1f%%)" % (_k, _v, _v / _el * 100.0,) for _k, _v in self.times.items())
+			self.logger.info("Tokens/s: %.1f source, %.1f target, padding ratio: %.2f%%, time: %s, peak memory: %s, grad norm: %s, steps/hour: %.1f" % (rs["src_tokens_per_sec"], rs["tgt_tokens_per_sec"], rs["padding_ratio"] * 100.0, _times, "n/a" if rs["peak_memory_mb"] is None else ("%.1fMB" % rs["peak_memory_mb"]), "n/a" if _gnorm is None else ("%.3f (max %.3f)" % (rs["grad_norm"], rs["grad_norm_max"],)), rs["steps_per_hour"],))
+		if self.jsonf is not None:
+			with sys_open(self.jsonf, "a", encoding="utf-8") as f:
+				f.write(dumps(rs))
+				f.write("\n")
+		self.reset()
+
+		return rs